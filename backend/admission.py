@@ -0,0 +1,129 @@
+"""
+Admission control for the conversion endpoints.
+
+Every conversion holds upload buffers, decoded pages and worker slots, so
+letting an unbounded number run at once degrades all of them (and can run
+the node out of memory).  AdmissionMiddleware counts the conversion requests
+in progress, globally and per client, and answers requests over either
+limit straight away, before their body is read: 503 when the server is
+full, 429 when one client already has its share, both with ``Retry-After``.
+Upload session files (PUT) and finalize count like conversions, since
+both decode and encode pages.
+A request keeps its slot until its response has been sent completely, so
+streamed responses count for as long as they are being produced.
+"""
+import json
+import logging
+import re
+from collections import Counter
+from typing import Iterable, Optional, Tuple
+
+import config
+from metrics import REJECTED_REQUESTS
+
+logger = logging.getLogger('snapmerge.admission')
+
+
+class AdmissionController:
+    """Counts requests in progress against a global and a per-client limit (0 = unlimited)"""
+
+    def __init__(self, max_concurrent: int = config.MAX_CONCURRENT_CONVERSIONS,
+                 max_per_client: int = config.MAX_CONVERSIONS_PER_CLIENT,
+                 retry_after: int = config.ADMISSION_RETRY_AFTER):
+        self.max_concurrent = max_concurrent
+        self.max_per_client = max_per_client
+        self.retry_after = retry_after
+        self.active = 0
+        self.rejected = 0
+        self._per_client: Counter = Counter()
+
+    def try_acquire(self, client: str) -> Optional[Tuple[int, str]]:
+        """Take a slot for ``client``; returns (status, reason) instead when over a limit"""
+        if self.max_per_client > 0 and self._per_client[client] >= self.max_per_client:
+            self.rejected += 1
+            return 429, f"Too many concurrent conversions from this client (limit {self.max_per_client})"
+        if self.max_concurrent > 0 and self.active >= self.max_concurrent:
+            self.rejected += 1
+            return 503, f"Server is busy (limit {self.max_concurrent} concurrent conversions)"
+        self.active += 1
+        self._per_client[client] += 1
+        return None
+
+    def release(self, client: str):
+        self.active -= 1
+        self._per_client[client] -= 1
+        if self._per_client[client] <= 0:
+            del self._per_client[client]
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'clients': len(self._per_client),
+            'max_concurrent': self.max_concurrent,
+            'max_per_client': self.max_per_client,
+            'rejected': self.rejected,
+        }
+
+
+def client_address(scope: dict, header: str = config.CLIENT_IP_HEADER) -> str:
+    """
+    The client a request is accounted to: the first address in ``header``
+    (e.g. X-Forwarded-For, when running behind a trusted proxy) or else the
+    peer address of the connection
+    """
+    if header:
+        name = header.lower().encode('latin-1')
+        for key, value in scope.get('headers', []):
+            if key == name:
+                first = value.decode('latin-1').split(',')[0].strip()
+                if first:
+                    return first
+    client = scope.get('client')
+    return client[0] if client else 'unknown'
+
+
+def path_pattern(paths: Iterable[str]) -> re.Pattern:
+    """A regex matching any of the route ``paths``; a ``{name}`` part matches one path segment"""
+    alternatives = (re.sub(r'\\\{\w+\\\}', '[^/]+', re.escape(path)) for path in paths)
+    return re.compile('(?:%s)' % '|'.join(alternatives))
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying an AdmissionController to POSTs and PUTs on the given route paths"""
+
+    def __init__(self, app, controller: AdmissionController, paths: Iterable[str] = ('/convert', '/jobs')):
+        self.app = app
+        self.controller = controller
+        self.paths = path_pattern(paths)
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] != 'http' or scope['method'] not in ('POST', 'PUT')
+                or not self.paths.fullmatch(scope['path'])):
+            await self.app(scope, receive, send)
+            return
+
+        client = client_address(scope)
+        rejection = self.controller.try_acquire(client)
+        if rejection is not None:
+            status, reason = rejection
+            REJECTED_REQUESTS.inc(status=status)
+            logger.warning("🚦 Rejected %s from %s: %s", scope['path'], client, reason,
+                           extra={'client': client, 'status': status})
+            await _send_json(send, status, {"error": reason},
+                             [(b'retry-after', str(self.controller.retry_after).encode())])
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(client)
+
+
+async def _send_json(send, status: int, content: dict, headers: list):
+    body = json.dumps(content).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode())] + headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
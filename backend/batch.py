@@ -0,0 +1,291 @@
+"""
+Batch conversions: many independent documents from one request.
+
+Back offices build dozens of packets at once, and a /convert per packet
+pays for the multipart parsing, the temp directory and the response every
+time, and processes files that several packets share once per packet.
+``POST /batch`` takes every file once plus a JSON manifest naming the
+output documents and the uploads each is made of, by filename or upload
+position:
+
+    {"documents": [
+        {"name": "smith", "files": ["smith-passport.jpg", "bank-letter.pdf"]},
+        {"name": "doe", "files": [3, "bank-letter.pdf"], "mode": "split"}]}
+
+Every distinct upload (by content and filename, so the same file attached
+twice is one upload too) is processed once, however many documents use it,
+through one window over the shared worker pool, in the order the documents
+need them.  The documents go into one ZIP that is streamed as they are
+completed, in manifest order: a merged document as ``<name>.pdf``, a split
+one as ``<name>/<upload>.pdf`` per upload, and finally
+``batch_report.json`` with the per-document counts.  Processed pages are
+held only until the last document using them has been written.
+"""
+import asyncio
+import json
+import logging
+import zipfile
+from collections import Counter
+from contextlib import aclosing
+from dataclasses import dataclass, replace
+from typing import AsyncIterator, Dict, List, Tuple
+
+import config
+from conversion import CONVERT_FORM_SCHEMA, ConversionProgress, parse_convert_fields, process_upload
+from executor import ordered_window
+from pdfstream import ChunkBuffer
+from pipeline import (
+    ZIP_COMPRESSIONS,
+    MergedDocument,
+    PageOptions,
+    page_filename,
+    render_single_page_pdf,
+    split_document_name,
+)
+from uploads import UploadError, ordered_upload_name
+
+logger = logging.getLogger('snapmerge.batch')
+
+BATCH_REPORT_NAME = 'batch_report.json'
+
+# Page processing applies to the whole batch; mode is each document's default
+BATCH_FIELDS = ('mode', 'pipeline', 'label_mode', 'color_mode', 'max_in_flight', 'zip_compression')
+
+BATCH_FORM_SCHEMA = {
+    "type": "object",
+    "required": ["files", "manifest"],
+    "properties": {
+        "files": CONVERT_FORM_SCHEMA["properties"]["files"],
+        "manifest": {"type": "string",
+                     "description": 'JSON: {"documents": [{"name": ..., "files": [filename or position, ...], '
+                                    '"mode": "merge" or "split"}, ...]}'},
+        **{name: CONVERT_FORM_SCHEMA["properties"][name] for name in BATCH_FIELDS},
+    },
+}
+
+
+@dataclass
+class BatchDocument:
+    """One output document of a batch"""
+    name: str
+    mode: str  # 'merge' or 'split'
+    uploads: list  # In document order; an upload may appear in several documents
+
+
+def upload_key(upload) -> Tuple[str, str]:
+    """Uploads with the same key give the same pages"""
+    return upload.sha256, upload.filename
+
+
+def _document_name(value, number: int) -> str:
+    if not isinstance(value, str) or not value.strip():
+        raise UploadError(f"Document {number} needs a name")
+    # One path segment inside the archive
+    name = value.strip().replace('/', '_').replace('\\', '_')
+    return '_' + name if name.startswith('.') else name
+
+
+def parse_manifest(text: str, uploads: list, default_mode: str) -> List[BatchDocument]:
+    """The documents of a batch manifest; raises UploadError when it is malformed or refers to no upload"""
+    try:
+        manifest = json.loads(text)
+    except ValueError as e:
+        raise UploadError(f"manifest is not valid JSON: {e}")
+    entries = manifest.get("documents") if isinstance(manifest, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise UploadError('manifest must be an object with a non-empty "documents" list')
+    if len(entries) > config.MAX_BATCH_DOCUMENTS:
+        raise UploadError(f"manifest lists {len(entries)} documents, over the limit of "
+                          f"{config.MAX_BATCH_DOCUMENTS}", status_code=413)
+
+    by_name: Dict[str, list] = {}
+    for upload in uploads:
+        by_name.setdefault(upload.filename, []).append(upload)
+
+    def resolve(reference, number: int):
+        if isinstance(reference, int) and not isinstance(reference, bool):
+            if 0 <= reference < len(uploads):
+                return uploads[reference]
+            raise UploadError(f"Document {number}: no upload at position {reference}")
+        if isinstance(reference, str):
+            matches = by_name.get(reference, [])
+            if not matches:
+                raise UploadError(f"Document {number}: no upload named '{reference}'")
+            if len({upload_key(upload) for upload in matches}) > 1:
+                raise UploadError(f"Document {number}: '{reference}' was uploaded more than once "
+                                  f"with different content, refer to it by position")
+            return matches[0]
+        raise UploadError(f"Document {number}: files are filenames or upload positions")
+
+    documents, names = [], set()
+    for number, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            raise UploadError(f"Document {number} must be an object")
+        name = _document_name(entry.get("name"), number)
+        if name.lower() in names:
+            raise UploadError(f"Document name '{name}' is used more than once")
+        names.add(name.lower())
+        mode = entry.get("mode", default_mode)
+        if mode not in ('merge', 'split'):
+            raise UploadError(f"Document '{name}': unknown mode '{mode}', expected one of: merge, split")
+        files = entry.get("files")
+        if not isinstance(files, list) or not files:
+            raise UploadError(f"Document '{name}' needs a non-empty files list")
+        documents.append(BatchDocument(name, mode, [resolve(reference, number) for reference in files]))
+    return documents
+
+
+def parse_batch_fields(fields: dict, uploads: list):
+    """The page parameters and documents of a /batch form; raises UploadError on bad values"""
+    if "manifest" not in fields:
+        raise UploadError("manifest is required")
+    params = parse_convert_fields({name: fields[name] for name in BATCH_FIELDS if name in fields})
+    if params["mode"] not in ('merge', 'split'):
+        raise UploadError(f"Unknown mode '{params['mode']}', expected one of: merge, split")
+    return params, parse_manifest(fields["manifest"], uploads, params["mode"])
+
+
+class BatchArchive:
+    """
+    The batch response: a ZIP that documents are written into one at a
+    time, page by page; ``out`` does not need to be seekable
+    """
+
+    def __init__(self, out, compression: str = 'stored'):
+        self._zip = zipfile.ZipFile(out, 'w', ZIP_COMPRESSIONS[compression])
+        self._entry = None
+        self._document = None
+        self._split_names = set()
+        self._prefix = ''
+        self.entries: List[str] = []  # Of the current document
+
+    def begin(self, document: BatchDocument):
+        self.entries = []
+        if document.mode == 'split':
+            self._prefix, self._split_names = f"{document.name}/", set()
+        else:
+            name = f"{document.name}.pdf"
+            self._entry = self._zip.open(name, 'w', force_zip64=True)
+            self._document = MergedDocument(self._entry)
+            self.entries.append(name)
+
+    def add(self, page, rendered=None):
+        if self._document is not None:
+            self._document.add(page)
+            return
+        if rendered is None:
+            rendered = render_single_page_pdf(page)
+        name = self._prefix + split_document_name(page_filename(page), self._split_names)
+        self._zip.writestr(name, rendered)
+        self.entries.append(name)
+
+    def end(self):
+        if self._document is not None:
+            self._document.close()
+            self._entry.close()
+        self._entry = self._document = None
+
+    def write_report(self, report: dict):
+        self._zip.writestr(BATCH_REPORT_NAME, json.dumps(report, indent=2))
+
+    def close(self):
+        self._zip.close()
+
+    def abort(self):
+        """Give up on an unfinished archive while ``out`` is still open"""
+        try:
+            if self._entry is not None:
+                self._entry.close()
+            self._zip.close()
+        except (OSError, ValueError):
+            pass
+
+
+async def stream_batch(documents: List[BatchDocument], params: dict, options: PageOptions, in_flight: int,
+                       report: dict) -> AsyncIterator[bytes]:
+    """
+    Process the batch and yield the ZIP in chunks, a page at a time.
+
+    Nothing is yielded before the first page of the first document that
+    has any; when no document has a page the generator ends without
+    yielding at all.  ``report`` is filled in as documents finish and is
+    written into the archive as the last entry.
+    """
+    # Every distinct upload once, in the order the documents need them
+    uses = Counter(upload_key(upload) for document in documents for upload in document.uploads)
+    split_keys = {upload_key(upload) for document in documents if document.mode == 'split'
+                  for upload in document.uploads}
+    first_use = {}
+    for document in documents:
+        for upload in document.uploads:
+            first_use.setdefault(upload_key(upload), upload)
+    distinct = list(first_use.values())
+    report.update({"processed_files": len(distinct),
+                   "shared_files": sum(1 for count in uses.values() if count > 1), "documents": []})
+
+    # Shared by every page task of the batch, TIFF frames included
+    limiter = asyncio.Semaphore(max(1, in_flight))
+
+    def process(upload):
+        # Split documents render each upload's own PDF inside the window
+        render = render_single_page_pdf if upload_key(upload) in split_keys else None
+        return process_upload(upload, params["pipeline"], options, limiter, render=render)
+
+    sink = ChunkBuffer()
+    archive = BatchArchive(sink, params["zip_compression"])
+    ready: Dict[Tuple[str, str], tuple] = {}  # Processed uploads still needed: (page or exception, rendered)
+    written = 0
+    complete = False
+    try:
+        async with aclosing(ordered_window((process(upload) for upload in distinct), in_flight)) as results:
+            pending = iter(distinct)
+            for document in documents:
+                for upload in document.uploads:
+                    while upload_key(upload) not in ready:
+                        done = next(pending)
+                        result = await anext(results)
+                        # The processed page is all we need from here on
+                        done.data = None
+                        ready[upload_key(done)] = (result, None) if isinstance(result, Exception) else result
+
+                # Numbered within the document, as if it had come in its own request
+                uploads = [replace(upload, index=index, ordered_name=ordered_upload_name(index, upload.filename))
+                           for index, upload in enumerate(document.uploads)]
+                progress = ConversionProgress(uploads)
+                begun = False
+                for upload in uploads:
+                    result, rendered = ready[upload_key(upload)]
+                    page = progress.record(upload, result)
+                    if page is None:
+                        continue
+                    if not begun:
+                        archive.begin(document)
+                        begun = True
+                    await asyncio.to_thread(archive.add, page, rendered)
+                    written += 1
+                    yield sink.drain()
+                entry = {"name": document.name, "mode": document.mode, **progress.status()}
+                del entry["state"], entry["pages"]
+                if begun:
+                    await asyncio.to_thread(archive.end)
+                    entry["entries"] = archive.entries
+                    yield sink.drain()
+                else:
+                    entry["error"] = progress.no_pages_error().content["error"]
+                report["documents"].append(entry)
+                logger.debug("📦 Batch document %s: %d pages", document.name, progress.processed_count)
+
+                for upload in document.uploads:
+                    key = upload_key(upload)
+                    uses[key] -= 1
+                    if not uses[key]:
+                        ready.pop(key, None)
+
+        if written:
+            archive.write_report(report)
+            archive.close()
+            yield sink.drain()
+        complete = True
+    finally:
+        if not complete:
+            archive.abort()
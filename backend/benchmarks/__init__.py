@@ -0,0 +1,4 @@
+"""Performance benchmarks for the SnapMerge conversion pipeline.
+
+Run from the backend directory, e.g. ``python -m benchmarks.bench_single_encode``.
+"""
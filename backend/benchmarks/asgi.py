@@ -0,0 +1,93 @@
+"""
+In-process HTTP driver for the ASGI app.
+
+Requests are handed to the app directly (no sockets, uvicorn or HTTP
+client), so end-to-end benchmarks measure the application itself: body
+parsing, the conversion and producing the response.  The request body is
+delivered in network-sized chunks, as a server would.
+"""
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Iterable, List, Tuple
+
+
+def multipart_body(files: Iterable[Tuple[str, bytes, str]], fields: dict = None) -> Tuple[bytes, str]:
+    """Encode (filename, data, content type) files and form fields; returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                     .encode())
+    for filename, data, content_type in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+@dataclass
+class Response:
+    status: int
+    headers: dict
+    body_bytes: int
+    seconds: float  # Until the last body byte
+    first_byte_seconds: float  # Until the first body byte
+    chunks: List[int] = field(default_factory=list)
+
+
+async def request(app, method: str, path: str, body: bytes = b'', headers: Iterable[Tuple[str, str]] = (),
+                  chunk_size: int = 64 * 1024, client: Tuple[str, int] = ('127.0.0.1', 50000)) -> Response:
+    """Run one request through ``app``; the body is counted, not kept"""
+    raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    raw_headers.append((b'content-length', str(len(body)).encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'root_path': '', 'headers': raw_headers, 'client': client, 'server': ('testserver', 80),
+    }
+    offsets = iter(range(0, max(len(body), 1), chunk_size))
+    done = asyncio.Event()
+    response = Response(status=0, headers={}, body_bytes=0, seconds=0.0, first_byte_seconds=0.0)
+
+    async def receive():
+        offset = next(offsets, None)
+        if offset is not None:
+            chunk = body[offset:offset + chunk_size]
+            return {'type': 'http.request', 'body': chunk, 'more_body': offset + chunk_size < len(body)}
+        # Like a client that stays connected until the response is complete
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    started = time.perf_counter()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response.status = message['status']
+            response.headers = {key.decode('latin-1'): value.decode('latin-1')
+                                for key, value in message.get('headers', [])}
+        elif message['type'] == 'http.response.body':
+            data = message.get('body', b'')
+            if data and not response.chunks:
+                response.first_byte_seconds = time.perf_counter() - started
+            if data:
+                response.chunks.append(len(data))
+                response.body_bytes += len(data)
+            if not message.get('more_body', False):
+                response.seconds = time.perf_counter() - started
+                done.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        done.set()
+    return response
+
+
+@asynccontextmanager
+async def running(app):
+    """Run the app's lifespan (startup and shutdown) around the block"""
+    async with app.router.lifespan_context(app):
+        yield app
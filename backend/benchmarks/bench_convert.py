@@ -0,0 +1,161 @@
+"""
+End-to-end /convert throughput, driven in-process through the ASGI app.
+
+    python -m benchmarks.bench_convert [--pages 12] [--requests 4] [--concurrency 1,4]
+                                       [--modes merge,split] [--stream] [--json out.json]
+
+Every scenario runs in a fresh interpreter that imports the app with the
+result and page caches disabled (so every request does the full work) and
+admission limits off, starts its lifespan, sends one warm-up request and
+then ``--requests`` rounds of ``--concurrency`` simultaneous requests.  The
+request bodies are distinct corpus images (one seed per three pages), so
+the PDF writer cannot share images between pages.
+
+Reported per scenario: latency and time to first byte, pages and input
+megabytes per second, response size, and the peak RSS of the web process
+and of the largest worker process.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.corpus import build_corpus
+from benchmarks.report import write_results
+
+CONTENT_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png'}
+
+
+def corpus_files(corpus_dir: str, pages: int):
+    """``pages`` distinct corpus images as (upload name, path, content type)"""
+    files = []
+    seed = 0
+    while len(files) < pages:
+        for path in build_corpus(corpus_dir, seed=seed):
+            if len(files) < pages:
+                name = f"page_{len(files) + 1:03d}_{os.path.basename(path)}"
+                files.append((name, path, CONTENT_TYPES[os.path.splitext(path)[1]]))
+        seed += 1
+    return files
+
+
+def _percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def _run_scenario(scenario: dict) -> dict:
+    """One scenario in this (fresh) process; the app is imported here, after the environment is set"""
+    os.environ.update(scenario['env'])
+    import main
+    from benchmarks import asgi
+
+    files = []
+    for name, path, content_type in scenario['files']:
+        with open(path, 'rb') as f:
+            files.append((name, f.read(), content_type))
+    fields = {'mode': scenario['mode'], 'pipeline': scenario['pipeline']}
+    if scenario['stream']:
+        fields['stream'] = 'true'
+    body, content_type = asgi.multipart_body(files, fields)
+    headers = [('content-type', content_type)]
+
+    async def convert():
+        response = await asgi.request(main.app, 'POST', '/convert', body, headers)
+        if response.status != 200:
+            raise RuntimeError(f"/convert answered {response.status}")
+        return response
+
+    async def run():
+        async with asgi.running(main.app):
+            await convert()  # Warm-up: worker start-up, fonts, codecs
+            responses = []
+            started = time.perf_counter()
+            for _ in range(scenario['requests']):
+                responses += await asyncio.gather(*(convert() for _ in range(scenario['concurrency'])))
+            return responses, time.perf_counter() - started
+
+    responses, wall = asyncio.run(run())
+    latencies = [r.seconds * 1000 for r in responses]
+    first_bytes = [r.first_byte_seconds * 1000 for r in responses]
+    pages = len(files) * len(responses)
+    # ru_maxrss is in KiB on Linux; the engine's workers have exited (and
+    # been waited for) once the lifespan is over
+    return {
+        'latency_ms_median': round(statistics.median(latencies), 1),
+        'latency_ms_p95': round(_percentile(latencies, 0.95), 1),
+        'first_byte_ms_median': round(statistics.median(first_bytes), 1),
+        'pages_per_second': round(pages / wall, 2),
+        'input_mb_per_second': round(len(body) * len(responses) / wall / 1024 / 1024, 2),
+        'response_bytes': int(statistics.median(r.body_bytes for r in responses)),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'worker_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def measure(scenario: dict) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(_run_scenario, scenario).result()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pages', type=int, default=12, help='images per request')
+    parser.add_argument('--requests', type=int, default=4, help='timed rounds per scenario')
+    parser.add_argument('--concurrency', default='1,4', help='simultaneous requests per round, comma-separated')
+    parser.add_argument('--modes', default='merge,split')
+    parser.add_argument('--stream', action='store_true', help='also measure streamed responses')
+    parser.add_argument('--pipeline', default='single', choices=('single', 'legacy'))
+    parser.add_argument('--executor', default='process', choices=('process', 'thread'))
+    parser.add_argument('--pool-size', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'snapmerge-bench-corpus'))
+    parser.add_argument('--json', help="also write results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    files = corpus_files(args.corpus_dir, args.pages)
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = {
+            'SNAPMERGE_EXECUTOR': args.executor,
+            'SNAPMERGE_POOL_SIZE': str(args.pool_size),
+            'SNAPMERGE_TEMP_ROOT': os.path.join(work_dir, 'temp'),
+            'SNAPMERGE_RESULT_CACHE_DIR': os.path.join(work_dir, 'results'),
+            'SNAPMERGE_RESULT_CACHE_MAX_BYTES': '0',
+            'SNAPMERGE_PAGE_CACHE_DIR': os.path.join(work_dir, 'pages'),
+            'SNAPMERGE_PAGE_CACHE_MAX_BYTES': '0',
+            'SNAPMERGE_MAX_CONCURRENT_CONVERSIONS': '0',
+            'SNAPMERGE_MAX_CONVERSIONS_PER_CLIENT': '0',
+            'SNAPMERGE_LOG_LEVEL': 'WARNING',
+        }
+        for mode in args.modes.split(','):
+            for stream in (False, True) if args.stream else (False,):
+                for concurrency in (int(value) for value in args.concurrency.split(',')):
+                    name = f"{mode}{'_stream' if stream else ''}_c{concurrency}"
+                    results[name] = measure({
+                        'env': env, 'files': files, 'mode': mode, 'stream': stream,
+                        'pipeline': args.pipeline, 'requests': args.requests, 'concurrency': concurrency,
+                    })
+
+    print(f"{'scenario':<22}{'median ms':>11}{'p95 ms':>9}{'1st byte':>10}{'pages/s':>9}{'MB/s in':>9}"
+          f"{'out KB':>9}{'RSS MB':>8}{'worker':>8}")
+    for name, row in results.items():
+        print(f"{name:<22}{row['latency_ms_median']:>11.1f}{row['latency_ms_p95']:>9.1f}"
+              f"{row['first_byte_ms_median']:>10.1f}{row['pages_per_second']:>9.2f}"
+              f"{row['input_mb_per_second']:>9.2f}{row['response_bytes'] / 1024:>9.1f}"
+              f"{row['peak_rss_mb']:>8.1f}{row['worker_peak_rss_mb']:>8.1f}")
+
+    if args.json:
+        write_results(args.json, 'bench_convert', results, parameters={
+            key: value for key, value in vars(args).items() if key not in ('json', 'corpus_dir')})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
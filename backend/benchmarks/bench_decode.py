@@ -0,0 +1,80 @@
+"""
+Decode + resize cost per page with and without reduced-resolution decoding.
+
+    python -m benchmarks.bench_decode [--repeat N] [--json out.json]
+
+Each measurement runs resize_for_pdf on a freshly opened upload in its own
+child process, so the reported peak RSS growth belongs to that one page.
+'full' disables the decode-time reduction with an absurdly large reducing
+gap; 'reduced' uses the pipeline's default.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.corpus import build_corpus
+from benchmarks.report import write_results
+
+
+def _run_once(path: str, variant: str):
+    import pipeline
+    from PIL import Image
+
+    if variant == 'full':
+        pipeline.DECODE_REDUCING_GAP = 1e9
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    img = pipeline.resize_for_pdf(Image.open(path))
+    img.load()
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    return elapsed, (rss_after - rss_before) / 1024, img.info['decode_scale']
+
+
+def measure(path: str, variant: str, repeat: int) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    samples = []
+    for _ in range(repeat):
+        # A fresh interpreter per sample, so ru_maxrss starts from scratch
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            samples.append(pool.submit(_run_once, path, variant).result())
+    return {
+        'ms_median': round(statistics.median(s[0] for s in samples) * 1000, 2),
+        'peak_rss_growth_mb': round(max(s[1] for s in samples), 1),
+        'decode_scale': samples[0][2],
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'snapmerge-bench-corpus'))
+    parser.add_argument('--json', help="also write results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for path in build_corpus(args.corpus_dir):
+        results[os.path.basename(path)] = {
+            variant: measure(path, variant, args.repeat) for variant in ('full', 'reduced')}
+
+    print(f"{'page':<24}{'full ms':>10}{'reduced ms':>12}{'full MB':>10}{'reduced MB':>12}{'scale':>7}")
+    for name, row in results.items():
+        full, reduced = row['full'], row['reduced']
+        print(f"{name:<24}{full['ms_median']:>10.1f}{reduced['ms_median']:>12.1f}"
+              f"{full['peak_rss_growth_mb']:>10.1f}{reduced['peak_rss_growth_mb']:>12.1f}"
+              f"{'1/' + str(reduced['decode_scale']):>7}")
+
+    if args.json:
+        write_results(args.json, 'bench_decode', results, parameters={'repeat': args.repeat})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+Micro-benchmarks of the individual pipeline functions.
+
+    python -m benchmarks.bench_functions [--repeat N] [--functions a,b] [--json out.json]
+
+optimize_image_for_pdf and add_filename_to_image are measured per corpus
+image; create_professional_pdf and compress_pdf on a document made of all
+corpus pages.  Inputs are prepared before each call and not timed.  Every
+case runs in its own child process, so the reported peak RSS growth (over
+the prepared inputs, during the first call) belongs to that call alone.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.corpus import build_corpus
+from benchmarks.report import write_results
+
+FUNCTIONS = ('optimize_image_for_pdf', 'add_filename_to_image', 'create_professional_pdf', 'compress_pdf')
+PER_IMAGE = ('optimize_image_for_pdf', 'add_filename_to_image')
+
+
+def _labeled_pages(paths):
+    import pipeline
+
+    images, file_info = [], []
+    for index, path in enumerate(paths):
+        name = os.path.basename(path)
+        images.append(pipeline.process_image_file(path, name, index + 1))
+        file_info.append({'original_name': name})
+    return images, file_info
+
+
+def _cases(function: str, paths, work_dir: str):
+    """(input name, setup() -> call arguments) pairs for ``function``"""
+    import pipeline
+    from PIL import Image
+
+    if function == 'optimize_image_for_pdf':
+        return [(os.path.basename(path), lambda path=path: (Image.open(path),)) for path in paths]
+    if function == 'add_filename_to_image':
+        def labeled_input(path):
+            img = pipeline.optimize_image_for_pdf(Image.open(path))
+            img.load()
+            return img, os.path.basename(path), 1
+        return [(os.path.basename(path), lambda path=path: labeled_input(path)) for path in paths]
+
+    images, file_info = _labeled_pages(paths)
+    pdf_path = os.path.join(work_dir, 'document.pdf')
+    document = f"{len(images)}_pages"
+    if function == 'create_professional_pdf':
+        return [(document, lambda: (images, pdf_path, file_info))]
+    pipeline.create_professional_pdf(images, pdf_path, file_info)
+    original = os.path.join(work_dir, 'original.pdf')
+    shutil.copyfile(pdf_path, original)
+
+    def fresh_copy():
+        # compress_pdf rewrites the file in place
+        shutil.copyfile(original, pdf_path)
+        return (pdf_path,)
+    return [(document, fresh_copy)]
+
+
+def _run_case(function: str, paths, index: int, repeat: int) -> tuple:
+    import pipeline
+
+    fn = getattr(pipeline, function)
+    with tempfile.TemporaryDirectory() as work_dir:
+        name, setup = _cases(function, paths, work_dir)[index]
+        # The first call also loads fonts and codecs; its peak is the
+        # function's, as ru_maxrss (KiB on Linux) only ever goes up
+        args = setup()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+        del args
+        samples = []
+        for _ in range(repeat):
+            args = setup()
+            start = time.perf_counter()
+            fn(*args)
+            samples.append(time.perf_counter() - start)
+            del args
+    return name, {
+        'ms_median': round(statistics.median(samples) * 1000, 2),
+        'ms_min': round(min(samples) * 1000, 2),
+        'peak_rss_growth_mb': round(rss_growth, 1),
+    }
+
+
+def measure(function: str, paths, repeat: int) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    cases = len(paths) if function in PER_IMAGE else 1
+    results = {}
+    for index in range(cases):
+        # A fresh interpreter per case, so ru_maxrss starts from scratch
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            name, row = pool.submit(_run_case, function, paths, index, repeat).result()
+        results[name] = row
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--functions', default=','.join(FUNCTIONS))
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'snapmerge-bench-corpus'))
+    parser.add_argument('--json', help="also write results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    paths = build_corpus(args.corpus_dir)
+    results = {function: measure(function, paths, args.repeat) for function in args.functions.split(',')}
+
+    print(f"{'function':<26}{'input':<24}{'median ms':>11}{'min ms':>9}{'RSS +MB':>9}")
+    for function, rows in results.items():
+        for name, row in rows.items():
+            print(f"{function:<26}{name:<24}{row['ms_median']:>11.2f}{row['ms_min']:>9.2f}"
+                  f"{row['peak_rss_growth_mb']:>9.1f}")
+
+    if args.json:
+        write_results(args.json, 'bench_functions', results, parameters={'repeat': args.repeat})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
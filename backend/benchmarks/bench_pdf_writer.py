@@ -0,0 +1,108 @@
+"""
+PDF assembly: the old two-pass path vs single-pass compressed writers.
+
+    python -m benchmarks.bench_pdf_writer [--pages 1,10,50,200] [--repeat N] [--json out.json]
+
+Pages are prepared once up front (legacy pipeline, corpus images in turn),
+so only document assembly is measured:
+
+* two_pass: ReportLab canvas without page compression, then compress_pdf
+  re-reads and rewrites the file (what create_professional_pdf used to do)
+* reportlab: ReportLab canvas with pageCompression=1, no re-parse
+* stream: PdfStreamWriter with a classic xref table
+* stream_objstm: PdfStreamWriter with object streams (what /convert uses)
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+from benchmarks.corpus import build_corpus
+from benchmarks.report import write_results
+from pipeline import (
+    compress_pdf,
+    draw_prepared_page,
+    prepare_legacy_page,
+    write_prepared_pdf,
+)
+
+
+def _canvas(pages, pdf_path, page_compression):
+    c = canvas.Canvas(pdf_path, pagesize=A4, pageCompression=page_compression)
+    for i, page in enumerate(pages):
+        if i > 0:
+            c.showPage()
+        draw_prepared_page(c, page)
+    c.save()
+
+
+def _two_pass(pages, pdf_path):
+    _canvas(pages, pdf_path, 0)
+    compress_pdf(pdf_path)
+
+
+def _reportlab(pages, pdf_path):
+    _canvas(pages, pdf_path, 1)
+
+
+def _stream(pages, pdf_path):
+    with open(pdf_path, 'wb') as f:
+        write_prepared_pdf(pages, f, object_streams=False)
+
+
+def _stream_objstm(pages, pdf_path):
+    with open(pdf_path, 'wb') as f:
+        write_prepared_pdf(pages, f)
+
+
+WRITERS = {'two_pass': _two_pass, 'reportlab': _reportlab, 'stream': _stream, 'stream_objstm': _stream_objstm}
+
+
+def measure(fn, pages, pdf_path: str, repeat: int) -> dict:
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(pages, pdf_path)
+        wall_times.append(time.perf_counter() - start)
+    return {
+        'wall_ms_median': round(statistics.median(wall_times) * 1000, 2),
+        'pdf_bytes': os.path.getsize(pdf_path),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pages', default='1,10,50,200', help='comma-separated page counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'snapmerge-bench-corpus'))
+    parser.add_argument('--json', help="also write results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+    page_counts = [int(count) for count in args.pages.split(',')]
+
+    prepared = [prepare_legacy_page(path, os.path.basename(path), 1) for path in build_corpus(args.corpus_dir)]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        pdf_path = os.path.join(out_dir, 'merged.pdf')
+        for count in page_counts:
+            pages = [prepared[i % len(prepared)] for i in range(count)]
+            results[count] = {name: measure(fn, pages, pdf_path, args.repeat) for name, fn in WRITERS.items()}
+
+    print(f"{'pages':>6}" + ''.join(f"{name + ' ms':>18}" for name in WRITERS)
+          + ''.join(f"{name + ' KB':>18}" for name in WRITERS))
+    for count, row in results.items():
+        print(f"{count:>6}" + ''.join(f"{row[name]['wall_ms_median']:>18.1f}" for name in WRITERS)
+              + ''.join(f"{row[name]['pdf_bytes'] / 1024:>18.1f}" for name in WRITERS))
+
+    if args.json:
+        write_results(args.json, 'bench_pdf_writer', results, parameters={'pages': page_counts, 'repeat': args.repeat})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
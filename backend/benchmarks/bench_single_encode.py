@@ -0,0 +1,87 @@
+"""
+CPU time per page: legacy multi-encode pipeline vs the single-encode pipeline.
+
+    python -m benchmarks.bench_single_encode [--repeat N] [--json out.json]
+
+Each page is run through the complete path from upload file to a finished
+one-page PDF.  The legacy path is process_image_file + create_professional_pdf
+followed by the compress_pdf re-parse it used to run before writing
+compressed pages itself, so the baseline stays the original pipeline; the
+single-encode path is prepare_page + write_prepared_pdf.
+Everything runs in this process, so process_time() measures only the
+pipeline's own CPU.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import build_corpus
+from benchmarks.report import write_results
+from pipeline import (
+    compress_pdf,
+    create_professional_pdf,
+    prepare_page,
+    process_image_file,
+    write_prepared_pdf,
+)
+
+
+def _legacy(path: str, pdf_path: str):
+    img = process_image_file(path, os.path.basename(path), 1)
+    create_professional_pdf([img], pdf_path, [])
+    compress_pdf(pdf_path)
+
+
+def _single(path: str, pdf_path: str):
+    page = prepare_page(path, os.path.basename(path), 1)
+    with open(pdf_path, 'wb') as f:
+        write_prepared_pdf([page], f)
+
+
+PATHS = {'legacy': _legacy, 'single': _single}
+
+
+def measure(fn, path: str, pdf_path: str, repeat: int) -> dict:
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn(path, pdf_path)
+        cpu_times.append(time.process_time() - start)
+    return {
+        'cpu_ms_median': round(statistics.median(cpu_times) * 1000, 2),
+        'cpu_ms_min': round(min(cpu_times) * 1000, 2),
+        'pdf_bytes': os.path.getsize(pdf_path),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'snapmerge-bench-corpus'))
+    parser.add_argument('--json', help="also write results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        pdf_path = os.path.join(out_dir, 'page.pdf')
+        for path in build_corpus(args.corpus_dir):
+            name = os.path.basename(path)
+            results[name] = {mode: measure(fn, path, pdf_path, args.repeat) for mode, fn in PATHS.items()}
+
+    print(f"{'page':<24}{'legacy ms':>12}{'single ms':>12}{'speedup':>10}{'legacy KB':>12}{'single KB':>12}")
+    for name, row in results.items():
+        legacy, single = row['legacy'], row['single']
+        speedup = legacy['cpu_ms_median'] / max(single['cpu_ms_median'], 0.01)
+        print(f"{name:<24}{legacy['cpu_ms_median']:>12.1f}{single['cpu_ms_median']:>12.1f}{speedup:>9.1f}x"
+              f"{legacy['pdf_bytes'] / 1024:>12.1f}{single['pdf_bytes'] / 1024:>12.1f}")
+
+    if args.json:
+        write_results(args.json, 'bench_single_encode', results, parameters={'repeat': args.repeat})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
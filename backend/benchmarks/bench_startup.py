@@ -0,0 +1,153 @@
+"""
+Cold start and first-request latency of the production server.
+
+    python -m benchmarks.bench_startup [--pages 4] [--requests 5] [--runs 3] [--json out.json]
+
+Every run launches ``run_server.py --production`` on a free port, with and
+without warm-up, and measures over real HTTP: the time from launch until
+``GET /`` answers (the server only accepts connections once its lifespan,
+warm-up included, is done), the latency of the first /convert and the
+median of the ``--requests`` that follow.  The server's own startup report
+(import and warm-up time, from /metrics) is included.  Caches are disabled
+and admission limits off, so every request does the full work.
+
+Reported per scenario, as medians over the runs: ready, first request and
+warm request milliseconds, and the server-side import and warm-up times.
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.asgi import multipart_body
+from benchmarks.bench_convert import corpus_files
+from benchmarks.report import write_results
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_TIMEOUT = 60.0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _request(port: int, method: str, path: str, body: bytes = b'', headers: dict = None):
+    """(status, body) of one request on a new connection"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def _startup_metrics(port: int) -> dict:
+    _, body = _request(port, 'GET', '/metrics')
+    values = {}
+    for line in body.decode().splitlines():
+        if line.startswith('snapmerge_startup_seconds{'):
+            phase = line.split('"')[1]
+            values[f"server_{phase}_ms"] = round(float(line.rsplit(' ', 1)[1]) * 1000, 1)
+    return values
+
+
+def measure(env: dict, args, warmup: bool, body: bytes, content_type: str) -> dict:
+    port = _free_port()
+    command = [sys.executable, 'run_server.py', '--production', '--host', '127.0.0.1', '--port', str(port)]
+    if not warmup:
+        command.append('--no-warmup')
+    launched = time.perf_counter()
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, env={**os.environ, **env},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with status {server.returncode}")
+            if time.perf_counter() - launched > READY_TIMEOUT:
+                raise RuntimeError("Server did not become ready")
+            try:
+                if _request(port, 'GET', '/')[0] == 200:
+                    break
+            except OSError:
+                time.sleep(0.01)
+        ready = time.perf_counter() - launched
+
+        latencies = []
+        for _ in range(1 + args.requests):
+            started = time.perf_counter()
+            status, _ = _request(port, 'POST', '/convert', body, {'Content-Type': content_type})
+            if status != 200:
+                raise RuntimeError(f"/convert answered {status}")
+            latencies.append(time.perf_counter() - started)
+        row = {
+            'ready_ms': round(ready * 1000, 1),
+            'first_request_ms': round(latencies[0] * 1000, 1),
+            'warm_request_ms_median': round(statistics.median(latencies[1:]) * 1000, 1),
+        }
+        row.update(_startup_metrics(port))
+        return row
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pages', type=int, default=4, help='images per request')
+    parser.add_argument('--requests', type=int, default=5, help='requests after the first one')
+    parser.add_argument('--runs', type=int, default=3, help='server launches per scenario')
+    parser.add_argument('--pipeline', default='single', choices=('single', 'legacy'))
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'snapmerge-bench-corpus'))
+    parser.add_argument('--json', help="also write results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    files = []
+    for name, path, content_type in corpus_files(args.corpus_dir, args.pages):
+        with open(path, 'rb') as f:
+            files.append((name, f.read(), content_type))
+    body, content_type = multipart_body(files, {'pipeline': args.pipeline})
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = {
+            'SNAPMERGE_TEMP_ROOT': os.path.join(work_dir, 'temp'),
+            'SNAPMERGE_RESULT_CACHE_MAX_BYTES': '0',
+            'SNAPMERGE_PAGE_CACHE_MAX_BYTES': '0',
+            'SNAPMERGE_THUMBNAIL_CACHE_MAX_BYTES': '0',
+            'SNAPMERGE_MAX_CONCURRENT_CONVERSIONS': '0',
+            'SNAPMERGE_MAX_CONVERSIONS_PER_CLIENT': '0',
+            'SNAPMERGE_LOG_LEVEL': 'WARNING',
+        }
+        for warmup in (False, True):
+            runs = [measure(env, args, warmup, body, content_type) for _ in range(args.runs)]
+            results['warmup' if warmup else 'cold'] = {
+                key: round(statistics.median(run[key] for run in runs if key in run), 1)
+                for key in runs[0]}
+
+    print(f"{'scenario':<10}{'ready ms':>10}{'1st req ms':>12}{'warm ms':>10}{'import ms':>11}{'warm-up ms':>12}")
+    for name, row in results.items():
+        print(f"{name:<10}{row['ready_ms']:>10.1f}{row['first_request_ms']:>12.1f}"
+              f"{row['warm_request_ms_median']:>10.1f}{row.get('server_import_ms', 0):>11.1f}"
+              f"{row.get('server_warmup_ms', 0):>12.1f}")
+
+    if args.json:
+        write_results(args.json, 'bench_startup', results, parameters={
+            key: value for key, value in vars(args).items() if key not in ('json', 'corpus_dir')})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Compare two benchmark result files, e.g. from two commits.
+
+    python -m benchmarks.compare base.json new.json [--threshold 10]
+
+Every numeric result present in both files is matched by its path
+(``merge_c4.latency_ms_median``).  Times, sizes and memory are better when
+lower, ``*_per_second`` rates when higher; other numbers are only shown
+when they differ.  Exits with status 1 when a metric got worse by more than
+``--threshold`` percent, so it can gate a CI job.
+"""
+import argparse
+import json
+import re
+import sys
+from typing import Dict, Optional
+
+LOWER_IS_BETTER = re.compile(r'(^|_)(ms|bytes|mb|seconds)(_|$)')
+HIGHER_IS_BETTER = re.compile(r'per_second$')
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        report = json.load(f)
+    # Files written before the common envelope hold the results directly
+    return report.get('results', report) if 'benchmark' in report else report
+
+
+def flatten(results: dict, prefix: str = '') -> Dict[str, float]:
+    values = {}
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def direction(path: str) -> Optional[int]:
+    """+1 if higher is better, -1 if lower is better, None for informational values"""
+    name = path.rsplit('.', 1)[-1]
+    if HIGHER_IS_BETTER.search(name):
+        return 1
+    if LOWER_IS_BETTER.search(name):
+        return -1
+    return None
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    """(path, base, new, change in percent, verdict) for every metric present in both"""
+    base_values, new_values = flatten(base), flatten(new)
+    rows = []
+    for path in sorted(base_values.keys() & new_values.keys()):
+        old, current = base_values[path], new_values[path]
+        change = (current - old) / old * 100 if old else 0.0
+        better = direction(path)
+        if better is None:
+            verdict = 'changed' if current != old else ''
+        elif change * better < -threshold:
+            verdict = 'REGRESSION'
+        elif change * better > threshold:
+            verdict = 'improved'
+        else:
+            verdict = ''
+        rows.append((path, old, current, change, verdict))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change that counts')
+    parser.add_argument('--all', action='store_true', help='also list unchanged metrics')
+    args = parser.parse_args(argv)
+
+    rows = compare(load_results(args.base), load_results(args.new), args.threshold)
+    width = max((len(row[0]) for row in rows), default=10)
+    print(f"{'metric':<{width}}{'base':>14}{'new':>14}{'change':>10}")
+    for path, old, current, change, verdict in rows:
+        if verdict or args.all:
+            print(f"{path:<{width}}{old:>14.6g}{current:>14.6g}{change:>+9.1f}%  {verdict}")
+    regressions = sum(1 for row in rows if row[4] == 'REGRESSION')
+    print(f"{len(rows)} metrics compared, {regressions} regressions over {args.threshold:g}%")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
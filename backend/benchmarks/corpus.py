@@ -0,0 +1,69 @@
+"""
+Deterministic synthetic image corpus for benchmarks.
+
+Images are generated from a fixed seed so that numbers are comparable across
+runs and commits without checking binary fixtures into the repository.
+"""
+import io
+import os
+import random
+from typing import Dict, List, Tuple
+
+from PIL import Image, ImageDraw, ImageFilter
+
+# name -> (width, height, format); the mix mirrors real uploads: phone photos,
+# flatbed scans and already-small JPEGs
+CORPUS_SPECS: Dict[str, Tuple[int, int, str]] = {
+    'phone_photo.jpg': (4032, 3024, 'JPEG'),
+    'document_scan.png': (2480, 3508, 'PNG'),
+    'small_photo.jpg': (780, 1040, 'JPEG'),
+}
+
+
+def _photo(width: int, height: int, rng: random.Random) -> Image.Image:
+    """Smooth gradients with sensor-like noise, roughly like a camera photo"""
+    base = Image.new('RGB', (64, 48))
+    base.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                  for _ in range(64 * 48)])
+    img = base.resize((width, height), Image.Resampling.BICUBIC)
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    return Image.blend(img, noise, 0.12)
+
+
+def _scan(width: int, height: int, rng: random.Random) -> Image.Image:
+    """Off-white page with lines of dark 'text' blocks, like a document scan"""
+    img = Image.new('RGB', (width, height), (246, 244, 240))
+    draw = ImageDraw.Draw(img)
+    line_height = max(12, height // 60)
+    for y in range(line_height * 4, height - line_height * 4, line_height * 2):
+        x = width // 10
+        while x < width * 9 // 10:
+            word = rng.randrange(line_height, line_height * 6)
+            draw.rectangle((x, y, min(x + word, width * 9 // 10), y + line_height), fill=(30, 30, 35))
+            x += word + line_height
+    return img.filter(ImageFilter.GaussianBlur(1))
+
+
+def make_image(name: str, width: int, height: int, fmt: str, seed: int = 0) -> bytes:
+    """Encode one synthetic image the way a client would upload it"""
+    rng = random.Random(f"{seed}:{name}")
+    img = _scan(width, height, rng) if fmt == 'PNG' else _photo(width, height, rng)
+    buffer = io.BytesIO()
+    if fmt == 'JPEG':
+        img.save(buffer, format='JPEG', quality=90)
+    else:
+        img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def build_corpus(directory: str, seed: int = 0) -> List[str]:
+    """Write the corpus to ``directory`` (reusing existing files) and return the paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, (width, height, fmt) in CORPUS_SPECS.items():
+        path = os.path.join(directory, f"{seed}_{name}")
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(make_image(name, width, height, fmt, seed))
+        paths.append(path)
+    return paths
@@ -0,0 +1,53 @@
+"""
+Machine-readable benchmark results.
+
+Every benchmark's ``--json`` output has the same envelope, so runs from
+different commits can be diffed with ``python -m benchmarks.compare``:
+
+    {"benchmark": ..., "environment": {commit, python, platform, cpus, ...},
+     "parameters": {...}, "results": {...}}
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import PIL
+import reportlab
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def environment() -> dict:
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pillow': PIL.__version__,
+        'reportlab': reportlab.Version,
+    }
+
+
+def write_results(path: str, benchmark: str, results: dict, parameters: dict = None):
+    report = {
+        'benchmark': benchmark,
+        'environment': environment(),
+        'parameters': parameters or {},
+        'results': results,
+    }
+    if path == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,294 @@
+"""
+Content-addressed on-disk caches.
+
+Users re-submit identical document sets all the time (retries, flaky
+browsers, downloading again after the temp directory was cleaned up).
+DiskCache stores finished artifacts under a key derived from everything that
+determines their bytes, keeps the directory under a byte budget by evicting
+the least recently used entries, and counts hits and misses.
+
+PageCache builds on it to keep individual processed pages, so swapping one
+document in a batch only reprocesses that document, and the size tables of
+the target_bytes search, so asking for another size encodes nothing twice;
+ThumbnailCache keeps the /preview-order thumbnails.
+
+Each entry is two files: ``<key>.data`` with the artifact and ``<key>.json``
+with metadata the caller needs to serve it again.  The data file is written
+first and the metadata last, so an entry only becomes visible once it is
+complete.  Recency survives restarts through the metadata file's mtime.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Iterable, List, Optional, Tuple
+
+import config
+from pipeline import TARGET_LADDER, PageOptions, PreparedPage, page_fields
+
+# Bump when a change to the pipeline alters output bytes, so stale results
+# are not served
+RESULT_CACHE_VERSION = 3
+
+
+@dataclass
+class CacheEntry:
+    path: str  # The cached artifact
+    size: int
+    meta: dict
+
+
+def cache_key(files: Iterable[Tuple[str, str]], params: dict) -> str:
+    """
+    Key for an ordered list of (sha256, filename) inputs and the parameters
+    that shape the output
+    """
+    payload = json.dumps({
+        'version': RESULT_CACHE_VERSION,
+        'files': [list(item) for item in files],
+        'params': params,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(source_path: str, path: str):
+    """Hard-link ``source_path`` to ``path``, copying where links are not possible"""
+    try:
+        os.link(source_path, path)
+    except OSError:
+        shutil.copyfile(source_path, path)
+
+
+class DiskCache:
+    """Byte-budgeted LRU cache of files in one directory"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()  # key -> size, oldest first
+        self._bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + '.data', base + '.json'
+
+    def load(self):
+        """Index entries already on disk, least recently used first"""
+        with self._lock:
+            if self._loaded or not self.enabled:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            found = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.json'):
+                    continue
+                key = entry.name[:-len('.json')]
+                data_path, _ = self._paths(key)
+                try:
+                    found.append((entry.stat().st_mtime, key, os.path.getsize(data_path)))
+                except OSError:
+                    # Metadata without data: an interrupted write or eviction
+                    os.remove(entry.path)
+            for _, key, size in sorted(found):
+                self._entries[key] = size
+                self._bytes += size
+            self._loaded = True
+            self._evict()
+
+    def get(self, key: str, copy_to: Optional[str] = None) -> Optional[CacheEntry]:
+        """
+        The entry under ``key``, or None.  With ``copy_to`` the data is
+        hard-linked (or copied) to that path before the lock is released,
+        and the entry points there, so a later eviction cannot pull the file
+        from under a response that is still being sent.
+        """
+        if not self.enabled:
+            return None
+        self.load()
+        with self._lock:
+            size = self._entries.get(key)
+            data_path, meta_path = self._paths(key)
+            if size is not None:
+                try:
+                    with open(meta_path, encoding='utf-8') as f:
+                        meta = json.load(f)
+                    if copy_to is not None:
+                        _link_or_copy(data_path, copy_to)
+                        data_path = copy_to
+                    os.utime(meta_path)
+                except (OSError, ValueError):
+                    self._drop(key)
+                    size = None
+            if size is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return CacheEntry(path=data_path, size=size, meta=meta)
+
+    def put_file(self, key: str, source_path: str, meta: dict) -> Optional[CacheEntry]:
+        """
+        Store a finished file under ``key``; hard-links when possible so
+        nothing is copied.  Entries larger than the whole budget are skipped.
+        """
+        if not self.enabled:
+            return None
+        self.load()
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            return None
+        data_path, meta_path = self._paths(key)
+        staging = f"{data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        _link_or_copy(source_path, staging)
+        return self._commit(key, staging, size, meta)
+
+    def put_bytes(self, key: str, data: bytes, meta: dict) -> Optional[CacheEntry]:
+        if not self.enabled or len(data) > self.max_bytes:
+            return None
+        self.load()
+        data_path, _ = self._paths(key)
+        staging = f"{data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(staging, 'wb') as f:
+            f.write(data)
+        return self._commit(key, staging, len(data), meta)
+
+    def _commit(self, key: str, staging: str, size: int, meta: dict) -> CacheEntry:
+        data_path, meta_path = self._paths(key)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            os.replace(staging, data_path)
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+            self._entries[key] = size
+            self._bytes += size
+            self._evict()
+        return CacheEntry(path=data_path, size=size, meta=meta)
+
+    def _drop(self, key: str):
+        self._bytes -= self._entries.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class PageCache:
+    """
+    Processed pages keyed by upload content, label text, pipeline and options.
+
+    The page's position is not part of the key (it does not affect the
+    page), so a reordered batch is served from the same entries.
+    """
+
+    def __init__(self, store: DiskCache):
+        self.store = store
+
+    @staticmethod
+    def key(sha256: str, filename: str, pipeline: str, options: PageOptions, frame: int = 0) -> str:
+        params = {'pipeline': pipeline, **asdict(options)}
+        if frame:
+            # Later frames of a multi-page TIFF; the first keeps the single-page key
+            params['frame'] = frame
+        return cache_key([(sha256, filename)], params)
+
+    def get(self, key: str) -> Optional[PreparedPage]:
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(entry.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        fields = dict(entry.meta)
+        image_bytes = fields.pop('image_bytes')
+        return PreparedPage(image_data=data[:image_bytes], label_data=data[image_bytes:], **fields)
+
+    def put(self, key: str, page: PreparedPage):
+        # Image and label bytes go into the data file, everything else into the metadata
+        self.store.put_bytes(key, page.image_data + page.label_data, page_fields(page))
+
+    def put_file(self, key: str, path: str, fields: dict):
+        """Store a page already written out as its bytes file and page_fields (see measure_target_sizes)"""
+        self.store.put_file(key, path, fields)
+
+    @staticmethod
+    def sizes_key(sha256: str, filename: str, options: PageOptions, frame: int = 0) -> str:
+        """Key of a page's encoded sizes at every target_bytes step (see measure_target_sizes)"""
+        params = {'target_ladder': TARGET_LADDER, **asdict(options)}
+        if frame:
+            params['frame'] = frame
+        return cache_key([(sha256, filename)], params)
+
+    def get_sizes(self, key: str) -> Optional[List[int]]:
+        entry = self.store.get(key)
+        return entry.meta.get('sizes') if entry is not None else None
+
+    def put_sizes(self, key: str, sizes: List[int]):
+        # Only the metadata: the encodes themselves are not kept
+        self.store.put_bytes(key, b'', {'sizes': sizes})
+
+
+class ThumbnailCache:
+    """
+    /preview-order thumbnails keyed by upload content and thumbnail size
+    only, so the same bytes under any name or position are served again
+    """
+
+    def __init__(self, store: DiskCache):
+        self.store = store
+
+    @staticmethod
+    def key(sha256: str, size: int) -> str:
+        return cache_key([(sha256, '')], {'thumbnail_size': size})
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(entry.path, 'rb') as f:
+                return {'data': f.read(), **entry.meta}
+        except OSError:
+            return None
+
+    def put(self, key: str, thumbnail: dict):
+        meta = {name: value for name, value in thumbnail.items() if name != 'data'}
+        self.store.put_bytes(key, thumbnail['data'], meta)
+
+
+result_cache = DiskCache(config.RESULT_CACHE_DIR, config.RESULT_CACHE_MAX_BYTES)
+page_cache = PageCache(DiskCache(config.PAGE_CACHE_DIR, config.PAGE_CACHE_MAX_BYTES))
+thumbnail_cache = ThumbnailCache(DiskCache(config.THUMBNAIL_CACHE_DIR, config.THUMBNAIL_CACHE_MAX_BYTES))
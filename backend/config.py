@@ -0,0 +1,160 @@
+"""
+Runtime configuration for the SnapMerge backend.
+
+Every setting can be overridden with an environment variable so the same code
+runs on a laptop and on the production nodes without edits.
+"""
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_str(name: str, default: str) -> str:
+    value = os.environ.get(name)
+    return value if value not in (None, "") else default
+
+
+# Execution engine for the CPU-bound conversion stages
+EXECUTOR_KIND = _env_str("SNAPMERGE_EXECUTOR", "process")  # 'process' or 'thread'
+POOL_SIZE = _env_int("SNAPMERGE_POOL_SIZE", os.cpu_count() or 1)
+TASK_TIMEOUT = _env_float("SNAPMERGE_TASK_TIMEOUT", 120.0)  # seconds per task
+
+# Upper bound on pages of a single request processed at the same time, so one
+# large merge cannot occupy every worker
+MAX_IN_FLIGHT_PAGES = max(1, _env_int("SNAPMERGE_MAX_IN_FLIGHT_PAGES", POOL_SIZE))
+
+# Warm up every web process before it accepts requests: the engine's
+# workers are started and run a tiny page through each pipeline (imports,
+# fonts, codecs), so the first real request does not pay for that
+# (0 disables)
+WARMUP = _env_int("SNAPMERGE_WARMUP", 1)
+
+# Production launcher (run_server.py --production): listen address, web
+# worker processes (only 1 is supported, see run_server.py), accept
+# backlog, connections served at once before new ones get 503 (0 =
+# unlimited), idle keep-alive and the grace period for in-flight requests
+# on shutdown, in seconds
+SERVER_HOST = _env_str("SNAPMERGE_HOST", "0.0.0.0")
+SERVER_PORT = _env_int("SNAPMERGE_PORT", 8000)
+SERVER_WORKERS = max(1, _env_int("SNAPMERGE_WORKERS", 1))
+SERVER_BACKLOG = _env_int("SNAPMERGE_BACKLOG", 2048)
+SERVER_LIMIT_CONCURRENCY = _env_int("SNAPMERGE_LIMIT_CONCURRENCY", 0)
+SERVER_KEEP_ALIVE = _env_int("SNAPMERGE_KEEP_ALIVE", 5)
+SERVER_GRACEFUL_TIMEOUT = _env_int("SNAPMERGE_GRACEFUL_TIMEOUT", 30)
+
+# Default image pipeline: 'legacy' (multi-pass, matches historical output) or
+# 'single' (each page encoded once and embedded directly)
+PIPELINE_MODE = _env_str("SNAPMERGE_PIPELINE", "legacy")
+
+# Default filename label rendering: 'raster' (drawn into the page image,
+# matches historical output) or 'vector' (real PDF text under the image)
+LABEL_MODE = _env_str("SNAPMERGE_LABEL_MODE", "raster")
+
+# Default page color handling in the single-encode pipeline: 'auto' encodes
+# pages that are effectively grayscale as gray JPEG and black-and-white
+# document scans as 1-bit images; 'color' always encodes RGB JPEG
+COLOR_MODE = _env_str("SNAPMERGE_COLOR_MODE", "auto")
+
+# Default compression of the per-page PDFs in split-mode ZIPs: 'stored' (the
+# JPEG-based PDFs barely deflate, so this saves CPU for a few percent of
+# size) or 'deflated'
+ZIP_COMPRESSION = _env_str("SNAPMERGE_ZIP_COMPRESSION", "stored")
+
+# Per-request working directories and background job data live under here
+TEMP_ROOT = _env_str("SNAPMERGE_TEMP_ROOT", "temp")
+
+# The temp janitor removes request directories TEMP_TTL seconds after their
+# last change, keeps the whole temp root (jobs included) under TEMP_MAX_BYTES
+# by removing the oldest directories first (0 = no quota), and sweeps every
+# JANITOR_INTERVAL seconds
+TEMP_TTL = _env_float("SNAPMERGE_TEMP_TTL", 600.0)
+TEMP_MAX_BYTES = _env_int("SNAPMERGE_TEMP_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+JANITOR_INTERVAL = _env_float("SNAPMERGE_JANITOR_INTERVAL", 60.0)
+
+# Background jobs (POST /jobs): concurrent jobs, jobs allowed to wait in the
+# queue before new submissions get 503, and how long finished jobs and their
+# results are kept (seconds, 0 = forever)
+JOB_WORKERS = max(1, _env_int("SNAPMERGE_JOB_WORKERS", 2))
+MAX_QUEUED_JOBS = _env_int("SNAPMERGE_MAX_QUEUED_JOBS", 100)
+JOB_RETENTION = _env_float("SNAPMERGE_JOB_RETENTION", 24 * 3600.0)
+JOB_RETRY_AFTER = _env_int("SNAPMERGE_JOB_RETRY_AFTER", 30)  # Retry-After for a full queue
+
+# Upload sessions (POST /sessions): files are uploaded one per request and
+# processed as they land; sessions open at once before new ones get 503, and
+# seconds after their last upload that abandoned sessions are removed
+MAX_OPEN_SESSIONS = _env_int("SNAPMERGE_MAX_OPEN_SESSIONS", 1000)
+SESSION_TTL = _env_float("SNAPMERGE_SESSION_TTL", 900.0)
+
+# Batch conversions (POST /batch): output documents one manifest may ask for
+MAX_BATCH_DOCUMENTS = _env_int("SNAPMERGE_MAX_BATCH_DOCUMENTS", 500)
+
+# Upload ingestion: files up to UPLOAD_SPOOL_BYTES stay in memory, larger ones
+# are spilled to the job directory; requests over the limits are rejected
+# with 413 as soon as the limit is crossed
+UPLOAD_SPOOL_BYTES = _env_int("SNAPMERGE_UPLOAD_SPOOL_BYTES", 1024 * 1024)
+# ...but no more than UPLOAD_MEMORY_BYTES of one request is held in memory,
+# so a request with many small files does not grow with the file count
+UPLOAD_MEMORY_BYTES = _env_int("SNAPMERGE_UPLOAD_MEMORY_BYTES", 32 * 1024 * 1024)
+MAX_UPLOAD_FILE_BYTES = _env_int("SNAPMERGE_MAX_UPLOAD_FILE_BYTES", 50 * 1024 * 1024)
+MAX_UPLOAD_REQUEST_BYTES = _env_int("SNAPMERGE_MAX_UPLOAD_REQUEST_BYTES", 200 * 1024 * 1024)
+MAX_UPLOAD_FILES = _env_int("SNAPMERGE_MAX_UPLOAD_FILES", 500)
+MAX_FIELD_BYTES = _env_int("SNAPMERGE_MAX_FIELD_BYTES", 1024 * 1024)
+
+# Admission control for POST /convert and POST /jobs: requests in progress
+# at once, overall and per client, before new ones are turned away with 503
+# or 429 (0 = unlimited).  CLIENT_IP_HEADER names a header (e.g.
+# X-Forwarded-For) to identify clients by when behind a trusted proxy.
+MAX_CONCURRENT_CONVERSIONS = _env_int("SNAPMERGE_MAX_CONCURRENT_CONVERSIONS", 16)
+MAX_CONVERSIONS_PER_CLIENT = _env_int("SNAPMERGE_MAX_CONVERSIONS_PER_CLIENT", 4)
+ADMISSION_RETRY_AFTER = _env_int("SNAPMERGE_ADMISSION_RETRY_AFTER", 5)  # seconds
+CLIENT_IP_HEADER = _env_str("SNAPMERGE_CLIENT_IP_HEADER", "")
+
+# Decompression-bomb limits, checked from image headers before decoding:
+# pixels of a single image (larger ones are skipped) and of all images of
+# one request together (larger requests get 413); 0 = unlimited
+MAX_IMAGE_PIXELS = _env_int("SNAPMERGE_MAX_IMAGE_PIXELS", 100_000_000)
+MAX_REQUEST_PIXELS = _env_int("SNAPMERGE_MAX_REQUEST_PIXELS", 2_500_000_000)
+
+# Finished PDFs/ZIPs are cached on disk by a hash of the ordered input bytes,
+# filenames and parameters; least recently used results are evicted once the
+# cache exceeds RESULT_CACHE_MAX_BYTES (0 disables the cache)
+RESULT_CACHE_DIR = _env_str("SNAPMERGE_RESULT_CACHE_DIR", "cache/results")
+RESULT_CACHE_MAX_BYTES = _env_int("SNAPMERGE_RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+
+# Individual processed pages are cached by upload hash, filename, pipeline and
+# page options, so resubmitting a batch with one file swapped only processes
+# that file (0 disables the cache)
+PAGE_CACHE_DIR = _env_str("SNAPMERGE_PAGE_CACHE_DIR", "cache/pages")
+PAGE_CACHE_MAX_BYTES = _env_int("SNAPMERGE_PAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+# /preview-order thumbnails: default longest side in pixels (requests may ask
+# for up to THUMBNAIL_MAX_SIZE) and JPEG quality
+THUMBNAIL_SIZE = _env_int("SNAPMERGE_THUMBNAIL_SIZE", 256)
+THUMBNAIL_MAX_SIZE = 1024
+THUMBNAIL_QUALITY = 70
+
+# Thumbnails are cached by upload content and size alone, so reordering or
+# renaming previewed files never decodes them again (0 disables the cache)
+THUMBNAIL_CACHE_DIR = _env_str("SNAPMERGE_THUMBNAIL_CACHE_DIR", "cache/thumbnails")
+THUMBNAIL_CACHE_MAX_BYTES = _env_int("SNAPMERGE_THUMBNAIL_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+# After answering /preview-order, process the previewed files into the page
+# cache in the background, so the /convert that usually follows finds its
+# pages ready (0 disables)
+PREVIEW_WARM_PAGE_CACHE = _env_int("SNAPMERGE_PREVIEW_WARM_PAGE_CACHE", 1)
+# Warm-ups run after the admission slot of their request is released, so at
+# most this many run at once; further previews skip warming the cache
+MAX_PREVIEW_WARMUPS = max(0, _env_int("SNAPMERGE_MAX_PREVIEW_WARMUPS", 2))
+
+# Logging: level of the snapmerge loggers (per-page details are DEBUG) and
+# format, 'text' or 'json' (one object per line)
+LOG_LEVEL = _env_str("SNAPMERGE_LOG_LEVEL", "INFO")
+LOG_FORMAT = _env_str("SNAPMERGE_LOG_FORMAT", "text")
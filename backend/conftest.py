@@ -0,0 +1,15 @@
+import pytest
+
+import conversion
+from cache import DiskCache, PageCache
+from executor import ExecutionEngine
+
+
+@pytest.fixture
+def thread_engine(monkeypatch, tmp_path):
+    """Conversions run on a two-thread engine, with the page cache off"""
+    engine = ExecutionEngine(kind='thread', max_workers=2)
+    monkeypatch.setattr(conversion, "engine", engine)
+    monkeypatch.setattr(conversion, "page_cache", PageCache(DiskCache(str(tmp_path / "pages"), 0)))
+    yield engine
+    engine.shutdown()
@@ -0,0 +1,661 @@
+"""
+Conversion orchestration shared by the synchronous /convert endpoint and
+background jobs.
+
+Uploads are turned into pages on the execution engine (through the page
+cache), in upload order and with bounded parallelism, and the pages are
+written into the merged PDF or the split ZIP as they arrive.
+ConversionProgress keeps the per-page bookkeeping that ends up in response
+headers, status endpoints and job reports.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+from contextlib import aclosing
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import config
+from cache import page_cache
+from executor import engine, ordered_window
+from metrics import PAGES, SKIPPED_FILES, call_collecting_stages, observe_stages
+from pipeline import (
+    COLOR_MODES,
+    LABEL_MODES,
+    PAGE_CLASSES,
+    PIPELINES,
+    TARGET_DOCUMENT_OVERHEAD,
+    TARGET_LADDER,
+    TARGET_PAGE_OVERHEAD,
+    ZIP_COMPRESSIONS,
+    MergedDocument,
+    PageOptions,
+    SplitArchive,
+    copy_pdf_pages,
+    fit_to_budget,
+    header_pixels,
+    inspect_upload,
+    measure_target_sizes,
+    render_single_page_pdf,
+    target_step_options,
+)
+from uploads import UploadError
+
+logger = logging.getLogger('snapmerge.conversion')
+
+
+def generate_pdf_filename(file_info: list, image_count: int) -> str:
+    """Generate PDF filename using the same logic as the image labels"""
+
+    # If only one image, use the clean filename (same as image label)
+    if image_count == 1 and file_info:
+        original_name = file_info[0]['original_name']
+        # Use the same logic as add_filename_to_image function
+        clean_filename = os.path.splitext(original_name)[0]  # Remove extension
+        return f"{clean_filename}.pdf"
+
+    # For multiple images, create a descriptive name using the first image's clean filename
+    if file_info:
+        first_file = file_info[0]['original_name']
+        clean_filename = os.path.splitext(first_file)[0]  # Remove extension
+
+        # Add suffix for multiple documents
+        if image_count > 1:
+            return f"{clean_filename}_and_{image_count-1}_more_documents.pdf"
+
+    # Fallback
+    return f"merged_documents_{image_count}_pages.pdf"
+
+
+def format_decode_scales(file_info: list) -> str:
+    """Per-page decode reduction factors, in page order, for the X-Decode-Scales header"""
+    return ",".join(str(info.get('decode_scale', 1)) for info in file_info)
+
+
+def format_page_classes(file_info: list) -> str:
+    """How each page was encoded, in page order, for the X-Page-Classes header"""
+    return ",".join(info['page_class'] for info in file_info)
+
+
+def format_page_settings(file_info: list) -> str:
+    """target_bytes: JPEG quality and page box scale of each page, e.g. q80@1,q40@0.5,pdf"""
+    return ",".join(f"q{info['quality']}@{info['scale']:g}" if 'quality' in info else info['page_class']
+                    for info in file_info)
+
+
+def cleanup_temp_directory(temp_dir: str):
+    """Clean up temporary directory after processing"""
+    try:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+    except Exception as e:
+        logger.warning("Could not clean up temp directory %s: %s", temp_dir, e)
+
+
+def resolve_max_in_flight(requested: int) -> int:
+    """Clamp a request's parallelism to the server-wide per-request limit"""
+    if requested <= 0:
+        return config.MAX_IN_FLIGHT_PAGES
+    return min(requested, config.MAX_IN_FLIGHT_PAGES)
+
+
+def content_disposition(filename: str) -> str:
+    """Attachment header with an ASCII fallback and the UTF-8 filename"""
+    encoded_filename = urllib.parse.quote(filename)
+    return f'attachment; filename="{filename}"; filename*=UTF-8\'\'{encoded_filename}'
+
+
+class ConversionError(Exception):
+    """The conversion cannot produce a document; carries the HTTP status and JSON body"""
+
+    def __init__(self, status_code: int, content: dict):
+        super().__init__(content["error"])
+        self.status_code = status_code
+        self.content = content
+
+
+@dataclass
+class TargetPlan:
+    """The TARGET_LADDER step the target_bytes search chose for every image page"""
+    target_bytes: int
+    steps: Dict[int, List[int]] = field(default_factory=dict)  # Upload index -> step of each of its pages
+    estimated_bytes: List[int] = field(default_factory=list)  # Per document
+
+    def frame_options(self, upload, options: PageOptions) -> Optional[List[PageOptions]]:
+        """Options for each page of ``upload``, None for uploads without image pages"""
+        steps = self.steps.get(upload.index)
+        if not steps:
+            return None
+        return [target_step_options(options, step) for step in steps]
+
+
+class ConversionProgress:
+    """Per-request bookkeeping of processed and skipped files, in page order"""
+
+    def __init__(self, uploads: list):
+        self.total_files = len(uploads)
+        self.file_info = []  # One entry per output page
+        self.document_count = 0  # Uploads that produced pages
+        self.skipped_files = []
+        self.state = "processing"
+        # Per-upload progress: pending -> processing -> done/skipped, with timings
+        self.pages = [{"index": upload.index, "filename": upload.filename, "state": "pending"}
+                      for upload in uploads]
+        self._started = {}
+        # target_bytes: the chosen page settings, and the size of every finished document
+        self.target: Optional[TargetPlan] = None
+        self.document_bytes = []
+
+    @property
+    def processed_count(self) -> int:
+        return len(self.file_info)
+
+    def page_started(self, upload):
+        self.pages[upload.index]["state"] = "processing"
+        self._started[upload.index] = time.monotonic()
+
+    def page_finished(self, upload, cached: bool = False):
+        """The page left the worker pool (or the page cache); record how long it took"""
+        started = self._started.pop(upload.index, None)
+        if started is not None:
+            self.pages[upload.index]["seconds"] = round(time.monotonic() - started, 3)
+        self.pages[upload.index]["cached"] = cached
+
+    def record(self, upload, result):
+        """Account for one page result; returns the page, or None if the file was skipped"""
+        filename = upload.filename
+        if isinstance(result, Exception):
+            # Log the error but still continue with other files
+            reason = f"Could not process as image: {str(result)}"
+            logger.info("❌ %s: %s", filename, reason)
+            SKIPPED_FILES.inc()
+            self.skipped_files.append({
+                "filename": filename,
+                "reason": reason
+            })
+            self.pages[upload.index]["state"] = "skipped"
+            # Remove the invalid file
+            upload.discard()
+            return None
+
+        # Accept any image dimensions - no validation.  A multi-page upload
+        # gets one entry per page, all labeled with the upload's name
+        pages = result if isinstance(result, list) else [result]
+        steps = self.target.steps.get(upload.index, []) if self.target is not None else []
+        for number, page in enumerate(pages, 1):
+            info = {
+                "original_name": filename,
+                "ordered_name": upload.ordered_name,
+                "index": self.processed_count,
+                "sha256": upload.sha256,
+                "size": (page.width, page.height),
+                "mode": page.mode,
+                "encoding": page.encoding,
+                # color/gray/bilevel from the encoded image mode; 'pdf' for copied PDF pages
+                "page_class": PAGE_CLASSES.get(page.mode, page.encoding),
+                "decode_scale": page.decode_scale,
+            }
+            if isinstance(result, list):
+                info["source_page"] = number
+            if number <= len(steps):
+                info["scale"], info["quality"] = TARGET_LADDER[steps[number - 1]]
+            self.file_info.append(info)
+        self.document_count += 1
+        self.pages[upload.index]["state"] = "done"
+        self.pages[upload.index]["page_count"] = len(pages)
+        logger.debug("✅ Successfully processed %s as image #%d", filename, self.processed_count)
+        return result
+
+    @property
+    def target_met(self) -> bool:
+        """Whether every document fits target_bytes (as estimated, until the documents are written)"""
+        sizes = self.document_bytes or self.target.estimated_bytes
+        return all(size <= self.target.target_bytes for size in sizes)
+
+    def headers(self) -> dict:
+        headers = {
+            "X-Processed-Images": str(self.processed_count),
+            "X-Total-Files": str(self.total_files),
+            "X-Skipped-Files": str(len(self.skipped_files)),
+            "X-Decode-Scales": format_decode_scales(self.file_info),
+            "X-Page-Classes": format_page_classes(self.file_info),
+        }
+        if self.target is not None:
+            headers.update({
+                "X-Target-Bytes": str(self.target.target_bytes),
+                "X-Target-Met": str(self.target_met).lower(),
+                "X-Document-Bytes": ",".join(str(size) for size in self.document_bytes),
+                "X-Page-Settings": format_page_settings(self.file_info),
+            })
+        return headers
+
+    def status(self) -> dict:
+        status = {
+            "state": self.state,
+            "processed_images": self.processed_count,
+            "total_files": self.total_files,
+            "skipped_files": self.skipped_files,
+            "decode_scales": format_decode_scales(self.file_info),
+            "page_classes": format_page_classes(self.file_info),
+            "pages": self.pages,
+        }
+        if self.target is not None:
+            status["target"] = {
+                "target_bytes": self.target.target_bytes,
+                "met": self.target_met,
+                "estimated_bytes": self.target.estimated_bytes,
+                "document_bytes": self.document_bytes,
+                "page_settings": format_page_settings(self.file_info),
+            }
+        return status
+
+    def no_pages_error(self) -> ConversionError:
+        error_msg = "No valid image files found."
+        if self.skipped_files:
+            error_msg += f" Skipped {len(self.skipped_files)} files: "
+            error_msg += ", ".join(
+                [f"{sf['filename']} ({sf['reason']})" for sf in self.skipped_files[:3]])
+            if len(self.skipped_files) > 3:
+                error_msg += f" and {len(self.skipped_files) - 3} more..."
+        return ConversionError(400, {"error": error_msg, "skipped_files": self.skipped_files})
+
+
+def output_filename(mode: str) -> str:
+    """Name of the finished document inside the job directory"""
+    return "split_documents.zip" if mode == 'split' else "snapmerge_ordered.pdf"
+
+
+def download_name(mode: str, progress: ConversionProgress, document_count: int) -> str:
+    """Filename offered to the client for the finished document"""
+    if mode == 'split':
+        return "split_documents.zip"
+    return generate_pdf_filename(progress.file_info, document_count)
+
+
+def document_headers(mode: str, progress: ConversionProgress) -> dict:
+    """Response headers for a finished document"""
+    return {
+        "Content-Disposition": content_disposition(
+            download_name(mode, progress, progress.document_count)),
+        "Cache-Control": "no-cache",
+        **progress.headers()
+    }
+
+
+def page_options(params: dict) -> PageOptions:
+    """Per-page processing options of a validated /convert form"""
+    # Jobs queued before color_mode existed are restored without it
+    return PageOptions(label_mode=params["label_mode"], color_mode=params.get("color_mode", config.COLOR_MODE))
+
+
+def output_cache_params(params: dict, options: PageOptions) -> dict:
+    """The parameters that determine the output bytes, for the result cache key"""
+    output_params = {"mode": params["mode"], "pipeline": params["pipeline"], **asdict(options)}
+    if params.get("target_bytes"):
+        output_params["target_bytes"] = params["target_bytes"]
+    if params["mode"] == 'split':
+        output_params["zip_compression"] = params["zip_compression"]
+    return output_params
+
+
+async def check_pixel_budget(uploads: list, budget: int = config.MAX_REQUEST_PIXELS):
+    """
+    Reject a request whose images would decode to more than ``budget``
+    pixels in total, judging from the image headers alone (UploadError 413)
+    """
+    if budget <= 0:
+        return
+    pixels = await asyncio.to_thread(lambda: sum(header_pixels(upload.source) for upload in uploads))
+    if pixels > budget:
+        raise UploadError(
+            f"Images in this request total {pixels} pixels, over the {budget} pixel limit", status_code=413)
+
+
+def open_output_document(mode: str, out, zip_compression: str):
+    """The merged PDF or, in split mode, the ZIP of per-page PDFs, written to `out`"""
+    if mode == 'split':
+        return SplitArchive(out, zip_compression)
+    return MergedDocument(out)
+
+
+def split_renderer(mode: str):
+    """Split mode renders each page's own PDF as soon as the page is ready"""
+    return render_single_page_pdf if mode == 'split' else None
+
+
+async def process_upload(upload, pipeline: str, options: PageOptions, limiter: asyncio.Semaphore,
+                         progress: Optional[ConversionProgress] = None, render=None,
+                         frame_options: Optional[List[PageOptions]] = None):
+    """
+    Process one upload through the page cache or the worker pool: returns
+    (page, rendered), see process_uploads.  A multi-page upload gives the
+    list of its pages: every frame of a multi-page TIFF, or every page of a
+    PDF, which is copied into the output without being rendered.
+    `frame_options` overrides `options` page by page.
+
+    Every page task (and `render`) holds `limiter` while it runs; the
+    uploads and frames of one request share it, so the request never has
+    more page tasks running than the limiter allows.
+    """
+    page_worker = PIPELINES[pipeline]
+
+    def options_for(frame: int) -> PageOptions:
+        return frame_options[frame] if frame_options and frame < len(frame_options) else options
+
+    def cache_key_for(frame: int) -> str:
+        return page_cache.key(upload.sha256, upload.filename, pipeline, options_for(frame), frame)
+
+    async def prepare_frame(frame: int):
+        """One image page (or TIFF frame) from the page cache or the pool: (page, cached)"""
+        async with limiter:
+            page = await asyncio.to_thread(page_cache.get, cache_key_for(frame))
+            if page is not None:
+                logger.debug("♻️  Reusing cached page for %s", upload.filename)
+                return page, True
+            return await engine.run(page_worker, upload.source, upload.filename, upload.index + 1,
+                                    options_for(frame), frame), False
+
+    if progress is not None:
+        progress.page_started(upload)
+    prepared = []
+    try:
+        kind, frames = await asyncio.to_thread(inspect_upload, upload.source)
+        if kind == 'pdf':
+            # Parsed and copied out of the upload on the pool; writing the pages only replays them
+            async with limiter:
+                pages, timings = await engine.run(call_collecting_stages, copy_pdf_pages,
+                                                  upload.source, upload.filename)
+            observe_stages(timings)
+            PAGES.inc(len(pages), source='pdf')
+        else:
+            prepared = await gather_frames(prepare_frame(frame) for frame in range(frames))
+            pages = [page for page, _ in prepared]
+    finally:
+        if progress is not None:
+            progress.page_finished(upload, bool(prepared) and all(cached for _, cached in prepared))
+    for frame, (page, cached) in enumerate(prepared):
+        PAGES.inc(source='cache' if cached else 'pipeline')
+        if not cached:
+            observe_stages(page.timings)
+            try:
+                await asyncio.to_thread(page_cache.put, cache_key_for(frame), page)
+            except Exception as e:
+                logger.warning("Could not cache page %s: %s", upload.filename, e)
+    page = pages if len(pages) > 1 or kind == 'pdf' else pages[0]
+    if render is None:
+        return page, None
+    async with limiter:
+        return page, await render_document(render, page)
+
+
+async def render_document(render, page):
+    """``render(page)`` (split mode's PDF of one upload) on the worker pool"""
+    document, timings = await engine.run(call_collecting_stages, render, page)
+    observe_stages(timings)
+    return document
+
+
+async def gather_frames(frame_tasks) -> list:
+    """
+    Results of the frames of one upload, in frame order; the first failure
+    is raised and the other frames are cancelled.  The frames bound their
+    own parallelism through the request's limiter.
+    """
+    results = []
+    frame_tasks = list(frame_tasks)
+    async with aclosing(ordered_window(frame_tasks, len(frame_tasks))) as frames:
+        async for result in frames:
+            if isinstance(result, Exception):
+                raise result
+            results.append(result)
+    return results
+
+
+async def process_uploads(uploads: list, pipeline: str, options: PageOptions, in_flight: int,
+                          progress: ConversionProgress, render=None, plan: Optional[TargetPlan] = None):
+    """
+    Yield (upload, page or exception, rendered) in upload order.
+
+    Pages are decoded/optimized/labeled concurrently on the worker pool, at
+    most `in_flight` of them at a time (the frames of multi-page uploads
+    included), and only `in_flight` uploads are ever held ahead of the
+    consumer.  Pages seen before (same bytes, label and options) come from
+    the page cache without touching the pool.  `render`, if given, is
+    applied to every page under the same limit, so per-page output is
+    produced in parallel too; `rendered` is its result (None without it).
+    Start and finish of every page are reported to `progress` for per-page
+    timings.
+
+    A multi-page upload yields the list of its pages (see process_upload).
+    With a target_bytes `plan`, image pages get the settings it chose.
+    """
+    limiter = asyncio.Semaphore(max(1, in_flight))
+    page_tasks = (process_upload(upload, pipeline, options, limiter, progress, render,
+                                 plan.frame_options(upload, options) if plan is not None else None)
+                  for upload in uploads)
+    async with aclosing(ordered_window(page_tasks, in_flight)) as results:
+        upload_iter = iter(uploads)
+        async for result in results:
+            upload = next(upload_iter)
+            # The processed page is all we need from here on
+            upload.data = None
+            logger.debug("🔍 Processed file %d/%d: %s", upload.index + 1, len(uploads), upload.filename)
+            if isinstance(result, Exception):
+                yield upload, result, None
+            else:
+                yield upload, *result
+
+
+async def plan_target(uploads: list, params: dict, options: PageOptions, in_flight: int) -> TargetPlan:
+    """
+    Choose per-page settings so that every document (the merged PDF, or
+    each PDF of the split ZIP) stays within ``params["target_bytes"]``.
+
+    Every image page is encoded once at each TARGET_LADDER step on the
+    worker pool, `in_flight` pages at a time across all uploads and TIFF
+    frames, and only the sizes are kept (size
+    tables of pages seen before come from the page cache).  The search
+    over the tables (fit_to_budget) then costs no encodes at all.  Pages of
+    uploaded PDFs are copied as they are and count with their file size.
+
+    The budget is shared by all pages, so every page needs its whole table.
+    The encodes are spooled to disk meanwhile and the one chosen for each
+    page goes into the page cache, where the conversion finds it instead of
+    encoding the page again.
+    """
+    target = params["target_bytes"]
+    limiter = asyncio.Semaphore(max(1, in_flight))
+    spool_root = None
+    if page_cache.store.enabled:
+        os.makedirs(config.TEMP_ROOT, exist_ok=True)
+        spool_root = tempfile.mkdtemp(prefix='target-', dir=config.TEMP_ROOT)
+    spooled = {}  # (upload index, frame) -> (spool directory, page_fields of every step)
+
+    async def measure_frame(upload, frame: int) -> List[int]:
+        key = page_cache.sizes_key(upload.sha256, upload.filename, options, frame)
+        spool = os.path.join(spool_root, f"{upload.index}-{frame}") if spool_root is not None else None
+        async with limiter:
+            sizes = await asyncio.to_thread(page_cache.get_sizes, key)
+            if sizes is not None:
+                return sizes
+            measured = await engine.run(measure_target_sizes, upload.source, upload.filename, upload.index + 1,
+                                        options, frame, spool)
+        observe_stages(measured['timings'])
+        if spool is not None:
+            spooled[upload.index, frame] = spool, measured['pages']
+        try:
+            await asyncio.to_thread(page_cache.put_sizes, key, measured['sizes'])
+        except Exception as e:
+            logger.warning("Could not cache page sizes of %s: %s", upload.filename, e)
+        return measured['sizes']
+
+    def keep_chosen_pages(plan: TargetPlan):
+        """Put the spooled encode of every page's chosen step into the page cache"""
+        for upload in uploads:
+            for frame, step in enumerate(plan.steps.get(upload.index, [])):
+                if (upload.index, frame) not in spooled:
+                    continue
+                spool, pages = spooled[upload.index, frame]
+                key = page_cache.key(upload.sha256, upload.filename, params["pipeline"],
+                                     target_step_options(options, step), frame)
+                try:
+                    page_cache.put_file(key, os.path.join(spool, str(step)), pages[step])
+                except Exception as e:
+                    logger.warning("Could not cache page %s: %s", upload.filename, e)
+
+    async def measure(upload):
+        """(bytes copied as they are, size table of each image page) of one upload"""
+        kind, frames = await asyncio.to_thread(inspect_upload, upload.source)
+        if kind == 'pdf':
+            return upload.size, []
+        return 0, await gather_frames(measure_frame(upload, frame) for frame in range(frames))
+
+    measured = []
+    try:
+        async with aclosing(ordered_window((measure(upload) for upload in uploads), in_flight)) as results:
+            async for result in results:
+                # Unreadable uploads are skipped by the conversion itself
+                measured.append(None if isinstance(result, Exception) else result)
+
+        plan = TargetPlan(target)
+        indices = [index for index, result in enumerate(measured) if result is not None]
+        groups = [[index] for index in indices] if params["mode"] == 'split' else [indices]
+        for group in groups:
+            tables = [table for index in group for table in measured[index][1]]
+            overhead = (TARGET_DOCUMENT_OVERHEAD + TARGET_PAGE_OVERHEAD * len(tables)
+                        + sum(measured[index][0] for index in group))
+            steps = fit_to_budget(tables, target - overhead)
+            plan.estimated_bytes.append(overhead + sum(table[step] for table, step in zip(tables, steps)))
+            for index in group:
+                count = len(measured[index][1])
+                plan.steps[uploads[index].index], steps = steps[:count], steps[count:]
+        if spooled:
+            await asyncio.to_thread(keep_chosen_pages, plan)
+    finally:
+        if spool_root is not None:
+            await asyncio.to_thread(shutil.rmtree, spool_root, ignore_errors=True)
+    logger.info("🎯 Fitting %d files into %d bytes per document: estimated %s",
+                len(uploads), target, ", ".join(str(size) for size in plan.estimated_bytes))
+    return plan
+
+
+# /convert parses its own multipart body (see uploads.py), so the form is
+# described to OpenAPI by hand
+CONVERT_FORM_SCHEMA = {
+    "type": "object",
+    "required": ["files"],
+    "properties": {
+        "files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+        "mode": {"type": "string", "enum": ["merge", "split"], "default": "merge"},
+        "max_in_flight": {"type": "integer", "default": 0,
+                          "description": "Pages processed in parallel; 0 = server default"},
+        "pipeline": {"type": "string", "enum": list(PIPELINES), "default": config.PIPELINE_MODE},
+        "label_mode": {"type": "string", "enum": list(LABEL_MODES), "default": config.LABEL_MODE},
+        "color_mode": {"type": "string", "enum": list(COLOR_MODES), "default": config.COLOR_MODE,
+                       "description": "Single pipeline: 'auto' encodes gray and black-and-white pages "
+                                      "as gray or 1-bit images"},
+        "stream": {"type": "boolean", "default": False,
+                   "description": "Send the PDF/ZIP while pages are still being processed"},
+        "zip_compression": {"type": "string", "enum": list(ZIP_COMPRESSIONS),
+                            "default": config.ZIP_COMPRESSION,
+                            "description": "Split mode: compression of the PDFs in the ZIP"},
+        "target_bytes": {"type": "integer", "default": 0,
+                         "description": "Largest size of the PDF (each PDF in split mode); picks the JPEG "
+                                        "quality and resolution of every page, uses the single pipeline. "
+                                        "0 = off"},
+    },
+}
+
+
+def form_flag(fields: dict, name: str, default: bool = False) -> bool:
+    """A boolean form field: 1/true/yes/on"""
+    if name not in fields:
+        return default
+    return fields[name].lower() in ("1", "true", "yes", "on")
+
+
+def parse_convert_fields(fields: dict) -> dict:
+    """Validate the non-file /convert form fields, raising UploadError on bad values"""
+    params = {
+        "mode": fields.get("mode", "merge"),  # 'merge' or 'split'
+        "pipeline": fields.get("pipeline", config.PIPELINE_MODE),  # 'legacy' or 'single'
+        "label_mode": fields.get("label_mode", config.LABEL_MODE),  # 'raster' or 'vector'
+        "color_mode": fields.get("color_mode", config.COLOR_MODE),  # 'auto' or 'color'
+        "zip_compression": fields.get("zip_compression", config.ZIP_COMPRESSION),  # 'stored' or 'deflated'
+    }
+    try:
+        params["max_in_flight"] = int(fields.get("max_in_flight") or 0)  # 0 = server default
+    except ValueError:
+        raise UploadError("max_in_flight must be an integer")
+    try:
+        params["target_bytes"] = int(fields.get("target_bytes") or 0)  # 0 = off
+    except ValueError:
+        raise UploadError("target_bytes must be an integer")
+    if params["target_bytes"] < 0:
+        raise UploadError("target_bytes must not be negative")
+    if params["target_bytes"]:
+        # Only single-encode pages have a quality and size to choose
+        params["pipeline"] = "single"
+    params["stream"] = form_flag(fields, "stream")
+    if params["pipeline"] not in PIPELINES:
+        raise UploadError(
+            f"Unknown pipeline '{params['pipeline']}', expected one of: {', '.join(PIPELINES)}")
+    if params["label_mode"] not in LABEL_MODES:
+        raise UploadError(
+            f"Unknown label_mode '{params['label_mode']}', expected one of: {', '.join(LABEL_MODES)}")
+    if params["color_mode"] not in COLOR_MODES:
+        raise UploadError(
+            f"Unknown color_mode '{params['color_mode']}', expected one of: {', '.join(COLOR_MODES)}")
+    if params["zip_compression"] not in ZIP_COMPRESSIONS:
+        raise UploadError(
+            f"Unknown zip_compression '{params['zip_compression']}', "
+            f"expected one of: {', '.join(ZIP_COMPRESSIONS)}")
+    return params
+
+
+async def write_output(out, uploads: list, params: dict, options: PageOptions, in_flight: int,
+                       progress: ConversionProgress, results=None):
+    """
+    Process every upload and write the finished merged PDF (or split ZIP)
+    to the binary file ``out``, page by page in upload order.  ``results``
+    replaces the processing with pages produced elsewhere: an async
+    iterator of (upload, page or exception, rendered) like process_uploads.
+
+    Raises ConversionError when no page could be processed or the document
+    could not be written.
+    """
+    mode = params["mode"]
+    if results is None and params.get("target_bytes"):
+        progress.target = await plan_target(uploads, params, options, in_flight)
+    document = open_output_document(mode, out, params["zip_compression"])
+    try:
+        if results is None:
+            results = process_uploads(uploads, params["pipeline"], options, in_flight, progress,
+                                      render=split_renderer(mode), plan=progress.target)
+        async with aclosing(results):
+            async for upload, result, rendered in results:
+                page = progress.record(upload, result)
+                if page is None:
+                    continue
+                try:
+                    await asyncio.to_thread(document.add, page, rendered)
+                except Exception as pdf_error:
+                    raise ConversionError(500, {"error": f"Failed to create PDF: {str(pdf_error)}"})
+                if rendered is not None:
+                    progress.document_bytes.append(len(rendered))
+
+        if progress.processed_count == 0:
+            raise progress.no_pages_error()
+        try:
+            await asyncio.to_thread(document.close)
+        except Exception as pdf_error:
+            raise ConversionError(500, {"error": f"Failed to create PDF: {str(pdf_error)}"})
+        if mode != 'split':
+            progress.document_bytes.append(out.tell())
+    except BaseException:
+        document.abort()
+        raise
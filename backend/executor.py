@@ -0,0 +1,129 @@
+"""
+Execution engine for the CPU-bound stages of the conversion pipeline.
+
+Decoding, resizing, labeling and PDF generation hold the GIL (or simply burn
+CPU) for hundreds of milliseconds per page.  Running them inline in an
+``async def`` endpoint blocks the uvicorn event loop, so every other request,
+including ``/`` health checks, waits behind the largest upload.  The engine
+moves that work onto a process pool (or a thread pool) and gives callers an
+awaitable with a per-task timeout.
+"""
+import asyncio
+import collections
+import itertools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+import config
+from logs import configure_logging
+
+
+class TaskTimeoutError(TimeoutError):
+    """Raised when a pipeline task does not finish within its timeout"""
+
+
+class ExecutionEngine:
+    """Owns the worker pool used for CPU-bound conversion stages"""
+
+    def __init__(self, kind: str = config.EXECUTOR_KIND, max_workers: int = config.POOL_SIZE,
+                 task_timeout: float = config.TASK_TIMEOUT):
+        if kind not in ('process', 'thread'):
+            raise ValueError(f"Unknown executor kind: {kind!r}")
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.task_timeout = task_timeout
+        # Run in every worker process before it takes its first task (must
+        # be picklable, i.e. a module-level function)
+        self.worker_init: Optional[Callable[[], Any]] = None
+        self._pool: Optional[Executor] = None
+
+    @property
+    def running(self) -> bool:
+        return self._pool is not None
+
+    def start(self):
+        """Create the worker pool; calling it on a running engine is a no-op"""
+        if self._pool is not None:
+            return
+        if self.kind == 'process':
+            # 'spawn' keeps workers from inheriting the event loop's threads
+            # and sockets, which is not safe to do with fork; they also start
+            # without our logging setup, hence the initializer.
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker, initargs=(self.worker_init,))
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='snapmerge')
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting work, drop queued tasks and wait for running ones"""
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=True)
+
+    async def run(self, fn: Callable[..., Any], *args, timeout: Optional[float] = None) -> Any:
+        """
+        Run ``fn(*args)`` on the pool and await its result.
+
+        ``fn`` and its arguments must be picklable when the engine uses
+        processes.  A task that exceeds the timeout raises TaskTimeoutError;
+        the worker itself cannot be interrupted, so its result is discarded
+        once it finishes.
+        """
+        self.start()
+        limit = self.task_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._pool, fn, *args)
+        try:
+            return await asyncio.wait_for(future, timeout=limit if limit > 0 else None)
+        except asyncio.TimeoutError:
+            raise TaskTimeoutError(
+                f"{getattr(fn, '__name__', 'task')} exceeded the {limit:g}s timeout") from None
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer); replace the pool
+            # so later requests are not poisoned by this one.
+            self.shutdown(wait=False)
+            raise
+
+
+def _init_worker(worker_init: Optional[Callable[[], Any]]):
+    configure_logging()
+    if worker_init is not None:
+        worker_init()
+
+
+async def ordered_window(awaitables: Iterable[Awaitable[Any]], window: int) -> AsyncIterator[Any]:
+    """
+    Await ``awaitables`` with at most ``window`` running at a time and yield
+    their results in input order; a failed one yields its exception instead.
+
+    At most ``window`` awaitables run beyond the result being yielded, so a
+    consumer that handles results one by one never has more than
+    ``window + 1`` of them alive, however many items there are.
+    ``awaitables`` is consumed lazily.  Closing the generator early cancels
+    the ones still pending.
+    """
+    awaitables = iter(awaitables)
+    pending = collections.deque(
+        asyncio.ensure_future(item) for item in itertools.islice(awaitables, max(1, window)))
+    try:
+        while pending:
+            task = pending.popleft()
+            try:
+                result = await task
+            except Exception as exc:
+                result = exc
+            # Keep the pool busy while the caller handles this result
+            for item in itertools.islice(awaitables, 1):
+                pending.append(asyncio.ensure_future(item))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+engine = ExecutionEngine()
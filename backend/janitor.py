@@ -0,0 +1,244 @@
+"""
+Lifecycle of the temp root.
+
+Request working directories used to be removed by a fire-and-forget
+``delayed_cleanup`` task per request; those tasks die with the process, so
+every restart or reload leaked directories, and nothing bounded the disk
+space used.  The janitor instead owns the temp root:
+
+* it sweeps on startup and then on a schedule, removing directories whose
+  last change is older than their area's TTL (request directories and job
+  directories expire separately);
+* it keeps the total size under a byte quota by removing the least
+  recently changed directories first;
+* it never touches directories that are in use (held by a running request
+  or belonging to an unfinished job).
+
+Scanning tens of thousands of directories must stay cheap, so sizes are
+kept in an index: a sweep lists each area once (one ``stat`` per directory)
+and only walks the directories that are new or changed since the last
+sweep.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger('snapmerge.janitor')
+
+
+@dataclass
+class _Entry:
+    area: str
+    mtime: float
+    size: int
+
+
+def directory_size(path: str) -> int:
+    """Bytes of all files below ``path``"""
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += directory_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return total
+
+
+class TempJanitor:
+    """
+    TTL expiry and byte quota for the directories in a set of areas.
+
+    ``areas`` maps each area directory to its TTL in seconds (0 = no
+    expiry).  An area nested in another one is skipped by the outer one.
+    ``in_use(path)`` can protect directories beyond the ones held through
+    ``hold()``; ``on_remove(path)`` is told, on the event loop, about every
+    directory the scheduled sweeps removed.
+    """
+
+    def __init__(self, areas: Dict[str, float], max_bytes: int = 0, interval: float = 60.0,
+                 grace: float = 60.0, in_use: Optional[Callable[[str], bool]] = None,
+                 on_remove: Optional[Callable[[str], None]] = None):
+        self.areas = {os.path.normpath(area): ttl for area, ttl in areas.items()}
+        self.max_bytes = max_bytes  # 0 = no quota
+        self.interval = interval
+        self.grace = grace  # Directories changed this recently are never evicted for the quota
+        self.in_use = in_use
+        self.on_remove = on_remove
+        self.sweeps = 0
+        self.expired = 0
+        self.evicted = 0
+        self.last_sweep: Optional[float] = None
+        self.last_sweep_seconds: Optional[float] = None
+        self._index: Dict[str, _Entry] = {}
+        self._held: Counter = Counter()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @contextmanager
+    def holding(self, path: str):
+        """Protect ``path`` from removal for the duration of the block"""
+        self.hold(path)
+        try:
+            yield
+        finally:
+            self.release(path)
+
+    def hold(self, path: str):
+        with self._lock:
+            self._held[os.path.normpath(path)] += 1
+
+    def release(self, path: str):
+        path = os.path.normpath(path)
+        with self._lock:
+            self._held[path] -= 1
+            if self._held[path] <= 0:
+                del self._held[path]
+
+    def _protected(self, path: str) -> bool:
+        with self._lock:
+            if path in self._held:
+                return True
+        return self.in_use is not None and self.in_use(path)
+
+    def _scan(self) -> Iterable[Tuple[str, str, os.stat_result]]:
+        for area in self.areas:
+            try:
+                entries = list(os.scandir(area))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                path = os.path.normpath(entry.path)
+                if path in self.areas:
+                    continue  # A nested area, swept on its own
+                try:
+                    yield area, path, entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+
+    def _refresh(self):
+        """Bring the index up to date, walking only new or changed directories"""
+        seen = set()
+        for area, path, stat in self._scan():
+            seen.add(path)
+            entry = self._index.get(path)
+            if entry is not None and entry.mtime == stat.st_mtime and not self._protected(path):
+                continue
+            if os.path.isdir(path):
+                size = directory_size(path)
+            else:
+                size = stat.st_size
+            self._index[path] = _Entry(area=area, mtime=stat.st_mtime, size=size)
+        for path in set(self._index) - seen:
+            del self._index[path]
+
+    def _remove(self, path: str):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._index.pop(path, None)
+
+    def sweep(self, now: Optional[float] = None) -> dict:
+        """Expire old directories, then enforce the quota; returns what was removed"""
+        started = time.monotonic()
+        now = time.time() if now is None else now
+        self._refresh()
+
+        expired = []
+        for path, entry in list(self._index.items()):
+            ttl = self.areas[entry.area]
+            if ttl > 0 and now - entry.mtime > ttl and not self._protected(path):
+                self._remove(path)
+                expired.append(path)
+
+        evicted = []
+        total = self.total_bytes
+        if 0 < self.max_bytes < total:
+            # Oldest first; only sorted when the quota is actually exceeded
+            for path, entry in sorted(self._index.items(), key=lambda item: item[1].mtime):
+                if total <= self.max_bytes:
+                    break
+                if now - entry.mtime < self.grace or self._protected(path):
+                    continue
+                total -= entry.size
+                self._remove(path)
+                evicted.append(path)
+
+        self.sweeps += 1
+        self.expired += len(expired)
+        self.evicted += len(evicted)
+        self.last_sweep = now
+        self.last_sweep_seconds = round(time.monotonic() - started, 4)
+        if expired or evicted:
+            logger.info("🧹 Temp sweep removed %d expired and %d over-quota entries (%d bytes in use)",
+                        len(expired), len(evicted), self.total_bytes)
+        return {'expired': expired, 'evicted': evicted}
+
+    async def run_sweep(self) -> dict:
+        """Sweep in a worker thread"""
+        try:
+            removed = await asyncio.to_thread(self.sweep)
+        except Exception as e:
+            logger.warning("Temp sweep failed: %s", e)
+            return {'expired': [], 'evicted': []}
+        if self.on_remove is not None:
+            for path in removed['expired'] + removed['evicted']:
+                self.on_remove(path)
+        return removed
+
+    async def start(self):
+        """Sweep once now, then every ``interval`` seconds"""
+        if self._task is not None:
+            return
+        await self.run_sweep()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_sweep()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry.size for entry in self._index.values())
+
+    def stats(self) -> dict:
+        by_area = {area: {'entries': 0, 'bytes': 0, 'ttl_seconds': ttl} for area, ttl in self.areas.items()}
+        for entry in self._index.values():
+            by_area[entry.area]['entries'] += 1
+            by_area[entry.area]['bytes'] += entry.size
+        return {
+            'bytes': self.total_bytes,
+            'entries': len(self._index),
+            'max_bytes': self.max_bytes,
+            'areas': by_area,
+            'held': len(self._held),
+            'sweeps': self.sweeps,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'last_sweep': self.last_sweep,
+            'last_sweep_seconds': self.last_sweep_seconds,
+        }
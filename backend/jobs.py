@@ -0,0 +1,285 @@
+"""
+Background conversion jobs.
+
+A large merge can take longer than a proxy lets an HTTP request stay open.
+``POST /jobs`` ingests the same form as ``/convert``, writes every upload to
+the job's directory and returns right away; a small pool of asyncio workers
+takes jobs off a bounded queue and runs them through the same conversion
+code as ``/convert``.
+
+Each job lives in ``<temp root>/jobs/<id>/``: the uploads, the finished
+document and ``job.json`` with the job's parameters, state and final
+report.  The record is rewritten on every state change, so completed
+results survive a restart, and jobs that were queued or running when the
+server stopped are picked up again (their uploads are still on disk).
+Finished jobs are removed by the temp janitor once ``JOB_RETENTION`` has
+passed (or earlier, oldest first, when the temp quota is exceeded).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import config
+from cache import cache_key, result_cache
+from conversion import (
+    ConversionError,
+    ConversionProgress,
+    document_headers,
+    output_cache_params,
+    output_filename,
+    page_options,
+    resolve_max_in_flight,
+    write_output,
+)
+from metrics import RESPONSE_BYTES
+from uploads import IngestedUpload
+
+logger = logging.getLogger('snapmerge.jobs')
+
+JOB_RECORD = 'job.json'
+
+
+class JobQueueFull(Exception):
+    """No room for another queued job"""
+
+
+@dataclass
+class Job:
+    id: str
+    directory: str
+    params: dict  # Parsed /convert form fields
+    uploads: List[IngestedUpload]
+    state: str = 'queued'
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    # Set once complete: what GET /jobs/{id}/result serves
+    result: Optional[dict] = None
+    # Final (or, while running, the live) per-page report
+    report: dict = field(default_factory=dict)
+    progress: Optional[ConversionProgress] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ('complete', 'failed')
+
+    def to_record(self) -> dict:
+        """What goes into job.json"""
+        uploads = []
+        for upload in self.uploads:
+            entry = asdict(upload)
+            entry['data'] = None  # Job uploads are always on disk; empty files have no file
+            uploads.append(entry)
+        return {
+            'id': self.id,
+            'params': self.params,
+            'uploads': uploads,
+            'state': self.state,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'result': self.result,
+            'report': self.report,
+        }
+
+    @classmethod
+    def from_record(cls, directory: str, record: dict) -> 'Job':
+        uploads = []
+        for entry in record['uploads']:
+            upload = IngestedUpload(**entry)
+            if upload.path is None:
+                upload.data = b''
+            uploads.append(upload)
+        fields = {name: record[name] for name in
+                  ('id', 'params', 'state', 'created_at', 'started_at', 'finished_at', 'error',
+                   'result', 'report')}
+        return cls(directory=directory, uploads=uploads, **fields)
+
+    def status(self) -> dict:
+        """Public view for GET /jobs/{id}"""
+        report = self.progress.status() if self.progress is not None else self.report
+        view = {
+            'job_id': self.id,
+            'mode': self.params['mode'],
+            'total_files': len(self.uploads),
+            **report,
+            'state': self.state,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.started_at is not None:
+            view['elapsed_seconds'] = round((self.finished_at or time.time()) - self.started_at, 3)
+        if self.error is not None:
+            view['error'] = self.error
+        if self.state == 'complete':
+            view['result_url'] = f"/jobs/{self.id}/result"
+        return view
+
+
+class JobManager:
+    """Bounded queue of conversion jobs served by a fixed number of workers"""
+
+    def __init__(self, root: str, workers: int = config.JOB_WORKERS,
+                 max_queued: int = config.MAX_QUEUED_JOBS):
+        self.root = root
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @staticmethod
+    def new_job_id() -> str:
+        return uuid4().hex
+
+    def directory(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    @property
+    def queued_count(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.state == 'queued')
+
+    def load(self) -> List[Job]:
+        """Read the job records on disk; returns the unfinished jobs, oldest first"""
+        os.makedirs(self.root, exist_ok=True)
+        for entry in os.scandir(self.root):
+            record_path = os.path.join(entry.path, JOB_RECORD)
+            if not entry.is_dir() or entry.name in self.jobs or not os.path.exists(record_path):
+                continue
+            try:
+                with open(record_path, encoding='utf-8') as f:
+                    job = Job.from_record(entry.path, json.load(f))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning("Could not load job %s: %s", entry.name, e)
+                continue
+            self.jobs[job.id] = job
+        unfinished = [job for job in self.jobs.values() if not job.finished]
+        return sorted(unfinished, key=lambda job: job.created_at)
+
+    def save(self, job: Job):
+        record_path = os.path.join(job.directory, JOB_RECORD)
+        with open(record_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(job.to_record(), f)
+        os.replace(record_path + '.tmp', record_path)
+
+    def in_use(self, directory: str) -> bool:
+        """Whether ``directory`` belongs to a job that has not finished (for the janitor)"""
+        job = self.jobs.get(os.path.basename(directory))
+        return job is not None and not job.finished
+
+    def forget(self, directory: str):
+        """Drop the job whose directory the janitor removed"""
+        if os.path.dirname(os.path.normpath(directory)) == os.path.normpath(self.root):
+            self.jobs.pop(os.path.basename(directory), None)
+
+    async def start(self):
+        """Load persisted jobs, re-queue unfinished ones and start the workers"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        for job in await asyncio.to_thread(self.load):
+            logger.info("🔁 Resuming job %s (%s before restart)", job.id, job.state)
+            job.state = 'queued'
+            self._queue.put_nowait(job.id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; interrupted jobs stay on disk and resume on the next start"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, job_id: str, params: dict, uploads: List[IngestedUpload]) -> Job:
+        """Queue a job whose uploads are already in its directory"""
+        if self.queued_count >= self.max_queued:
+            raise JobQueueFull(f"Too many queued jobs (limit {self.max_queued})")
+        job = Job(id=job_id, directory=self.directory(job_id), params=params, uploads=uploads)
+        await asyncio.to_thread(self.save, job)
+        self.jobs[job_id] = job
+        self._queue.put_nowait(job_id)
+        return job
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                job = self.jobs.get(job_id)
+                if job is not None and job.state == 'queued':
+                    await self._run(job)
+            except Exception as e:
+                logger.exception("Job worker error on %s: %s", job_id, e)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        params = job.params
+        options = page_options(params)
+        output_path = os.path.join(job.directory, output_filename(params["mode"]))
+        job.state, job.started_at, job.error = 'running', time.time(), None
+        job.progress = ConversionProgress(job.uploads)
+        await asyncio.to_thread(self.save, job)
+        logger.info("🧵 Job %s started: %d files (%s)", job.id, len(job.uploads), params['mode'])
+
+        result_key = cache_key(((upload.sha256, upload.filename) for upload in job.uploads),
+                               output_cache_params(params, options))
+        # Linked into the job directory under the cache lock; an entry whose
+        # data has gone is a miss and the job converts as usual
+        cached = await asyncio.to_thread(result_cache.get, result_key, output_path)
+        try:
+            if cached is not None:
+                job.result = {'path': output_path, 'media_type': cached.meta['media_type'],
+                              'headers': cached.meta['headers']}
+            else:
+                in_flight = resolve_max_in_flight(params["max_in_flight"])
+                with open(output_path, 'wb') as output_file:
+                    await write_output(output_file, job.uploads, params, options, in_flight, job.progress)
+                headers = document_headers(params["mode"], job.progress)
+                media_type = 'application/zip' if params["mode"] == 'split' else 'application/pdf'
+                job.result = {'path': output_path, 'media_type': media_type, 'headers': headers}
+                RESPONSE_BYTES.observe(os.path.getsize(output_path), mode=params["mode"])
+                try:
+                    await asyncio.to_thread(result_cache.put_file, result_key, output_path,
+                                            {'media_type': media_type, 'headers': headers})
+                except Exception as e:
+                    logger.warning("Could not cache result: %s", e)
+            job.state = 'complete'
+        except ConversionError as e:
+            job.state, job.error = 'failed', e.content["error"]
+        except Exception as e:
+            job.state, job.error = 'failed', f"Failed to process images: {str(e)}"
+
+        if job.state == 'failed' and os.path.exists(output_path):
+            os.remove(output_path)
+        job.finished_at = time.time()
+        job.progress.state = job.state
+        if cached is None or job.result is None:
+            job.report = job.progress.status()
+        else:
+            # Served from the result cache: only the counts from its headers are known
+            headers = job.result['headers']
+            job.report = {
+                'processed_images': int(headers.get('X-Processed-Images', 0)),
+                'decode_scales': headers.get('X-Decode-Scales', ''),
+                'cached_result': True,
+            }
+        job.progress = None
+        # The inputs are no longer needed once the job has finished
+        for upload in job.uploads:
+            upload.discard()
+        await asyncio.to_thread(self.save, job)
+        logger.info("🧵 Job %s %s in %.2fs", job.id, job.state, job.finished_at - job.started_at,
+                    extra={'job': job.id, 'state': job.state, 'mode': params['mode'],
+                           'seconds': round(job.finished_at - job.started_at, 3),
+                           'processed_images': job.report.get('processed_images')})
+
+
+job_manager = JobManager(os.path.join(config.TEMP_ROOT, 'jobs'))
@@ -0,0 +1,62 @@
+"""
+Logging setup.
+
+Every module logs to a ``snapmerge.<module>`` logger.  Per-page details are
+DEBUG, so at the default INFO level the page workers do not format or write
+anything on the hot path.  Fields passed with ``extra={...}`` are kept as
+structured data: appended as ``key=value`` in the text format, or as keys
+of the one-JSON-object-per-line format.
+"""
+import json
+import logging
+import sys
+
+import config
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def record_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={json.dumps(value, default=str, ensure_ascii=False)}'
+                                   for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **record_fields(record),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+FORMATTERS = {'text': TextFormatter, 'json': JsonFormatter}
+
+
+def configure_logging(level: str = config.LOG_LEVEL, fmt: str = config.LOG_FORMAT):
+    """Send the ``snapmerge`` loggers to stderr; safe to call more than once"""
+    logger = logging.getLogger('snapmerge')
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(FORMATTERS.get(fmt, TextFormatter)())
+        logger.addHandler(handler)
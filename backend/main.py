@@ -1,20 +1,139 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import FileResponse, JSONResponse
+import time
+# Taken before the framework and pipeline imports, for the startup report
+IMPORT_STARTED = time.perf_counter()
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image, ImageDraw, ImageFont
+import logging
 import os
-import shutil
 from uuid import uuid4
-from typing import List
+from contextlib import asynccontextmanager
 import asyncio
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import inch
-from reportlab.lib.utils import ImageReader
-import io
-import PyPDF2
+from collections import OrderedDict
+import config
+from cache import cache_key, page_cache, result_cache, thumbnail_cache
+from conversion import (
+    CONVERT_FORM_SCHEMA,
+    ConversionError,
+    ConversionProgress,
+    check_pixel_budget,
+    cleanup_temp_directory,
+    content_disposition,
+    document_headers,
+    download_name,
+    generate_pdf_filename,
+    open_output_document,
+    output_cache_params,
+    output_filename,
+    page_options,
+    parse_convert_fields,
+    plan_target,
+    process_uploads,
+    resolve_max_in_flight,
+    split_renderer,
+    write_output,
+)
+from admission import AdmissionController, AdmissionMiddleware
+from batch import BATCH_FORM_SCHEMA, parse_batch_fields, stream_batch
+from executor import engine
+from janitor import TempJanitor
+from jobs import JobQueueFull, job_manager
+from logs import configure_logging
+import metrics
+from pdfstream import ChunkBuffer
+from pipeline import PageOptions
+from preview import PREVIEW_FORM_SCHEMA, parse_preview_fields, preview_uploads, warm_page_cache
+from sessions import (
+    FINALIZE_FORM_SCHEMA,
+    SESSION_FORM_SCHEMA,
+    SessionError,
+    SessionLimit,
+    parse_finalize_fields,
+    session_manager,
+)
+from uploads import UploadError, ingest_multipart
+from warmup import FirstRequestTimer, prime_worker, report_startup, warm_up
+
+configure_logging()
+logger = logging.getLogger('snapmerge.main')
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+# Requests that do conversion work (admission control, first-request timing)
+CONVERSION_PATHS = ('/convert', '/jobs', '/preview-order', '/batch')
+# Session files are processed as they land and finalize writes the document,
+# so both count against the admission limits too
+SESSION_PATHS = ('/sessions/{session_id}/files/{position}', '/sessions/{session_id}/finalize')
+
+
+def forget_directory(path: str):
+    """The janitor removed ``path``: drop the job or upload session it belonged to"""
+    job_manager.forget(path)
+    session_manager.forget(path)
+
+
+# Owns everything under the temp root: request directories expire
+# TEMP_TTL after their last change, finished jobs after JOB_RETENTION and
+# upload sessions SESSION_TTL after their last upload
+temp_janitor = TempJanitor(
+    {config.TEMP_ROOT: config.TEMP_TTL, job_manager.root: config.JOB_RETENTION,
+     session_manager.root: config.SESSION_TTL},
+    max_bytes=config.TEMP_MAX_BYTES,
+    interval=config.JANITOR_INTERVAL,
+    in_use=job_manager.in_use,
+    on_remove=forget_directory,
+)
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start (and warm up) the conversion worker pool with the app and drain it on shutdown"""
+    if config.WARMUP:
+        engine.worker_init = prime_worker
+    engine.start()
+    logger.info("⚙️  Execution engine started: %d %s workers", engine.max_workers, engine.kind)
+    await asyncio.to_thread(result_cache.load)
+    await asyncio.to_thread(page_cache.store.load)
+    await asyncio.to_thread(thumbnail_cache.store.load)
+    await job_manager.start()
+    # After the jobs are loaded, so the sweep knows which ones are unfinished
+    await temp_janitor.start()
+    warmup_seconds = None
+    if config.WARMUP:
+        try:
+            warmup_seconds = await warm_up(engine)
+        except Exception as e:
+            logger.warning("Warm-up failed, the first requests will be slower: %s", e)
+    report_startup(IMPORT_SECONDS, warmup_seconds, time.perf_counter() - IMPORT_STARTED)
+    try:
+        yield
+    finally:
+        await temp_janitor.stop()
+        await job_manager.stop()
+        session_manager.stop()
+        # Cache warming is only an optimization, don't wait for it
+        warmups = list(preview_warmups)
+        for task in warmups:
+            task.cancel()
+        await asyncio.gather(*warmups, return_exceptions=True)
+        # Let in-flight conversions finish; queued ones are cancelled
+        await asyncio.get_running_loop().run_in_executor(None, engine.shutdown)
+        logger.info("⚙️  Execution engine stopped")
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Turn away conversions (and previews and session uploads, which decode
+# images too) over the concurrency limits before reading their bodies
+# (added first so CORS headers still go on the rejections)
+app.add_middleware(FirstRequestTimer, paths=CONVERSION_PATHS)
+admission = AdmissionController()
+app.add_middleware(AdmissionMiddleware, controller=admission, paths=CONVERSION_PATHS + SESSION_PATHS)
+
+metrics.CONVERSIONS_IN_PROGRESS.set_function(lambda: admission.active)
+metrics.JOBS.set_function(lambda: {
+    (state,): sum(1 for job in job_manager.jobs.values() if job.state == state)
+    for state in ('queued', 'running', 'complete', 'failed')})
+metrics.TEMP_BYTES.set_function(lambda: temp_janitor.total_bytes)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,486 +141,239 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     expose_headers=["Content-Disposition",
-                    "X-Processed-Images", "X-Total-Files", "X-Skipped-Files"],
+                    "X-Processed-Images", "X-Total-Files", "X-Skipped-Files",
+                    "X-Decode-Scales", "X-Page-Classes", "X-Target-Bytes", "X-Target-Met", "X-Document-Bytes",
+                    "X-Page-Settings", "X-Cache", "X-Conversion-Id", "X-Batch-Documents", "Retry-After"],
 )
 
 
-def optimize_image_for_pdf(img: Image.Image, max_width: int = 800, max_height: int = 1200, quality: int = 65) -> Image.Image:
-    """
-    Optimize image for PDF to reduce file size while maintaining quality for visa documents
-    """
-    # Convert to RGB if not already
-    if img.mode != 'RGB':
-        if img.mode in ('RGBA', 'LA', 'P'):
-            # Create white background for transparent images
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()
-                             [-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
-        else:
-            img = img.convert('RGB')
-
-    # Calculate new dimensions maintaining aspect ratio
-    width, height = img.size
-
-    # Only resize if image is larger than max dimensions
-    if width > max_width or height > max_height:
-        # Calculate scaling factor
-        width_ratio = max_width / width
-        height_ratio = max_height / height
-        scale_factor = min(width_ratio, height_ratio)
-
-        new_width = int(width * scale_factor)
-        new_height = int(height * scale_factor)
-
-        # Use LANCZOS for high-quality resizing
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        print(
-            f"   📏 Resized from {width}x{height} to {new_width}x{new_height}")
-
-    # Apply additional compression by reducing quality slightly
-    # Save to bytes buffer with compression
-    buffer = io.BytesIO()
-    img.save(buffer, format='JPEG', quality=quality, optimize=True)
-    buffer.seek(0)
-
-    # Load back the compressed image
-    compressed_img = Image.open(buffer)
-
-    return compressed_img
-
-
 @app.get("/")
 async def root():
     return {"message": "SnapMerge API - Image to PDF Converter"}
 
 
-@app.post("/preview-order")
-async def preview_file_order(files: list[UploadFile] = File(...)):
-    """Preview the order of uploaded files without processing them"""
-    if not files:
-        return {"error": "No files provided"}
-
-    file_preview = []
-    for index, file in enumerate(files):
-        # Reset file pointer
-        await file.seek(0)
+@app.get("/cache-stats")
+async def cache_stats():
+    """Hit/miss counters and disk usage of the result, page and thumbnail caches"""
+    return {"results": result_cache.stats(), "pages": page_cache.store.stats(),
+            "thumbnails": thumbnail_cache.store.stats()}
 
-        file_preview.append({
-            "index": index,
-            "filename": file.filename,
-            "content_type": file.content_type,
-            "size": file.size if hasattr(file, 'size') else "Unknown"
-        })
-
-    return {
-        "total_files": len(files),
-        "processing_order": file_preview,
-        "message": f"Files will be processed in the order shown above (0-{len(files)-1})"
-    }
 
+@app.get("/metrics")
+async def metrics_report():
+    """Stage timings, sizes and counters in the Prometheus text format"""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
-def generate_pdf_filename(file_info: list, image_count: int) -> str:
-    """Generate PDF filename using the same logic as the image labels"""
 
-    # If only one image, use the clean filename (same as image label)
-    if image_count == 1 and file_info:
-        original_name = file_info[0]['original_name']
-        # Use the same logic as add_filename_to_image function
-        clean_filename = os.path.splitext(original_name)[0]  # Remove extension
-        return f"{clean_filename}.pdf"
+@app.get("/temp-usage")
+async def temp_usage():
+    """Disk usage of the temp root as of the last janitor sweep"""
+    return temp_janitor.stats()
 
-    # For multiple images, create a descriptive name using the first image's clean filename
-    if file_info:
-        first_file = file_info[0]['original_name']
-        clean_filename = os.path.splitext(first_file)[0]  # Remove extension
 
-        # Add suffix for multiple documents
-        if image_count > 1:
-            return f"{clean_filename}_and_{image_count-1}_more_documents.pdf"
+@app.get("/convert/{conversion_id}/status")
+async def conversion_status_report(conversion_id: str):
+    """Final page counts of a streamed conversion, which cannot travel in its headers"""
+    progress = conversion_status.get(conversion_id)
+    if progress is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown conversion"})
+    return progress.status()
 
-    # Fallback
-    return f"merged_documents_{image_count}_pages.pdf"
-
-
-def cleanup_temp_directory(temp_dir: str):
-    """Clean up temporary directory after processing"""
-    try:
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-    except Exception as e:
-        print(f"Warning: Could not clean up temp directory {temp_dir}: {e}")
 
+@app.post("/preview-order", openapi_extra={"requestBody": {
+    "required": True, "content": {"multipart/form-data": {"schema": PREVIEW_FORM_SCHEMA}}}})
+async def preview_file_order(request: Request):
+    """
+    Preview the order of uploaded files with their dimensions and, if
+    asked for, thumbnails; the pages are converted into the page cache in
+    the background so the /convert that follows is faster
+    """
+    temp_dir = os.path.join(config.TEMP_ROOT, str(uuid4()))
+    started = time.perf_counter()
+    with temp_janitor.holding(temp_dir):
+        response = await run_preview(request, temp_dir)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="preview",
+                                    status=getattr(response, "status_code", 200))
+    return response
 
-def add_filename_to_image(img: Image.Image, filename: str, page_number: int) -> Image.Image:
-    """Add professional filename label under the image for visa documentation"""
 
-    # Calculate new image size with space for text
-    margin = 80  # Slightly reduced space for text at bottom
-    horizontal_padding = 30  # Equal padding from both sides
-    new_width = max(img.width, 800)  # Ensure minimum width for text
-    new_height = img.height + margin
+# Background page cache warm-ups started by /preview-order
+preview_warmups: "set[asyncio.Task]" = set()
 
-    # Create new image with white background
-    new_img = Image.new('RGB', (new_width, new_height), 'white')
 
-    # Calculate position to center the original image
-    x_offset = (new_width - img.width) // 2
-    new_img.paste(img, (x_offset, 0))
+async def run_preview(request: Request, temp_dir: str):
+    try:
+        fields, uploads = await ingest_multipart(request, temp_dir)
+        params = parse_preview_fields(fields)
+        # Thumbnails and warming the page cache decode the images
+        await check_pixel_budget(uploads)
+    except UploadError as e:
+        cleanup_temp_directory(temp_dir)
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
 
-    # Draw text
-    draw = ImageDraw.Draw(new_img)
+    if not uploads:
+        cleanup_temp_directory(temp_dir)
+        return {"error": "No files provided"}
 
-    # Try to load a professional font, fallback to default
+    in_flight = resolve_max_in_flight(params["max_in_flight"])
     try:
-        # Adjust font size based on image width while ensuring readability
-        # Adjusted font size calculation
-        font_size = min(32, max(18, new_width // 50))
-        font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-    except:
-        try:
-            font = ImageFont.truetype(
-                "/System/Library/Fonts/Helvetica.ttc", 20)
-        except:
-            font = ImageFont.load_default()
-
-    # Prepare text with filename only
-    clean_filename = os.path.splitext(filename)[0]  # Remove extension
-    text = clean_filename
-
-    # Calculate text size to ensure it fits
-    text = clean_filename
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-
-    # If text is too wide, try to shrink it
-    max_width = new_width - (2 * horizontal_padding)
-    if text_width > max_width:
-        # Reduce font size until it fits
-        while text_width > max_width and font_size > 12:
-            font_size -= 2
-            font = ImageFont.truetype(
-                "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-
-    # Calculate position to center the text
-    x = (new_width - text_width) // 2  # Center horizontally
-    # Center vertically in margin area
-    y = img.height + (margin - text_height) // 2
-
-    # Draw text with professional styling
-    # Enhanced shadow effect for better readability
-    shadow_offset = 2
-    shadow_color = '#BBBBBB'  # Slightly lighter shadow for professional look
-
-    # Draw shadow with multiple layers for depth
-    for offset in range(shadow_offset):
-        draw.text((x + offset, y + offset),
-                  text, font=font, fill=shadow_color)
-
-    # Draw main text with professional styling
-    draw.text((x, y), text, font=font,
-              fill='#1A365D')  # Rich navy blue for professional look
-
-    return new_img
-
-
-def create_professional_pdf(image_list: List[Image.Image], pdf_path: str, file_info: List[dict]):
-    """Create a professional PDF using ReportLab for consulate documents"""
-
-    # A4 page dimensions in points (1 point = 1/72 inch)
-    page_width, page_height = A4
-    margin = 0.5 * inch  # 0.5 inch margins
-    usable_width = page_width - (2 * margin)
-    usable_height = page_height - (2 * margin)
-
-    # Create the PDF canvas
-    c = canvas.Canvas(pdf_path, pagesize=A4)
-
-    # Set PDF metadata for official documents
-    # c.setTitle("Immigration Visa Documents")
-    # c.setAuthor("SnapMerge Document Converter")
-    # c.setSubject("Official Immigration Documentation")
-    # c.setKeywords("visa, immigration, documents, official")
-
-    for i, img in enumerate(image_list):
-        if i > 0:  # Add new page for each image after the first
-            c.showPage()
-
-        # Convert PIL image to bytes for ReportLab with compression
-        img_buffer = io.BytesIO()
-        # Use JPEG with lower quality for smaller file size
-        img.save(img_buffer, format='JPEG', quality=70, optimize=True)
-        img_buffer.seek(0)
-
-        # Create ImageReader object
-        img_reader = ImageReader(img_buffer)
-
-        # Calculate scaling to fit page while maintaining aspect ratio
-        img_width_px, img_height_px = img.size
-
-        # Calculate the maximum size that fits on the page
-        scale_w = usable_width / img_width_px
-        scale_h = usable_height / img_height_px
-        # Use the smaller scale to fit both dimensions
-        scale = min(scale_w, scale_h)
-
-        # Calculate final dimensions
-        final_width = img_width_px * scale
-        final_height = img_height_px * scale
-
-        # Center the image on the page
-        x_offset = margin + (usable_width - final_width) / 2
-        y_offset = margin + (usable_height - final_height) / 2
-
-        # Draw the image at high resolution
-        c.drawImage(
-            img_reader,
-            x_offset,
-            y_offset,
-            width=final_width,
-            height=final_height,
-            preserveAspectRatio=True,
-            anchor='c'
-        )
-
-        # Add professional header
-        # c.setFont("Helvetica-Bold", 12)
-        # c.drawString(margin, page_height - 30, "OFFICIAL IMMIGRATION DOCUMENT")
+        file_preview = await preview_uploads(uploads, params, in_flight)
+    except BaseException:
+        cleanup_temp_directory(temp_dir)
+        raise
+
+    warm_cache = params["warm_cache"] and page_cache.store.enabled
+    if warm_cache and len(preview_warmups) >= config.MAX_PREVIEW_WARMUPS:
+        logger.debug("Skipping page cache warm-up: %d already running", len(preview_warmups))
+        warm_cache = False
+    if warm_cache:
+        # Held from now on, released by the warm-up when it is done
+        temp_janitor.hold(temp_dir)
+        task = asyncio.create_task(warm_preview_pages(temp_dir, uploads, params, in_flight))
+        preview_warmups.add(task)
+        task.add_done_callback(preview_warmups.discard)
+    else:
+        cleanup_temp_directory(temp_dir)
 
-        # Add page number and document info
-        # c.setFont("Helvetica", 10)
-        # page_info = f"Page {i + 1} of {len(image_list)}"
-        # if i < len(file_info):
-        #     page_info += f" - {file_info[i]['original_name']}"
+    response = {
+        "total_files": len(uploads),
+        "processing_order": file_preview,
+        "message": f"Files will be processed in the order shown above (0-{len(uploads)-1})"
+    }
+    if params["thumbnails"]:
+        response["cached_thumbnails"] = sum(1 for entry in file_preview if entry.get("thumbnail_cached"))
+    return response
 
-        # c.drawRightString(page_width - margin, page_height - 30, page_info)
 
-        # Add footer with timestamp and system info
-        c.setFont("Helvetica", 8)
-        from datetime import datetime
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S UTC")
-        # footer_text = f"Generated by SnapMerge on {timestamp} - High Resolution: 300 DPI"
+async def warm_preview_pages(temp_dir: str, uploads: list, params: dict, in_flight: int):
+    try:
+        await warm_page_cache(uploads, params, in_flight)
+    except Exception as e:
+        logger.warning("Could not warm the page cache: %s", e)
+    finally:
+        cleanup_temp_directory(temp_dir)
+        temp_janitor.release(temp_dir)
 
-        # Calculate centered position for footer text
-        # text_width = c.stringWidth(footer_text, "Helvetica", 8)
-        # footer_x = (page_width - text_width) / 2
-        # c.drawString(footer_x, 20, footer_text)
 
-        # Add quality assurance note
-        # c.setFont("Helvetica", 7)
-        # quality_note = "This document maintains original image quality and resolution for official use"
+# Final statistics of streamed conversions, which cannot go into response
+# headers; only the most recent ones are kept
+conversion_status: "OrderedDict[str, ConversionProgress]" = OrderedDict()
+MAX_TRACKED_CONVERSIONS = 1000
 
-        # # Calculate centered position for quality note
-        # quality_width = c.stringWidth(quality_note, "Helvetica", 7)
-        # quality_x = (page_width - quality_width) / 2
-        # c.drawString(quality_x, 10, quality_note)
 
-    # Save the PDF with compression
-    c.save()
+def track_conversion(conversion_id: str, progress: ConversionProgress):
+    conversion_status[conversion_id] = progress
+    while len(conversion_status) > MAX_TRACKED_CONVERSIONS:
+        conversion_status.popitem(last=False)
 
-    # Apply additional PDF compression to reduce file size
-    compress_pdf(pdf_path)
 
-    print(
-        f"✅ Compressed PDF created: {len(image_list)} pages optimized for small file size")
+@app.post("/convert", openapi_extra={"requestBody": {
+    "required": True, "content": {"multipart/form-data": {"schema": CONVERT_FORM_SCHEMA}}}})
+async def convert_to_pdf(request: Request):
+    temp_dir = os.path.join(config.TEMP_ROOT, str(uuid4()))
+    # The janitor leaves the directory alone while the request runs; once
+    # the response is out it is removed TEMP_TTL after its last change
+    started = time.perf_counter()
+    with temp_janitor.holding(temp_dir):
+        response = await run_conversion(request, temp_dir)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="convert",
+                                    status=getattr(response, "status_code", 200))
+    return response
 
 
-def compress_pdf(pdf_path: str):
-    """Compress PDF file to reduce size"""
+async def run_conversion(request: Request, temp_dir: str):
+    # Stream the upload into memory/disk sinks, enforcing size limits early
     try:
-        # Read the original PDF
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            writer = PyPDF2.PdfWriter()
-
-            # Copy pages with compression
-            for page in reader.pages:
-                # Remove unnecessary data and compress
-                page.compress_content_streams()
-                writer.add_page(page)
-
-            # Set compression options
-            # writer.add_metadata({
-            #     '/Title': 'Immigration Visa Documents - Compressed',
-            #     '/Subject': 'Official Immigration Documentation',
-            #     '/Creator': 'SnapMerge Document Converter'
-            # })
-
-            # Write compressed PDF
-            temp_path = pdf_path + '.tmp'
-            with open(temp_path, 'wb') as output_file:
-                writer.write(output_file)
-
-        # Replace original with compressed version
-        import shutil
-        shutil.move(temp_path, pdf_path)
-        print(f"   📦 PDF compressed successfully")
+        with metrics.stage("upload_read"):
+            fields, uploads = await ingest_multipart(request, temp_dir)
+        metrics.UPLOAD_BYTES.observe(sum(upload.size for upload in uploads))
+        params = parse_convert_fields(fields)
+        # Refuse decompression bombs before any image is decoded
+        await check_pixel_budget(uploads)
+    except UploadError as e:
+        cleanup_temp_directory(temp_dir)
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
 
-    except Exception as e:
-        print(f"   ⚠️  PDF compression failed: {e}")
-        # If compression fails, continue with original PDF
+    if not uploads:
+        cleanup_temp_directory(temp_dir)
+        return {"error": "No files provided"}
 
+    mode = params["mode"]
+    pipeline = params["pipeline"]
+    label_mode = params["label_mode"]
+    options = page_options(params)
 
-@app.post("/convert")
-async def convert_to_pdf(
-    files: list[UploadFile] = File(...),
-    mode: str = Form('merge')  # 'merge' or 'split'
-):
-    if not files:
-        return {"error": "No files provided"}
+    # Identical inputs and parameters always produce the same document
+    result_key = cache_key(((upload.sha256, upload.filename) for upload in uploads),
+                           output_cache_params(params, options))
+    # Linked into the request's directory, where eviction cannot reach it
+    os.makedirs(temp_dir, exist_ok=True)
+    cached = result_cache.get(result_key, copy_to=os.path.join(temp_dir, output_filename(mode)))
+    if cached is not None:
+        logger.info("♻️  Serving cached result for %d files", len(uploads))
+        metrics.RESPONSE_BYTES.observe(cached.size, mode=mode)
+        return FileResponse(
+            cached.path,
+            media_type=cached.meta["media_type"],
+            headers={**cached.meta["headers"], "X-Cache": "HIT"}
+        )
 
-    print(f"🔄 Starting conversion process...")
-    print(f"📊 Received {len(files)} files for processing")
+    logger.info("📊 Received %d files for processing (%s pipeline, %s labels)",
+                len(uploads), pipeline, label_mode)
 
     # Log file details
-    for i, file in enumerate(files):
-        print(f"   File {i+1}: {file.filename} ({file.content_type})")
+    if logger.isEnabledFor(logging.DEBUG):
+        for upload in uploads:
+            where = "spilled to disk" if upload.path else "in memory"
+            logger.debug("File %d: %s (%s, %d bytes, %s)", upload.index + 1, upload.filename,
+                         upload.content_type, upload.size, where)
 
-    temp_dir = f"temp/{uuid4()}"
-    os.makedirs(temp_dir, exist_ok=True)
-    image_list = []
-    file_info = []
+    in_flight = resolve_max_in_flight(params["max_in_flight"])
+    logger.debug("⚙️  Processing up to %d pages in parallel", in_flight)
+    if params["stream"]:
+        return await stream_conversion(temp_dir, uploads, params, options, in_flight)
+
+    progress = ConversionProgress(uploads)
+    output_path = os.path.join(temp_dir, output_filename(mode))
 
     try:
-        # Process files in the exact order they were uploaded
-        processed_count = 0
-        skipped_files = []
-
-        for index, file in enumerate(files):
-            print(
-                f"🔍 Processing file {index + 1}/{len(files)}: {file.filename}")
-
-            # Read file contents directly without validation
-            contents = await file.read()
-            print(f"   📖 Read {len(contents)} bytes")
-
-            # Create ordered filename to preserve sequence
-            file_extension = os.path.splitext(
-                file.filename)[1] if file.filename else ".jpg"
-            ordered_filename = f"{processed_count:03d}_{file.filename}" if file.filename else f"{processed_count:03d}_image{file_extension}"
-            path = os.path.join(temp_dir, ordered_filename)
-
-            # Save file to disk
-            with open(path, "wb") as f:
-                f.write(contents)
-
-            # Try to process as image - force processing even if validation fails
-            try:
-                img = Image.open(path)
-                original_size = img.size
-                print(
-                    f"   🖼️  Original image: {img.size} pixels, mode: {img.mode}")
-
-                # Optimize image for PDF (resize + compress)
-                img = optimize_image_for_pdf(
-                    img, max_width=800, max_height=1200, quality=60)
-                print(f"   ✅ Optimized: {original_size} → {img.size} pixels")
-
-                # Add professional filename label for visa documentation
-                img_with_label = add_filename_to_image(
-                    img, file.filename, processed_count + 1)
-                print(f"   📝 Added professional filename label")
-
-                # Accept any image dimensions - no validation
-                image_list.append(img_with_label)
-                file_info.append({
-                    "original_name": file.filename,
-                    "ordered_name": ordered_filename,
-                    "index": processed_count,
-                    "size": img_with_label.size,
-                    "mode": img_with_label.mode
-                })
-                processed_count += 1
-                print(
-                    f"   ✅ Successfully processed as image #{processed_count}")
-
-            except Exception as img_error:
-                # Log the error but still try to continue with other files
-                reason = f"Could not process as image: {str(img_error)}"
-                print(f"   ❌ {reason}")
-                skipped_files.append({
-                    "filename": file.filename,
-                    "reason": reason
-                })
-                # Remove the invalid file
-                if os.path.exists(path):
-                    os.remove(path)
-                continue
-
-        if not image_list:
-            error_msg = "No valid image files found."
-            if skipped_files:
-                error_msg += f" Skipped {len(skipped_files)} files: "
-                error_msg += ", ".join(
-                    [f"{sf['filename']} ({sf['reason']})" for sf in skipped_files[:3]])
-                if len(skipped_files) > 3:
-                    error_msg += f" and {len(skipped_files) - 3} more..."
-            return JSONResponse(
-                status_code=400,
-                content={"error": error_msg, "skipped_files": skipped_files}
-            )
+        # Process files in the exact order they were uploaded. Each page is
+        # written into the PDF (or its own PDF in the ZIP) and dropped before
+        # the next one.
+        logger.debug("📄 Streaming pages into %s...", os.path.basename(output_path))
+        try:
+            with open(output_path, "wb") as output_file:
+                await write_output(output_file, uploads, params, options, in_flight, progress)
+        except ConversionError as e:
+            cleanup_temp_directory(temp_dir)
+            return JSONResponse(status_code=e.status_code, content=e.content)
+
+        processed_count = progress.processed_count
+        skipped_files = progress.skipped_files
+        file_info = progress.file_info
 
         # Handle split or merge modes
         if mode == 'split':
-            # Generate a PDF per image and zip them
-            zip_path = os.path.join(temp_dir, 'split_documents.zip')
-            import zipfile
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for i, img in enumerate(image_list):
-                    info = file_info[i]
-                    # single PDF for this image
-                    single_name = os.path.splitext(
-                        info['original_name'])[0] + '.pdf'
-                    single_path = os.path.join(temp_dir, single_name)
-                    create_professional_pdf([img], single_path, [info])
-                    zf.write(single_path, arcname=single_name)
-            # Schedule cleanup
-            asyncio.create_task(delayed_cleanup(temp_dir, delay_seconds=600))
+            metrics.RESPONSE_BYTES.observe(os.path.getsize(output_path), mode=mode)
+            zip_headers = {
+                'Content-Disposition': f"attachment; filename=split_documents.zip",
+                'Cache-Control': 'no-cache',
+                **progress.headers()
+            }
+            await store_result(result_key, output_path, 'application/zip', zip_headers)
             # Return zip file
             return FileResponse(
-                zip_path,
+                output_path,
                 media_type='application/zip',
-                headers={
-                    'Content-Disposition': f"attachment; filename=split_documents.zip",
-                    'Cache-Control': 'no-cache',
-                    'X-Processed-Images': str(len(image_list)),
-                    'X-Total-Files': str(len(files)),
-                    'X-Skipped-Files': str(len(skipped_files))
-                }
-            )
-        # Merge mode: create one PDF with all images
-        pdf_path = f"{temp_dir}/snapmerge_ordered.pdf"
-
-        try:
-            # Create professional PDF using ReportLab for consulate documents
-            print(
-                f"📄 Creating professional PDF with {len(image_list)} documented images...")
-
-            # Use ReportLab for better control and professional output
-            create_professional_pdf(image_list, pdf_path, file_info)
-
-            print(f"✅ Professional PDF created with ReportLab for consulate submission")
-
-        except Exception as pdf_error:
-            cleanup_temp_directory(temp_dir)
-            return JSONResponse(
-                status_code=500,
-                content={"error": f"Failed to create PDF: {str(pdf_error)}"}
+                headers={**zip_headers, 'X-Cache': 'MISS'}
             )
 
+        # Merge mode: every page is in the finished PDF
+        pdf_path = output_path
         # Log processing summary
-        print(f"✅ Successfully processed {len(image_list)} images")
-        if skipped_files:
-            print(f"⚠️  Skipped {len(skipped_files)} files:")
-            for sf in skipped_files:
-                print(f"   - {sf['filename']}: {sf['reason']}")
+        logger.info("✅ PDF created with %d documented images", processed_count,
+                    extra={'mode': mode, 'processed_images': processed_count,
+                           'skipped_files': len(skipped_files), 'total_files': len(uploads)})
 
         # Verify the PDF was created successfully
         if not os.path.exists(pdf_path):
@@ -513,6 +385,7 @@ async def convert_to_pdf(
 
         # Check PDF file size
         pdf_size = os.path.getsize(pdf_path)
+        metrics.RESPONSE_BYTES.observe(pdf_size, mode=mode)
         if pdf_size == 0:
             cleanup_temp_directory(temp_dir)
             return JSONResponse(
@@ -520,33 +393,23 @@ async def convert_to_pdf(
                 content={"error": "Generated PDF file is empty"}
             )
 
-        # Schedule cleanup of temp directory after a longer delay
-        asyncio.create_task(delayed_cleanup(
-            temp_dir, delay_seconds=600))  # 10 minutes instead of 5
-
         # Generate meaningful PDF filename based on input images
-        pdf_filename = generate_pdf_filename(file_info, len(image_list))
-        print(f"🏷️  Generated PDF filename: {pdf_filename}")
-        print(
-            f"📁 File info for filename generation: {[f['original_name'] for f in file_info]}")
+        pdf_filename = generate_pdf_filename(file_info, progress.document_count)
+        logger.debug("🏷️  Generated PDF filename: %s", pdf_filename)
 
         # Enhanced response headers with processing info for visa documentation
-        # Properly encode filename for Content-Disposition header
-        import urllib.parse
-        encoded_filename = urllib.parse.quote(pdf_filename)
-
         response_headers = {
-            "Content-Disposition": f'attachment; filename="{pdf_filename}"; filename*=UTF-8\'\'{encoded_filename}',
+            "Content-Disposition": content_disposition(pdf_filename),
             "Cache-Control": "no-cache",
-            "X-Processed-Images": str(len(image_list)),
-            "X-Total-Files": str(len(files)),
-            "X-Skipped-Files": str(len(skipped_files))
+            **progress.headers()
         }
 
+        await store_result(result_key, pdf_path, "application/pdf", response_headers)
+
         return FileResponse(
             pdf_path,
             media_type="application/pdf",
-            headers=response_headers
+            headers={**response_headers, "X-Cache": "MISS"}
         )
 
     except Exception as e:
@@ -558,7 +421,418 @@ async def convert_to_pdf(
         )
 
 
-async def delayed_cleanup(temp_dir: str, delay_seconds: int = 300):
-    """Clean up temporary directory after a delay"""
-    await asyncio.sleep(delay_seconds)
-    cleanup_temp_directory(temp_dir)
+@app.post("/jobs", status_code=202, openapi_extra={"requestBody": {
+    "required": True, "content": {"multipart/form-data": {"schema": CONVERT_FORM_SCHEMA}}}})
+async def submit_job(request: Request):
+    """Queue a conversion with the same form as /convert and return its id right away"""
+    job_id = job_manager.new_job_id()
+    job_dir = job_manager.directory(job_id)
+    # Until it is submitted, the directory belongs to no job yet
+    started = time.perf_counter()
+    with temp_janitor.holding(job_dir):
+        response = await queue_job(request, job_id, job_dir)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="jobs",
+                                    status=response.status_code)
+    return response
+
+
+async def queue_job(request: Request, job_id: str, job_dir: str):
+    # Everything goes to the job directory, so queued jobs hold no memory
+    # and survive a restart
+    try:
+        with metrics.stage("upload_read"):
+            fields, uploads = await ingest_multipart(request, job_dir, spool_bytes=0, memory_bytes=0)
+        metrics.UPLOAD_BYTES.observe(sum(upload.size for upload in uploads))
+        params = parse_convert_fields(fields)
+        # Refuse decompression bombs before any image is decoded
+        await check_pixel_budget(uploads)
+    except UploadError as e:
+        cleanup_temp_directory(job_dir)
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+
+    if not uploads:
+        cleanup_temp_directory(job_dir)
+        return JSONResponse(status_code=400, content={"error": "No files provided"})
+
+    try:
+        job = await job_manager.submit(job_id, params, uploads)
+    except JobQueueFull as e:
+        cleanup_temp_directory(job_dir)
+        return JSONResponse(status_code=503, content={"error": str(e)},
+                            headers={"Retry-After": str(config.JOB_RETRY_AFTER)})
+
+    logger.info("🧵 Queued job %s: %d files (%d waiting)", job.id, len(uploads), job_manager.queued_count)
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "state": job.state,
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+    })
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """State, per-page progress and timings of a job"""
+    job = job_manager.jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job"})
+    return job.status()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """Download the finished document of a job"""
+    job = job_manager.jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job"})
+    if job.state == 'failed':
+        return JSONResponse(status_code=409, content={"error": job.error, "state": job.state})
+    if job.state != 'complete':
+        return JSONResponse(status_code=409, content={"error": f"Job is {job.state}", "state": job.state},
+                            headers={"Retry-After": "1"})
+    if not os.path.exists(job.result["path"]):
+        return JSONResponse(status_code=410, content={"error": "Job result is no longer available"})
+    return FileResponse(job.result["path"], media_type=job.result["media_type"],
+                        headers=job.result["headers"])
+
+
+@app.post("/sessions", status_code=201, openapi_extra={"requestBody": {
+    "required": False, "content": {"multipart/form-data": {"schema": SESSION_FORM_SCHEMA}}}})
+async def open_session(request: Request):
+    """Open an upload session; its files are processed as soon as each one is uploaded"""
+    session_id = session_manager.new_session_id()
+    session_dir = session_manager.directory(session_id)
+    with temp_janitor.holding(session_dir):
+        try:
+            fields = {}
+            if request.headers.get("content-type", "").startswith("multipart/form-data"):
+                fields, _ = await ingest_multipart(request, session_dir, max_files=0)
+            params = parse_convert_fields(fields)
+            os.makedirs(session_dir, exist_ok=True)
+            session = session_manager.create(session_id, params)
+        except (UploadError, SessionLimit) as e:
+            cleanup_temp_directory(session_dir)
+            if isinstance(e, SessionLimit):
+                return JSONResponse(status_code=503, content={"error": str(e)},
+                                    headers={"Retry-After": str(config.ADMISSION_RETRY_AFTER)})
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    logger.info("📤 Opened upload session %s (%s pipeline)", session.id, params["pipeline"])
+    return JSONResponse(status_code=201, content={
+        "session_id": session.id,
+        "state": session.state,
+        "expires_in": config.SESSION_TTL,
+        "upload_url": f"/sessions/{session.id}/files/{{position}}",
+        "finalize_url": f"/sessions/{session.id}/finalize",
+        "status_url": f"/sessions/{session.id}",
+    })
+
+
+@app.put("/sessions/{session_id}/files/{position}", openapi_extra={"requestBody": {
+    "required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object", "required": ["file"],
+        "properties": {"file": {"type": "string", "format": "binary"}}}}}}})
+async def upload_session_file(session_id: str, position: int, request: Request):
+    """Upload the file at ``position`` (replacing any earlier one) and start processing it"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown session"})
+    if not 0 <= position < config.MAX_UPLOAD_FILES:
+        return JSONResponse(status_code=400, content={
+            "error": f"position must be between 0 and {config.MAX_UPLOAD_FILES - 1}"})
+    directory = session.upload_directory(position)
+    started = time.perf_counter()
+    with temp_janitor.holding(session.directory):
+        session.receiving += 1
+        try:
+            session.check_open()
+            # Straight to disk: the page is processed from there while the
+            # session waits for its other files
+            _, uploads = await ingest_multipart(request, directory, spool_bytes=0, memory_bytes=0, max_files=1,
+                                                max_request_bytes=session.remaining_bytes(position))
+            if not uploads:
+                raise UploadError("No file provided")
+            await session.receive(position, uploads[0], directory)
+        except (UploadError, SessionError) as e:
+            cleanup_temp_directory(directory)
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+        finally:
+            session.receiving -= 1
+    upload = uploads[0]
+    metrics.UPLOAD_BYTES.observe(upload.size)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="session_file", status=200)
+    logger.debug("📥 Session %s: %s at position %d (%d bytes)", session.id, upload.filename, position, upload.size)
+    return {"position": position, "filename": upload.filename, "size": upload.size, "sha256": upload.sha256,
+            "state": session.files[position].state}
+
+
+@app.delete("/sessions/{session_id}/files/{position}")
+async def delete_session_file(session_id: str, position: int):
+    """Remove the file at ``position`` from an open session"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown session"})
+    try:
+        session.check_open()
+    except SessionError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    if not session.discard(position):
+        return JSONResponse(status_code=404, content={"error": f"No file uploaded at position {position}"})
+    return session.status()
+
+
+@app.get("/sessions/{session_id}")
+async def session_status(session_id: str):
+    """Uploaded files of a session and whether their pages are ready"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown session"})
+    return session.status()
+
+
+@app.post("/sessions/{session_id}/finalize", openapi_extra={"requestBody": {
+    "required": False, "content": {"multipart/form-data": {"schema": FINALIZE_FORM_SCHEMA}}}})
+async def finalize_session(session_id: str, request: Request):
+    """Put the processed pages together in the requested order and return the PDF (or ZIP)"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown session"})
+    started = time.perf_counter()
+    with temp_janitor.holding(session.directory):
+        response = await assemble_session(request, session)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="session_finalize",
+                                    status=response.status_code)
+    return response
+
+
+async def assemble_session(request: Request, session):
+    try:
+        fields = {}
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            fields, _ = await ingest_multipart(request, session.directory, max_files=0)
+        params, order = parse_finalize_fields(session.params, fields)
+    except UploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+
+    mode = params["mode"]
+    output_path = os.path.join(session.directory, output_filename(mode))
+    try:
+        with open(output_path, "wb") as output_file:
+            progress = await session.finalize(output_file, params, order)
+    except (SessionError, ConversionError) as e:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        content = {"error": str(e)} if isinstance(e, SessionError) else e.content
+        return JSONResponse(status_code=e.status_code, content=content)
+    except Exception as e:
+        logger.error("❌ Finalizing session %s failed: %s", session.id, e)
+        return JSONResponse(status_code=500, content={"error": f"Failed to process images: {str(e)}"})
+
+    metrics.RESPONSE_BYTES.observe(os.path.getsize(output_path), mode=mode)
+    logger.info("✅ Session %s finalized: %s output with %d documented images", session.id, mode,
+                progress.processed_count,
+                extra={'mode': mode, 'processed_images': progress.processed_count,
+                       'skipped_files': len(progress.skipped_files), 'total_files': progress.total_files,
+                       'session': session.id})
+    media_type = 'application/zip' if mode == 'split' else 'application/pdf'
+    # The session directory (and with it the document) expires SESSION_TTL from now
+    touch_directory(session.directory)
+    return FileResponse(output_path, media_type=media_type, headers=document_headers(mode, progress))
+
+
+async def stream_conversion(temp_dir: str, uploads: list, params: dict, options: PageOptions,
+                            in_flight: int):
+    """
+    Send the merged PDF (or split ZIP) while it is being built.
+
+    Each page is written to an in-memory buffer and flushed to the client
+    as soon as it is finished, so nothing is stored on disk and the first
+    bytes leave after the first page.  Headers go out before the skipped
+    files are known; the final counts are served by
+    GET /convert/{conversion_id}/status.
+    """
+    mode = params["mode"]
+    conversion_id = os.path.basename(temp_dir)
+    progress = ConversionProgress(uploads)
+    if params["target_bytes"]:
+        # Every page's settings are chosen before the first one goes out
+        try:
+            progress.target = await plan_target(uploads, params, options, in_flight)
+        except BaseException:
+            cleanup_temp_directory(temp_dir)
+            raise
+    results = process_uploads(uploads, params["pipeline"], options, in_flight, progress,
+                              render=split_renderer(mode), plan=progress.target)
+
+    # Hold the response back until one page succeeded, so a batch with no
+    # usable images still gets the regular 400 error
+    first_page = first_rendered = None
+    try:
+        async for upload, result, first_rendered in results:
+            first_page = progress.record(upload, result)
+            if first_page is not None:
+                break
+    except BaseException:
+        await results.aclose()
+        cleanup_temp_directory(temp_dir)
+        raise
+    if first_page is None:
+        await results.aclose()
+        cleanup_temp_directory(temp_dir)
+        error = progress.no_pages_error()
+        return JSONResponse(status_code=error.status_code, content=error.content)
+
+    progress.state = "streaming"
+    track_conversion(conversion_id, progress)
+    sink = ChunkBuffer()
+    document = open_output_document(mode, sink, params["zip_compression"])
+
+    async def chunks():
+        try:
+            await asyncio.to_thread(document.add, first_page, first_rendered)
+            if first_rendered is not None:
+                progress.document_bytes.append(len(first_rendered))
+            yield sink.drain()
+            async for upload, result, rendered in results:
+                page = progress.record(upload, result)
+                if page is None:
+                    continue
+                await asyncio.to_thread(document.add, page, rendered)
+                if rendered is not None:
+                    progress.document_bytes.append(len(rendered))
+                # Still in use: keep the janitor's TTL from running out mid-stream
+                touch_directory(temp_dir)
+                yield sink.drain()
+            document.close()
+            yield sink.drain()
+            if mode != 'split':
+                progress.document_bytes.append(sink.size)
+            progress.state = "complete"
+            metrics.RESPONSE_BYTES.observe(sink.size, mode=mode)
+            logger.info("✅ Streamed %s output with %d documented images", mode, progress.processed_count,
+                        extra={'mode': mode, 'processed_images': progress.processed_count,
+                               'skipped_files': len(progress.skipped_files), 'total_files': len(uploads),
+                               'conversion_id': conversion_id})
+        except Exception as e:
+            logger.error("❌ Streaming conversion %s failed: %s", conversion_id, e)
+            raise
+        finally:
+            if progress.state != "complete":
+                # Failed or the client went away; the response is incomplete
+                progress.state = "failed"
+                document.abort()
+            await results.aclose()
+            cleanup_temp_directory(temp_dir)
+
+    # The page count is not final yet, name the file after the whole batch
+    filename = download_name(mode, progress, len(uploads))
+    return StreamingResponse(
+        chunks(),
+        media_type=document.media_type,
+        headers={
+            "Content-Disposition": content_disposition(filename),
+            "Cache-Control": "no-cache",
+            "X-Conversion-Id": conversion_id,
+            "X-Total-Files": str(len(uploads)),
+            "X-Cache": "MISS",
+        }
+    )
+
+
+@app.post("/batch", openapi_extra={"requestBody": {
+    "required": True, "content": {"multipart/form-data": {"schema": BATCH_FORM_SCHEMA}}}})
+async def convert_batch(request: Request):
+    """
+    Build every document of a manifest from one upload and stream them
+    back as one ZIP; files used by several documents are processed once
+    """
+    temp_dir = os.path.join(config.TEMP_ROOT, str(uuid4()))
+    started = time.perf_counter()
+    with temp_janitor.holding(temp_dir):
+        response = await run_batch(request, temp_dir)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="batch",
+                                    status=getattr(response, "status_code", 200))
+    return response
+
+
+async def run_batch(request: Request, temp_dir: str):
+    try:
+        with metrics.stage("upload_read"):
+            fields, uploads = await ingest_multipart(request, temp_dir)
+        metrics.UPLOAD_BYTES.observe(sum(upload.size for upload in uploads))
+        if not uploads:
+            raise UploadError("No files provided")
+        params, documents = parse_batch_fields(fields, uploads)
+        await check_pixel_budget(uploads)
+    except UploadError as e:
+        cleanup_temp_directory(temp_dir)
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+
+    in_flight = resolve_max_in_flight(params["max_in_flight"])
+    logger.info("📦 Received a batch of %d documents from %d files (%s pipeline, %s labels)",
+                len(documents), len(uploads), params["pipeline"], params["label_mode"])
+    report = {}
+    chunks = stream_batch(documents, params, page_options(params), in_flight, report)
+
+    # Hold the response back until a document has a page, so a batch
+    # without usable images still gets a 400 error
+    try:
+        first_chunk = await anext(chunks, None)
+    except BaseException:
+        await chunks.aclose()
+        cleanup_temp_directory(temp_dir)
+        raise
+    if first_chunk is None:
+        cleanup_temp_directory(temp_dir)
+        return JSONResponse(status_code=400, content={
+            "error": "No valid image files found in any document", "documents": report.get("documents", [])})
+
+    async def body():
+        size = len(first_chunk)
+        complete = False
+        try:
+            yield first_chunk
+            async for chunk in chunks:
+                size += len(chunk)
+                # Still in use: keep the janitor's TTL from running out mid-stream
+                touch_directory(temp_dir)
+                yield chunk
+            complete = True
+            metrics.RESPONSE_BYTES.observe(size, mode="batch")
+            logger.info("✅ Streamed a batch of %d documents", len(documents),
+                        extra={'mode': 'batch', 'documents': len(documents), 'total_files': len(uploads),
+                               'shared_files': report["shared_files"]})
+        except Exception as e:
+            logger.error("❌ Batch %s failed: %s", os.path.basename(temp_dir), e)
+            raise
+        finally:
+            if not complete:
+                await chunks.aclose()
+            cleanup_temp_directory(temp_dir)
+
+    return StreamingResponse(
+        body(),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": content_disposition("batch_documents.zip"),
+            "Cache-Control": "no-cache",
+            "X-Total-Files": str(len(uploads)),
+            "X-Batch-Documents": str(len(documents)),
+        }
+    )
+
+
+def touch_directory(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+async def store_result(key: str, path: str, media_type: str, headers: dict):
+    """Keep a finished document in the result cache; failures only cost the cache entry"""
+    try:
+        await asyncio.to_thread(
+            result_cache.put_file, key, path, {"media_type": media_type, "headers": headers})
+    except Exception as e:
+        logger.warning("Could not cache result: %s", e)
+
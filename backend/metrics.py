@@ -0,0 +1,246 @@
+"""
+Prometheus-style metrics, served as text by GET /metrics.
+
+A small in-process registry (counters, gauges, histograms with labels) so
+the web process needs no extra dependency.  Pipeline stages are timed with
+``stage(name)``; most of them run in the execution engine's worker
+processes, whose metrics this process never sees, so the page workers wrap
+their work in ``collect_stages()``, which gathers the timings instead of
+observing them.  They travel back with the page (PreparedPage.timings) and
+are observed here with ``observe_stages``.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Seconds, from a cached page to a huge scan
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bytes, 16 KiB to 1 GiB by powers of 4
+SIZE_BUCKETS = tuple(16 * 1024 * 4 ** exponent for exponent in range(9))
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of every series"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('_total', _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down; ``function`` computes it at scrape time instead"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], object]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], object]):
+        """``function`` returns the value, or with labels a {label values tuple: value} dict"""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            result = self.function()
+            values = result.items() if self.labelnames else [((), result)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [('', _format_labels(self.labelnames, key), value) for key, value in sorted(values)]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Per series: bucket counts (not cumulative), sum, count
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def samples(self):
+        with self._lock:
+            series_list = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        samples = []
+        for key, (counts, total, count) in series_list:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                samples.append(('_bucket', labels, cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'snapmerge_stage_seconds',
+    'Time spent per pipeline stage (upload_read, decode, resize, encode, label, pdf_build, compress)',
+    ('stage',)))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'snapmerge_request_seconds', 'Time until the response of a conversion request starts',
+    ('endpoint', 'status')))
+UPLOAD_BYTES = REGISTRY.register(Histogram(
+    'snapmerge_upload_bytes', 'Bytes of files uploaded per conversion request', buckets=SIZE_BUCKETS))
+RESPONSE_BYTES = REGISTRY.register(Histogram(
+    'snapmerge_response_bytes', 'Size of the PDFs and ZIPs produced', ('mode',), buckets=SIZE_BUCKETS))
+PAGES = REGISTRY.register(Counter(
+    'snapmerge_pages', 'Pages processed, by source (page cache, pipeline, or copied from a PDF)', ('source',)))
+SKIPPED_FILES = REGISTRY.register(Counter(
+    'snapmerge_skipped_files', 'Uploaded files left out of the output'))
+REJECTED_REQUESTS = REGISTRY.register(Counter(
+    'snapmerge_rejected_requests', 'Conversion requests turned away by admission control', ('status',)))
+CONVERSIONS_IN_PROGRESS = REGISTRY.register(Gauge(
+    'snapmerge_conversions_in_progress', 'Conversion requests being served'))
+JOBS = REGISTRY.register(Gauge(
+    'snapmerge_jobs', 'Background jobs by state', ('state',)))
+TEMP_BYTES = REGISTRY.register(Gauge(
+    'snapmerge_temp_bytes', 'Bytes under the temp root as of the last janitor sweep'))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    'snapmerge_startup_seconds', 'Time this process took to become ready, by phase (import, warmup, total)',
+    ('phase',)))
+FIRST_REQUEST_SECONDS = REGISTRY.register(Gauge(
+    'snapmerge_first_request_seconds', 'Time until the response of the first conversion request of this process'))
+
+_local = threading.local()
+
+
+@contextmanager
+def collect_stages():
+    """Gather the stage timings of this thread into a dict instead of observing them"""
+    timings: Dict[str, float] = {}
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def record_stage(name: str, seconds: float):
+    """Account ``seconds`` to a pipeline stage (to the collecting dict, if any)"""
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a pipeline stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def observe_stages(timings: Dict[str, float]):
+    """Record timings gathered by collect_stages (possibly in another process)"""
+    for name, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def call_collecting_stages(fn: Callable[..., Any], *args) -> Tuple[Any, Dict[str, float]]:
+    """``fn(*args)`` and the stage timings it recorded, for work run in another process"""
+    with collect_stages() as timings:
+        result = fn(*args)
+    return result, timings
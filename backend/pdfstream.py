@@ -0,0 +1,353 @@
+"""
+Incremental PDF writer.
+
+ReportLab's canvas keeps every page, including the image data on it, in
+memory until ``save()``, so merging N pages needs memory for all N of them.
+PdfStreamWriter instead writes each object to the output as soon as it is
+complete and remembers only its byte offset for the cross-reference table
+(and a digest per image, so repeated images are stored once).  The output
+only needs ``write()``; it does not have to be seekable.
+
+The writer knows just enough PDF for SnapMerge pages: pre-encoded image
+XObjects, content streams, the base-14 Helvetica font and embedded TrueType
+subsets for label text, plus pages copied from uploaded PDFs (see
+pipeline.copy_pdf_page).  Content streams are Flate-compressed as they are
+written, and small dictionaries (pages, fonts, the page tree) are packed
+into compressed object streams with a cross-reference stream (PDF 1.5), so
+no post-processing pass is needed to get a compact file.
+"""
+import functools
+import hashlib
+import zlib
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from reportlab.lib.rl_accel import fp_str
+from reportlab.pdfbase.ttfonts import (
+    FF_NONSYMBOLIC,
+    FF_SYMBOLIC,
+    SUBSETN,
+    TTFontFace,
+    makeToUnicodeCMap,
+)
+
+PDF_HEADER = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+PDF_HEADER_OBJECT_STREAMS = b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n'
+OBJECTS_PER_STREAM = 100  # Small objects buffered before an object stream is written
+PROC_SET = ['/PDF', '/Text', '/ImageB', '/ImageC', '/ImageI']
+
+
+class Ref:
+    """Reference to an indirect object"""
+    __slots__ = ('number',)
+
+    def __init__(self, number: int):
+        self.number = number
+
+
+def pdf_string(data: bytes) -> bytes:
+    """Literal string with the delimiters escaped"""
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def format_value(value) -> bytes:
+    """
+    Serialize a Python value as a PDF object.
+
+    ``str`` values are emitted verbatim, so names are written with their
+    slash ('/DCTDecode'); ``bytes`` become literal strings.
+    """
+    if isinstance(value, Ref):
+        return b'%d 0 R' % value.number
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, int):
+        return b'%d' % value
+    if isinstance(value, float):
+        return fp_str(value).encode('ascii')
+    if isinstance(value, str):
+        return value.encode('latin-1')
+    if isinstance(value, bytes):
+        return pdf_string(value)
+    if isinstance(value, (list, tuple)):
+        return b'[' + b' '.join(format_value(item) for item in value) + b']'
+    if isinstance(value, dict):
+        return b'<<' + b''.join(
+            b'/' + key.encode('latin-1') + b' ' + format_value(item) for key, item in value.items()) + b'>>'
+    raise TypeError(f"Cannot serialize {type(value).__name__} into a PDF")
+
+
+@functools.lru_cache(maxsize=4)
+def _truetype_face(path: str) -> TTFontFace:
+    return TTFontFace(path)
+
+
+class ChunkBuffer:
+    """
+    Output that collects written bytes until they are drained, for sending
+    a document over the network while it is still being written
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self.size = 0  # Bytes written so far, drained or not
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class PdfStreamWriter:
+    """Writes a PDF to ``out`` one object at a time"""
+
+    def __init__(self, out: BinaryIO, compress: bool = True, object_streams: bool = True):
+        self.compress = compress
+        self.object_streams = object_streams and compress
+        self._out = out
+        self._position = 0
+        # Where object n lives, at index n - 1: its byte offset, or
+        # (object stream number, index in it) once packed into an object stream
+        self._offsets: List[Union[None, int, Tuple[int, int]]] = []
+        self._packed: List[Tuple[int, bytes]] = []  # Objects waiting for the next object stream
+        self._page_refs: List[Ref] = []
+        self._standard_fonts: Dict[str, Ref] = {}
+        self._images: Dict[bytes, Ref] = {}  # SHA-1 of the image data -> its XObject
+        self._subset_count = 0
+        self._closed = False
+        self._catalog = self.reserve()
+        self._pages = self.reserve()
+        self._write(PDF_HEADER_OBJECT_STREAMS if self.object_streams else PDF_HEADER)
+
+    @property
+    def page_count(self) -> int:
+        return len(self._page_refs)
+
+    @property
+    def bytes_written(self) -> int:
+        return self._position
+
+    def _write(self, data: bytes):
+        self._out.write(data)
+        self._position += len(data)
+
+    def reserve(self) -> Ref:
+        """Allocate an object number to be written later"""
+        self._offsets.append(None)
+        return Ref(len(self._offsets))
+
+    def _check_open(self):
+        if self._closed:
+            raise ValueError("PDF writer is already closed")
+
+    def _begin(self, ref: Optional[Ref]) -> Ref:
+        self._check_open()
+        ref = ref or self.reserve()
+        self._offsets[ref.number - 1] = self._position
+        self._write(b'%d 0 obj\n' % ref.number)
+        return ref
+
+    def write_object(self, value, ref: Optional[Ref] = None) -> Ref:
+        if self.object_streams:
+            self._check_open()
+            ref = ref or self.reserve()
+            self._packed.append((ref.number, format_value(value)))
+            if len(self._packed) >= OBJECTS_PER_STREAM:
+                self._flush_object_stream()
+            return ref
+        ref = self._begin(ref)
+        self._write(format_value(value) + b'\nendobj\n')
+        return ref
+
+    def _flush_object_stream(self):
+        """Write the buffered small objects as one compressed object stream"""
+        packed, self._packed = self._packed, []
+        if not packed:
+            return
+        header, position = [], 0
+        for number, body in packed:
+            header.append(b'%d %d' % (number, position))
+            position += len(body) + 1
+        header = b' '.join(header) + b'\n'
+        stream = self.write_stream({'Type': '/ObjStm', 'N': len(packed), 'First': len(header)},
+                                   header + b''.join(body + b'\n' for _, body in packed))
+        for index, (number, _) in enumerate(packed):
+            self._offsets[number - 1] = (stream.number, index)
+
+    def write_stream(self, dictionary: dict, data: bytes, compress: Optional[bool] = None,
+                     ref: Optional[Ref] = None) -> Ref:
+        """Write a stream object, Flate-compressing ``data`` unless told otherwise"""
+        dictionary = dict(dictionary)
+        if self.compress if compress is None else compress:
+            data = zlib.compress(data)
+            dictionary['Filter'] = '/FlateDecode'
+        dictionary['Length'] = len(data)
+        ref = self._begin(ref)
+        self._write(format_value(dictionary) + b'\nstream\n')
+        self._write(data)
+        self._write(b'\nendstream\nendobj\n')
+        return ref
+
+    def image(self, data: bytes, width: int, height: int, color_space: str, filter_name: str,
+              bits_per_component: int = 8) -> Ref:
+        """
+        Embed already-encoded image bytes (e.g. a JPEG for DCTDecode) as an
+        image XObject; identical images share one object, like ReportLab's
+        """
+        digest = hashlib.sha1(data).digest()
+        if digest not in self._images:
+            self._images[digest] = self._write_image(data, width, height, color_space, filter_name,
+                                                     bits_per_component)
+        return self._images[digest]
+
+    def _write_image(self, data: bytes, width: int, height: int, color_space: str, filter_name: str,
+                     bits_per_component: int) -> Ref:
+        return self.write_stream({
+            'Type': '/XObject',
+            'Subtype': '/Image',
+            'Width': width,
+            'Height': height,
+            'ColorSpace': '/' + color_space,
+            'BitsPerComponent': bits_per_component,
+            'Filter': '/' + filter_name,
+        }, data, compress=False)
+
+    def standard_font(self, name: str) -> Ref:
+        """A base-14 font with WinAnsi encoding, written once per document"""
+        if name not in self._standard_fonts:
+            self._standard_fonts[name] = self.write_object({
+                'Type': '/Font',
+                'Subtype': '/Type1',
+                'BaseFont': '/' + name,
+                'Encoding': '/WinAnsiEncoding',
+            })
+        return self._standard_fonts[name]
+
+    def truetype_subset_font(self, path: str, text: str) -> Tuple[Ref, bytes]:
+        """
+        Embed the glyphs ``text`` needs from the TrueType font at ``path``.
+
+        Returns the font and ``text`` encoded for it.  Each call writes its
+        own small subset, so nothing has to be kept until the end of the
+        document; characters the font lacks (or past the 255th distinct one)
+        render as .notdef.
+        """
+        face = _truetype_face(path)
+        subset = [0]  # Code 0 is .notdef
+        codes = {}
+        for char in text:
+            code = ord(char)
+            if code not in codes and code in face.charToGlyph and len(subset) < 256:
+                codes[code] = len(subset)
+                subset.append(code)
+        encoded = bytes(codes.get(ord(char), 0) for char in text)
+
+        base_font = (SUBSETN(self._subset_count) + b'+' + face.name + face.subfontNameX).decode('latin-1')
+        self._subset_count += 1
+        font_program = face.makeSubset(subset)
+        font_file = self.write_stream({'Length1': len(font_program)}, font_program)
+        descriptor = self.write_object({
+            'Type': '/FontDescriptor',
+            'Ascent': face.ascent,
+            'CapHeight': face.capHeight,
+            'Descent': face.descent,
+            'Flags': (face.flags & ~FF_NONSYMBOLIC) | FF_SYMBOLIC,
+            'FontBBox': list(face.bbox),
+            'FontName': '/' + base_font,
+            'ItalicAngle': face.italicAngle,
+            'StemV': face.stemV,
+            'FontFile2': font_file,
+            'MissingWidth': face.defaultWidth,
+        })
+        to_unicode = self.write_stream({}, makeToUnicodeCMap(base_font, subset).encode('latin-1'))
+        font = self.write_object({
+            'Type': '/Font',
+            'Subtype': '/TrueType',
+            'BaseFont': '/' + base_font,
+            'FirstChar': 0,
+            'LastChar': len(subset) - 1,
+            'Widths': [face.getCharWidth(code) for code in subset],
+            'FontDescriptor': descriptor,
+            'ToUnicode': to_unicode,
+        })
+        return font, encoded
+
+    def add_page(self, content: bytes, width: float, height: float,
+                 images: Optional[Dict[str, Ref]] = None, fonts: Optional[Dict[str, Ref]] = None) -> Ref:
+        """Write a page whose content stream uses the given image and font resources"""
+        resources = {'ProcSet': PROC_SET}
+        if images:
+            resources['XObject'] = dict(images)
+        if fonts:
+            resources['Font'] = dict(fonts)
+        contents = self.write_stream({}, content)
+        page = self.write_object({
+            'Type': '/Page',
+            'Parent': self._pages,
+            'MediaBox': [0, 0, width, height],
+            'Resources': resources,
+            'Contents': contents,
+        })
+        self._page_refs.append(page)
+        return page
+
+    def add_existing_page(self, page: dict) -> Ref:
+        """
+        Write a page dictionary taken from another document, whose
+        resources and contents were already written; only its place in the
+        page tree changes
+        """
+        ref = self.write_object({**page, 'Type': '/Page', 'Parent': self._pages})
+        self._page_refs.append(ref)
+        return ref
+
+    def close(self):
+        """Write the page tree, catalog and cross-reference table"""
+        if self._closed:
+            return
+        self.write_object({'Type': '/Pages', 'Count': len(self._page_refs), 'Kids': self._page_refs},
+                          ref=self._pages)
+        self.write_object({'Type': '/Catalog', 'Pages': self._pages}, ref=self._catalog)
+        info = self.write_object({'Producer': b'SnapMerge'})
+        trailer = {'Root': self._catalog, 'Info': info}
+        if self.object_streams:
+            self._flush_object_stream()
+            self._write_xref_stream(trailer)
+        else:
+            self._write_xref_table(trailer)
+        self._closed = True
+
+    def _write_xref_table(self, trailer: dict):
+        xref_offset = self._position
+        lines = [b'xref\n0 %d\n' % (len(self._offsets) + 1), b'0000000000 65535 f \n']
+        lines.extend(b'%010d 00000 n \n' % offset for offset in self._offsets)
+        self._write(b''.join(lines))
+        self._write(b'trailer\n' + format_value({'Size': len(self._offsets) + 1, **trailer})
+                    + b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset)
+
+    def _write_xref_stream(self, trailer: dict):
+        xref = self.reserve()
+        xref_offset = self._position
+        self._offsets[xref.number - 1] = xref_offset
+        # Fields: entry type, offset (or object stream number), generation (or index)
+        width = max(4, (xref_offset.bit_length() + 7) // 8)
+        rows = [b'\x00' + bytes(width) + b'\xff\xff']
+        for location in self._offsets:
+            if isinstance(location, tuple):
+                rows.append(b'\x02' + location[0].to_bytes(width, 'big') + location[1].to_bytes(2, 'big'))
+            else:
+                rows.append(b'\x01' + location.to_bytes(width, 'big') + b'\x00\x00')
+        self.write_stream({
+            'Type': '/XRef',
+            'Size': len(self._offsets) + 1,
+            'W': [1, width, 2],
+            **trailer,
+        }, b''.join(rows), ref=xref)
+        self._write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
@@ -0,0 +1,1410 @@
+"""
+Image and PDF processing stages for SnapMerge.
+
+Everything in this module is synchronous and CPU-bound.  It deliberately does
+not import FastAPI so that the execution engine's worker processes can import
+it cheaply; the web layer in main.py hands work to these functions through
+executor.engine.
+"""
+import functools
+import hashlib
+import io
+import logging
+import os
+import time
+import warnings
+import zipfile
+import zlib
+from dataclasses import asdict, dataclass, field, replace
+from typing import BinaryIO, Iterable, List, Optional, Tuple, Union
+
+import PyPDF2
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont
+from reportlab import rl_config
+from reportlab.lib.colors import HexColor
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.rl_accel import fp_str
+from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfdoc, pdfmetrics, pdfutils
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+import config
+from metrics import collect_stages, record_stage, stage
+from pdfstream import PdfStreamWriter, Ref, pdf_string
+
+logger = logging.getLogger('snapmerge.pipeline')
+
+# Decompression-bomb guard: Pillow refuses to open images with more pixels
+# than this (it only warns up to twice the limit; make that an error too)
+Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS or None
+warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+# ASCII85-wrapping binary streams only makes the PDF 25% bigger; every reader
+# we care about handles raw binary streams.
+rl_config.useA85 = 0
+
+LABEL_MARGIN = 80  # Height of the filename band under each image
+LABEL_MIN_WIDTH = 800  # Ensure minimum width for text
+LABEL_MIN_FONT_SIZE = 12
+LABEL_FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/System/Library/Fonts/Helvetica.ttc",
+)
+
+# Label modes: 'raster' draws the filename into the page bitmap (historical
+# output); 'vector' draws it as real PDF text under the image
+LABEL_MODES = ('raster', 'vector')
+VECTOR_LABEL_FONT_NAME = 'SnapMergeLabel'
+
+# Color modes: 'auto' classifies every page and encodes grayscale pages as
+# gray JPEG and black-and-white pages as 1-bit images; 'color' keeps RGB
+COLOR_MODES = ('auto', 'color')
+# Page classes and the image mode each is encoded in
+PAGE_CLASSES = {'RGB': 'color', 'L': 'gray', '1': 'bilevel'}
+# The classifier looks at every CLASSIFY_SAMPLE_STEP-th pixel in each direction
+CLASSIFY_SAMPLE_STEP = 2
+# A pixel is colored when its channels differ by more than this (tinted or
+# yellowed paper stays below it); a page with at most GRAY_MAX_COLOR_FRACTION
+# colored pixels is grayscale.  A ballpoint signature is above that.
+GRAY_CHROMA_THRESHOLD = 48
+GRAY_MAX_COLOR_FRACTION = 0.0005
+# A grayscale page is bilevel when ink and paper separate cleanly: Otsu's
+# between-class share of the variance is at least this (text scans score
+# 0.84-0.98, photographs and gradients 0.65-0.75)...
+BILEVEL_MIN_SEPARABILITY = 0.8
+# ...and few pixels are mid-tones (anti-aliased text edges stay below this)
+BILEVEL_MAX_MIDTONE_FRACTION = 0.25
+BILEVEL_MIDTONES = (48, 208)
+
+# Split-mode archive entry compression
+ZIP_COMPRESSIONS = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED}
+
+# Oversized images are first shrunk by cheap integer factors while the result
+# stays at least this many times the final size, so the LANCZOS pass that
+# follows keeps its quality (the same trade-off as Pillow's thumbnail())
+DECODE_REDUCING_GAP = 2.0
+
+# target_bytes: the page settings the size search may choose from, best
+# first, as (scale of the page box, JPEG quality).  Each step is smaller than
+# the one before for typical photos and scans; quality drops before
+# resolution does
+TARGET_LADDER = (
+    (1.0, 90), (1.0, 80), (1.0, 70), (1.0, 60), (1.0, 50), (1.0, 40),
+    (0.75, 45), (0.75, 35), (0.5, 40), (0.5, 30), (0.35, 30), (0.25, 25),
+)
+# Bytes a merged PDF needs besides the page images and labels: per document
+# (header, catalog, page tree, info, xref) and per page (page object, content
+# stream, image dictionaries, vector label text)
+TARGET_DOCUMENT_OVERHEAD = 2048
+TARGET_PAGE_OVERHEAD = 1024
+
+# PDF readers look for the %PDF- header this far into the file
+PDF_HEADER_SEARCH_BYTES = 1024
+# Page entries not carried over when a page is copied out of an uploaded PDF:
+# tree links, annotations (links and form fields point back into the source
+# document), article beads, thumbnails and structure-tree back references
+PDF_PAGE_SKIPPED_KEYS = ('/Parent', '/Annots', '/B', '/Thumb', '/StructParents')
+
+
+@dataclass(frozen=True)
+class PageOptions:
+    """Processing parameters shared by every page of one conversion request"""
+    max_width: int = 800
+    max_height: int = 1200
+    quality: int = 60
+    label_mode: str = 'raster'
+    color_mode: str = 'color'
+
+
+def reduce_for_decode(img: Image.Image, target_size: Tuple[int, int]) -> Tuple[Image.Image, int]:
+    """
+    Shrink an image as cheaply as possible before the final high-quality resample.
+
+    JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale (DCT scaling via draft
+    mode), so the full-size bitmap is never allocated; other formats are
+    box-reduced by an integer factor after decoding.  Either way the result
+    stays at least DECODE_REDUCING_GAP times the target size.  Returns the
+    reduced image and the overall reduction factor (1 = full resolution).
+    """
+    width, height = img.size
+    floor_width = max(1, int(target_size[0] * DECODE_REDUCING_GAP))
+    floor_height = max(1, int(target_size[1] * DECODE_REDUCING_GAP))
+
+    if img.format == 'JPEG':
+        # Only has an effect before the image data is loaded
+        img.draft(None, (floor_width, floor_height))
+
+    factor = min(img.width // floor_width, img.height // floor_height)
+    if factor >= 2:
+        try:
+            img = img.reduce(factor)
+        except ValueError:
+            pass  # Mode without reduce() support (e.g. palette); resample as-is
+
+    return img, max(1, round(width / img.width))
+
+
+def flatten_to_rgb(img: Image.Image) -> Image.Image:
+    """Convert to RGB, putting transparent images on a white background"""
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # Create white background for transparent images
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()
+                         [-1] if img.mode in ('RGBA', 'LA') else None)
+        return background
+    return img.convert('RGB')
+
+
+def resize_for_pdf(img: Image.Image, max_width: int = 800, max_height: int = 1200) -> Image.Image:
+    """
+    Flatten image to RGB and shrink it to fit the page box, without encoding it.
+
+    The reduction factor used while decoding is stored in img.info['decode_scale'].
+    """
+    # Calculate new dimensions maintaining aspect ratio
+    width, height = img.size
+    needs_resize = width > max_width or height > max_height
+    decode_scale = 1
+
+    with stage('decode'):
+        if needs_resize:
+            # Calculate scaling factor
+            width_ratio = max_width / width
+            height_ratio = max_height / height
+            scale_factor = min(width_ratio, height_ratio)
+
+            new_width = int(width * scale_factor)
+            new_height = int(height * scale_factor)
+
+            # Decode at reduced resolution before anything touches the pixels
+            img, decode_scale = reduce_for_decode(img, (new_width, new_height))
+        img.load()
+
+    with stage('resize'):
+        img = flatten_to_rgb(img)
+
+        # Only resize if image is larger than max dimensions
+        if needs_resize:
+            # Use LANCZOS for high-quality resizing
+            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            logger.debug("📏 Resized from %dx%d to %dx%d (decoded at 1/%d)",
+                         width, height, new_width, new_height, decode_scale)
+
+    img.info['decode_scale'] = decode_scale
+    return img
+
+
+def optimize_image_for_pdf(img: Image.Image, max_width: int = 800, max_height: int = 1200, quality: int = 65) -> Image.Image:
+    """
+    Optimize image for PDF to reduce file size while maintaining quality for visa documents
+    """
+    img = resize_for_pdf(img, max_width=max_width, max_height=max_height)
+
+    # Apply additional compression by reducing quality slightly
+    # Save to bytes buffer with compression
+    buffer = io.BytesIO()
+    with stage('encode'):
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    buffer.seek(0)
+
+    # Load back the compressed image
+    compressed_img = Image.open(buffer)
+    compressed_img.info['decode_scale'] = img.info['decode_scale']
+
+    return compressed_img
+
+
+def otsu_threshold(histogram: List[int]) -> Tuple[int, float]:
+    """
+    Otsu's threshold of a 256-bin histogram and its separability: the share
+    of the total variance between the two classes (1.0 = two pure levels)
+    """
+    total = sum(histogram)
+    total_sum = sum(level * count for level, count in enumerate(histogram))
+    mean = total_sum / total
+    variance = sum(count * (level - mean) ** 2 for level, count in enumerate(histogram)) / total
+    if not variance:
+        return 128, 1.0
+    best_threshold, best_between = 128, 0.0
+    dark, dark_sum = 0, 0
+    for level, count in enumerate(histogram[:-1]):
+        dark += count
+        dark_sum += level * count
+        if dark == 0 or dark == total:
+            continue
+        dark_mean = dark_sum / dark
+        light_mean = (total_sum - dark_sum) / (total - dark)
+        between = dark * (total - dark) * (dark_mean - light_mean) ** 2 / total ** 2
+        if between > best_between:
+            best_threshold, best_between = level, between
+    return best_threshold, best_between / variance
+
+
+def classify_page(img: Image.Image) -> Tuple[str, int]:
+    """
+    Classify an RGB page as 'color', 'gray' or 'bilevel' from a subsample of
+    its pixels, using only Pillow's C operations (channel spread and
+    histograms), so it costs a millisecond or two next to the decode.
+    Returns the class and, for bilevel pages, the ink/paper threshold.
+    """
+    sample = img.resize((max(1, img.width // CLASSIFY_SAMPLE_STEP), max(1, img.height // CLASSIFY_SAMPLE_STEP)),
+                        Image.Resampling.NEAREST)
+    pixels = sample.width * sample.height
+    red, green, blue = sample.split()
+    chroma = ImageChops.subtract(ImageChops.lighter(ImageChops.lighter(red, green), blue),
+                                 ImageChops.darker(ImageChops.darker(red, green), blue))
+    if sum(chroma.histogram()[GRAY_CHROMA_THRESHOLD + 1:]) > pixels * GRAY_MAX_COLOR_FRACTION:
+        return 'color', 0
+    histogram = sample.convert('L').histogram()
+    threshold, separability = otsu_threshold(histogram)
+    midtones = sum(histogram[BILEVEL_MIDTONES[0]:BILEVEL_MIDTONES[1]])
+    if separability >= BILEVEL_MIN_SEPARABILITY and midtones <= pixels * BILEVEL_MAX_MIDTONE_FRACTION:
+        return 'bilevel', threshold
+    return 'gray', 0
+
+
+def encode_page_image(img: Image.Image, quality: int, color_mode: str = 'color') -> Tuple[bytes, str, str]:
+    """
+    Encode a resized RGB page for embedding; returns (data, mode, encoding).
+
+    With color_mode 'auto', grayscale pages become gray JPEGs and bilevel
+    pages 1-bit rows, Flate-compressed (PDF's own 1-bit layout: rows padded
+    to whole bytes, 1 = white, exactly Pillow's '1' mode).
+    """
+    page_class, threshold = 'color', 0
+    if color_mode == 'auto':
+        with stage('classify'):
+            page_class, threshold = classify_page(img)
+    with stage('encode'):
+        if page_class == 'bilevel':
+            bits = img.convert('L').point(lambda level: 255 if level > threshold else 0, '1')
+            return zlib.compress(bits.tobytes()), '1', 'flate'
+        if page_class == 'gray':
+            img = img.convert('L')
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        return buffer.getvalue(), img.mode, 'jpeg'
+
+
+def _resolve_label_font_path() -> Optional[str]:
+    """Pick the first usable label font; resolved once per process at import"""
+    for path in LABEL_FONT_CANDIDATES:
+        try:
+            ImageFont.truetype(path, LABEL_MIN_FONT_SIZE)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+LABEL_FONT_PATH = _resolve_label_font_path()
+
+
+@functools.lru_cache(maxsize=64)
+def load_label_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Load a TrueType font once per (path, size) for the whole process"""
+    return ImageFont.truetype(path, size)
+
+
+def fit_label_font(draw: ImageDraw.ImageDraw, text: str, width: int, max_width: int):
+    """
+    Return (font, text_width, text_height) for the largest label font that fits.
+
+    Font sizes start from the band width and step down by 2 points to the
+    minimum; widths grow with size, so the largest size that fits is found by
+    binary search instead of measuring every step.  Text that does not fit
+    even at the smallest size uses the smallest size.
+    """
+    if LABEL_FONT_PATH is None:
+        font = ImageFont.load_default()
+        bbox = draw.textbbox((0, 0), text, font=font)
+        return font, bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    # Adjust font size based on image width while ensuring readability
+    start_size = min(32, max(18, width // 50))
+    sizes = [start_size]
+    while sizes[-1] > LABEL_MIN_FONT_SIZE:
+        sizes.append(sizes[-1] - 2)
+
+    def measure(size):
+        font = load_label_font(LABEL_FONT_PATH, size)
+        bbox = draw.textbbox((0, 0), text, font=font)
+        return font, bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    # First index in `sizes` (largest size) whose text fits
+    best = measure(sizes[0])
+    if best[1] <= max_width:
+        return best
+    low, high = 1, len(sizes) - 1
+    best = None
+    while low <= high:
+        mid = (low + high) // 2
+        candidate = measure(sizes[mid])
+        if candidate[1] <= max_width:
+            best = candidate
+            high = mid - 1
+        else:
+            low = mid + 1
+    return best if best is not None else measure(sizes[-1])
+
+
+def render_label_strip(width: int, filename: str) -> Image.Image:
+    """Render the white band with the filename that goes under each image"""
+
+    margin = LABEL_MARGIN
+    horizontal_padding = 30  # Equal padding from both sides
+
+    # Create the band with white background
+    strip = Image.new('RGB', (width, margin), 'white')
+
+    # Draw text
+    draw = ImageDraw.Draw(strip)
+
+    # Prepare text with filename only
+    clean_filename = os.path.splitext(filename)[0]  # Remove extension
+    text = clean_filename
+
+    # Shrink the font if the text is too wide for the band
+    max_width = width - (2 * horizontal_padding)
+    font, text_width, text_height = fit_label_font(draw, text, width, max_width)
+
+    # Calculate position to center the text
+    x = (width - text_width) // 2  # Center horizontally
+    y = (margin - text_height) // 2  # Center vertically in the band
+
+    # Rasterize the glyphs once as a coverage mask and stamp it for the
+    # shadow layers and the main text, instead of rendering it three times
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    glyphs = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(glyphs).text((-left, -top), text, font=font, fill=255)
+
+    # Draw text with professional styling
+    # Enhanced shadow effect for better readability
+    shadow_offset = 2
+    shadow_color = ImageColor.getrgb('#BBBBBB')  # Slightly lighter shadow for professional look
+
+    # Draw shadow with multiple layers for depth
+    for offset in range(shadow_offset):
+        strip.paste(shadow_color, (x + left + offset, y + top + offset), glyphs)
+
+    # Draw main text with professional styling
+    strip.paste(ImageColor.getrgb('#1A365D'),  # Rich navy blue for professional look
+                (x + left, y + top), glyphs)
+
+    return strip
+
+
+def add_filename_to_image(img: Image.Image, filename: str, page_number: int) -> Image.Image:
+    """Add professional filename label under the image for visa documentation"""
+
+    # Calculate new image size with space for text
+    new_width = max(img.width, LABEL_MIN_WIDTH)  # Ensure minimum width for text
+    new_height = img.height + LABEL_MARGIN
+
+    # Create new image with white background
+    new_img = Image.new('RGB', (new_width, new_height), 'white')
+
+    # Calculate position to center the original image
+    x_offset = (new_width - img.width) // 2
+    new_img.paste(img, (x_offset, 0))
+
+    # Label band goes directly under the image
+    new_img.paste(render_label_strip(new_width, filename), (0, img.height))
+
+    return new_img
+
+
+def labeled_box_layout(width: int, height: int) -> Tuple[float, float, float, int]:
+    """
+    Fit an image of width x height pixels plus its label band onto the page.
+
+    Returns (points per pixel, box x, box y, box width in pixels); the box is
+    the same one add_filename_to_image rasterizes into a single bitmap.
+    """
+    page_width, page_height = A4
+    margin = 0.5 * inch  # 0.5 inch margins
+    usable_width = page_width - (2 * margin)
+    usable_height = page_height - (2 * margin)
+
+    box_width = max(width, LABEL_MIN_WIDTH)
+    box_height = height + LABEL_MARGIN
+    scale = min(usable_width / box_width, usable_height / box_height)
+    x_offset = margin + (usable_width - box_width * scale) / 2
+    y_offset = margin + (usable_height - box_height * scale) / 2
+    return scale, x_offset, y_offset, box_width
+
+
+@functools.lru_cache(maxsize=None)
+def vector_label_font() -> str:
+    """Register the label font for non-Latin filenames once per process and return its name"""
+    if LABEL_FONT_PATH is not None:
+        try:
+            # Embedded (subset) TrueType keeps non-Latin filenames readable
+            pdfmetrics.registerFont(TTFont(VECTOR_LABEL_FONT_NAME, LABEL_FONT_PATH))
+            return VECTOR_LABEL_FONT_NAME
+        except Exception:
+            pass
+    return 'Helvetica'
+
+
+def vector_label_layout(filename: str, x: float, y: float, box_width: int, scale: float):
+    """
+    Size and place the filename text for the label band of a labeled box.
+
+    Sizes follow render_label_strip in pixel units and are converted with
+    ``scale`` (points per pixel).  Text width is linear in font size, so a
+    single measurement picks the largest size that fits.  Returns
+    (text, font name, font size in points, center x, baseline y).
+    """
+    text = os.path.splitext(filename)[0]  # Remove extension
+    try:
+        # Base-14 Helvetica needs no embedded font program at all
+        text.encode('cp1252')
+        font_name = 'Helvetica'
+    except UnicodeEncodeError:
+        font_name = vector_label_font()
+
+    max_width = box_width - 60  # Equal 30px padding from both sides
+    font_size = min(32, max(18, box_width // 50))
+    width_per_point = pdfmetrics.stringWidth(text, font_name, 1)
+    while width_per_point * font_size > max_width and font_size > LABEL_MIN_FONT_SIZE:
+        font_size -= 2
+    font_size_pt = font_size * scale
+
+    # Center the glyphs vertically in the band
+    ascent, descent = pdfmetrics.getAscentDescent(font_name, font_size_pt)
+    baseline = y + (LABEL_MARGIN * scale - (ascent + descent)) / 2
+    center = x + box_width * scale / 2
+    return text, font_name, font_size_pt, center, baseline
+
+
+def draw_vector_label(c: canvas.Canvas, filename: str, x: float, y: float, box_width: int, scale: float):
+    """Draw the filename as PDF text in the label band of a labeled box"""
+    text, font_name, font_size_pt, center, baseline = vector_label_layout(filename, x, y, box_width, scale)
+
+    c.saveState()
+    c.setFont(font_name, font_size_pt)
+    # Light shadow one pixel down-right, then the navy text on top
+    c.setFillColor(HexColor('#BBBBBB'))
+    c.drawCentredString(center + scale, baseline - scale, text)
+    c.setFillColor(HexColor('#1A365D'))
+    c.drawCentredString(center, baseline, text)
+    c.restoreState()
+
+
+def create_professional_pdf(image_list: List[Image.Image], pdf_path: str, file_info: List[dict],
+                            options: PageOptions = PageOptions()):
+    """
+    Create a professional PDF using ReportLab for consulate documents.
+
+    With raster labels the images already carry their label band; with
+    vector labels the filename from file_info is drawn as text under each
+    image instead.
+    """
+
+    started = time.perf_counter()
+
+    # A4 page dimensions in points (1 point = 1/72 inch)
+    page_width, page_height = A4
+    margin = 0.5 * inch  # 0.5 inch margins
+    usable_width = page_width - (2 * margin)
+    usable_height = page_height - (2 * margin)
+
+    # Create the PDF canvas; content streams are compressed as they are
+    # written, so there is no compress_pdf re-parse afterwards
+    c = canvas.Canvas(pdf_path, pagesize=A4, pageCompression=1)
+
+    # Set PDF metadata for official documents
+    # c.setTitle("Immigration Visa Documents")
+    # c.setAuthor("SnapMerge Document Converter")
+    # c.setSubject("Official Immigration Documentation")
+    # c.setKeywords("visa, immigration, documents, official")
+
+    for i, img in enumerate(image_list):
+        if i > 0:  # Add new page for each image after the first
+            c.showPage()
+
+        # Convert PIL image to bytes for ReportLab with compression
+        img_buffer = io.BytesIO()
+        # Use JPEG with lower quality for smaller file size
+        img.save(img_buffer, format='JPEG', quality=70, optimize=True)
+        img_buffer.seek(0)
+
+        # Create ImageReader object
+        img_reader = ImageReader(img_buffer)
+
+        if options.label_mode == 'vector':
+            # Same box as the raster band would occupy, label drawn as text
+            img_width_px, img_height_px = img.size
+            scale, box_x, box_y, box_width = labeled_box_layout(img_width_px, img_height_px)
+            c.drawImage(
+                img_reader,
+                box_x + ((box_width - img_width_px) // 2) * scale,
+                box_y + LABEL_MARGIN * scale,
+                width=img_width_px * scale,
+                height=img_height_px * scale,
+            )
+            draw_vector_label(c, file_info[i]['original_name'], box_x, box_y, box_width, scale)
+            continue
+
+        # Calculate scaling to fit page while maintaining aspect ratio
+        img_width_px, img_height_px = img.size
+
+        # Calculate the maximum size that fits on the page
+        scale_w = usable_width / img_width_px
+        scale_h = usable_height / img_height_px
+        # Use the smaller scale to fit both dimensions
+        scale = min(scale_w, scale_h)
+
+        # Calculate final dimensions
+        final_width = img_width_px * scale
+        final_height = img_height_px * scale
+
+        # Center the image on the page
+        x_offset = margin + (usable_width - final_width) / 2
+        y_offset = margin + (usable_height - final_height) / 2
+
+        # Draw the image at high resolution
+        c.drawImage(
+            img_reader,
+            x_offset,
+            y_offset,
+            width=final_width,
+            height=final_height,
+            preserveAspectRatio=True,
+            anchor='c'
+        )
+
+        # Add professional header
+        # c.setFont("Helvetica-Bold", 12)
+        # c.drawString(margin, page_height - 30, "OFFICIAL IMMIGRATION DOCUMENT")
+
+        # Add page number and document info
+        # c.setFont("Helvetica", 10)
+        # page_info = f"Page {i + 1} of {len(image_list)}"
+        # if i < len(file_info):
+        #     page_info += f" - {file_info[i]['original_name']}"
+
+        # c.drawRightString(page_width - margin, page_height - 30, page_info)
+
+        # Add footer with timestamp and system info
+        c.setFont("Helvetica", 8)
+        from datetime import datetime
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S UTC")
+        # footer_text = f"Generated by SnapMerge on {timestamp} - High Resolution: 300 DPI"
+
+        # Calculate centered position for footer text
+        # text_width = c.stringWidth(footer_text, "Helvetica", 8)
+        # footer_x = (page_width - text_width) / 2
+        # c.drawString(footer_x, 20, footer_text)
+
+        # Add quality assurance note
+        # c.setFont("Helvetica", 7)
+        # quality_note = "This document maintains original image quality and resolution for official use"
+
+        # # Calculate centered position for quality note
+        # quality_width = c.stringWidth(quality_note, "Helvetica", 7)
+        # quality_x = (page_width - quality_width) / 2
+        # c.drawString(quality_x, 10, quality_note)
+
+    # Save the PDF with compression
+    c.save()
+    record_stage('pdf_build', time.perf_counter() - started)
+
+    logger.debug("✅ Compressed PDF created: %d pages optimized for small file size", len(image_list))
+
+
+def compress_pdf(pdf_path: str):
+    """
+    Compress PDF file to reduce size.
+
+    The PDF writers compress as they write now; this re-parse is kept for
+    callers that post-process PDFs from elsewhere.
+    """
+    started = time.perf_counter()
+    try:
+        # Read the original PDF
+        with open(pdf_path, 'rb') as file:
+            reader = PyPDF2.PdfReader(file)
+            writer = PyPDF2.PdfWriter()
+
+            # Copy pages with compression
+            for page in reader.pages:
+                # Remove unnecessary data and compress
+                page.compress_content_streams()
+                writer.add_page(page)
+
+            # Set compression options
+            # writer.add_metadata({
+            #     '/Title': 'Immigration Visa Documents - Compressed',
+            #     '/Subject': 'Official Immigration Documentation',
+            #     '/Creator': 'SnapMerge Document Converter'
+            # })
+
+            # Write compressed PDF
+            temp_path = pdf_path + '.tmp'
+            with open(temp_path, 'wb') as output_file:
+                writer.write(output_file)
+
+        # Replace original with compressed version
+        import shutil
+        shutil.move(temp_path, pdf_path)
+        logger.debug("📦 PDF compressed successfully")
+
+    except Exception as e:
+        logger.warning("⚠️  PDF compression failed: %s", e)
+        # If compression fails, continue with original PDF
+    record_stage('compress', time.perf_counter() - started)
+
+
+def open_upload(source: Union[str, bytes], frame: int = 0) -> Image.Image:
+    """Open an upload from its file path or, if it was kept in memory, its bytes"""
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if frame:
+        img.seek(frame)
+    return img
+
+
+def image_frame_count(img: Image.Image) -> int:
+    """
+    Pages an image contributes: one per frame of a multi-page TIFF, else
+    one (animated GIFs and the depth frames of MPO photos are not pages)
+    """
+    return getattr(img, 'n_frames', 1) if img.format == 'TIFF' else 1
+
+
+def header_pixels(source: Union[str, bytes]) -> int:
+    """
+    Pixels the image will decode to, read from its headers only (every
+    frame of a multi-page TIFF); 0 when the upload is not an image Pillow
+    will open (PDFs are never decoded, anything else is skipped later)
+    """
+    try:
+        with open_upload(source) as img:
+            pixels = 0
+            for frame in range(image_frame_count(img)):
+                img.seek(frame)
+                pixels += img.width * img.height
+            return pixels
+    except Exception:
+        return 0
+
+
+def upload_dimensions(source: Union[str, bytes]) -> dict:
+    """
+    Size and page count of an upload from its headers alone: pixels of
+    the first frame for images, points of the first page for PDFs
+    """
+    if is_pdf(source):
+        sizes = pdf_page_sizes(source)
+        return {'width': sizes[0][0], 'height': sizes[0][1], 'pages': len(sizes)}
+    with open_upload(source) as img:
+        return {'width': img.width, 'height': img.height, 'pages': image_frame_count(img)}
+
+
+def make_thumbnail(source: Union[str, bytes], max_size: int, quality: int = config.THUMBNAIL_QUALITY) -> dict:
+    """
+    A small JPEG of an image upload (the first frame of a TIFF), no side
+    longer than ``max_size``.  JPEGs are decoded directly at 1/2 to 1/8
+    scale and other formats box-reduced before the final resample, so the
+    full-size bitmap is never needed.  Returns the JPEG bytes with the
+    upload's dimensions and page count, the thumbnail's dimensions and the
+    stage timings.
+    """
+    with collect_stages() as timings, stage('thumbnail'), open_upload(source) as img:
+        width, height = img.size
+        pages = image_frame_count(img)
+        if img.mode in ('P', '1'):
+            # Would only get a nearest-neighbour resample
+            img = flatten_to_rgb(img)
+        # Pillow's thumbnail() does the draft-mode decode and reduce() itself
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=DECODE_REDUCING_GAP)
+        thumbnail = flatten_to_rgb(img)
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format='JPEG', quality=quality)
+    return {'data': buffer.getvalue(), 'width': width, 'height': height, 'pages': pages,
+            'thumbnail_width': thumbnail.width, 'thumbnail_height': thumbnail.height, 'timings': timings}
+
+
+def is_pdf(source: Union[str, bytes]) -> bool:
+    """Whether the upload is a PDF; readers accept the header anywhere in the first 1 KiB"""
+    if isinstance(source, bytes):
+        head = source[:PDF_HEADER_SEARCH_BYTES]
+    else:
+        with open(source, 'rb') as f:
+            head = f.read(PDF_HEADER_SEARCH_BYTES)
+    return b'%PDF-' in head
+
+
+def inspect_upload(source: Union[str, bytes]) -> Tuple[str, int]:
+    """
+    ('pdf', 0) for a PDF, otherwise ('image', pages) from the image header.
+    Unreadable uploads count as one image page, so processing them reports
+    the usual error.
+    """
+    if is_pdf(source):
+        return 'pdf', 0
+    try:
+        with open_upload(source) as img:
+            return 'image', image_frame_count(img)
+    except Exception:
+        return 'image', 1
+
+
+def process_image_file(source: Union[str, bytes], filename: str, page_number: int,
+                       options: PageOptions = PageOptions(), frame: int = 0) -> Image.Image:
+    """Decode, optimize and label a single uploaded image (or one TIFF frame), ready for the PDF"""
+    img = open_upload(source, frame)
+    original_size = img.size
+    logger.debug("🖼️  Original image: %s pixels, mode: %s", img.size, img.mode)
+
+    # Optimize image for PDF (resize + compress)
+    img = optimize_image_for_pdf(
+        img, max_width=options.max_width, max_height=options.max_height, quality=options.quality)
+    logger.debug("✅ Optimized: %s → %s pixels", original_size, img.size)
+
+    if options.label_mode == 'vector':
+        # The label is drawn as text by create_professional_pdf
+        return img
+
+    # Add professional filename label for visa documentation
+    with stage('label'):
+        img_with_label = add_filename_to_image(img, filename, page_number)
+    img_with_label.info['decode_scale'] = img.info['decode_scale']
+    logger.debug("📝 Added professional filename label")
+
+    return img_with_label
+
+
+@dataclass
+class PreparedPage:
+    """A page whose image is already encoded and only needs embedding into a PDF"""
+    filename: str
+    image_data: bytes  # JPEG (DCT) bytes, or Flate-compressed 1-bit rows; embedded as-is
+    width: int
+    height: int
+    mode: str  # 'RGB', 'L' (gray) or '1' (bilevel), see PAGE_CLASSES
+    encoding: str  # 'jpeg', 'flate' (1-bit), or 'passthrough' when the upload's own JPEG bytes are reused
+    label_data: bytes  # zlib-compressed RGB pixels of the filename band (raster labels only)
+    label_width: int
+    decode_scale: int = 1  # Resolution reduction applied while decoding
+    label_mode: str = 'raster'
+    label_in_image: bool = False  # Raster band already part of image_data (legacy pipeline)
+    # Seconds per pipeline stage spent preparing the page (see metrics.collect_stages)
+    timings: dict = field(default_factory=dict, compare=False)
+
+
+def page_fields(page: PreparedPage) -> dict:
+    """
+    Everything of ``page`` but its bytes, plus the image's length: stored
+    next to a file of the image and label bytes (the stage timings describe
+    the run that produced the page, not the page)
+    """
+    fields = {name: value for name, value in asdict(page).items()
+              if name not in ('image_data', 'label_data', 'timings')}
+    fields['image_bytes'] = len(page.image_data)
+    return fields
+
+
+def _passthrough_jpeg(img: Image.Image, source: Union[str, bytes], max_width: int, max_height: int):
+    """Return the upload's bytes if they can go into the PDF untouched, else None"""
+    if img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+        return None
+    if img.width > max_width or img.height > max_height:
+        return None
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    try:
+        # Same parser ReportLab uses for DCT images; rejects exotic SOF types
+        pdfutils.readJPEGInfo(io.BytesIO(data))
+    except Exception:
+        return None
+    return data
+
+
+def prepare_page_variants(source: Union[str, bytes], filename: str, options: PageOptions,
+                          frame: int, qualities: Iterable[int]) -> List[PreparedPage]:
+    """
+    The single-encode page at each of ``qualities`` from one decode; what
+    prepare_page returns for ``options`` with that quality.  A JPEG that is
+    passed through is the same page at every quality.
+    """
+    qualities = list(qualities)
+    img = open_upload(source, frame)
+    logger.debug("🖼️  Original image: %s pixels, mode: %s", img.size, img.mode)
+
+    data = _passthrough_jpeg(img, source, options.max_width, options.max_height)
+    decode_scale = 1
+    if data is not None:
+        encodings = [(data, img.mode, 'passthrough')] * len(qualities)
+        width, height = img.width, img.height
+        logger.debug("⏩ Reusing original JPEG data")
+    else:
+        img = resize_for_pdf(img, max_width=options.max_width, max_height=options.max_height)
+        encodings = [encode_page_image(img, quality, options.color_mode) for quality in qualities]
+        width, height = img.width, img.height
+        decode_scale = img.info['decode_scale']
+        for data, mode, encoding in encodings:
+            logger.debug("✅ Encoded once: %dx%d pixels, %s %s, %d bytes",
+                         width, height, PAGE_CLASSES[mode], encoding, len(data))
+
+    label_width = max(width, LABEL_MIN_WIDTH)
+    label_data = b''
+    if options.label_mode == 'raster':
+        with stage('label'):
+            label_data = zlib.compress(render_label_strip(label_width, filename).tobytes())
+    return [
+        PreparedPage(
+            filename=filename,
+            image_data=data,
+            width=width,
+            height=height,
+            mode=mode,
+            encoding=encoding,
+            label_data=label_data,
+            label_width=label_width,
+            decode_scale=decode_scale,
+            label_mode=options.label_mode,
+        )
+        for data, mode, encoding in encodings
+    ]
+
+
+def prepare_page(source: Union[str, bytes], filename: str, page_number: int,
+                 options: PageOptions = PageOptions(), frame: int = 0) -> PreparedPage:
+    """Decode, resize and encode a single upload (or TIFF frame) exactly once for the single-encode pipeline"""
+    with collect_stages() as timings:
+        page, = prepare_page_variants(source, filename, options, frame, [options.quality])
+    page.timings = timings
+    return page
+
+
+def target_step_options(options: PageOptions, step: int) -> PageOptions:
+    """``options`` with the page box and JPEG quality of TARGET_LADDER[step]"""
+    scale, quality = TARGET_LADDER[step]
+    return replace(options, max_width=round(options.max_width * scale),
+                   max_height=round(options.max_height * scale), quality=quality)
+
+
+def measure_target_sizes(source: Union[str, bytes], filename: str, page_number: int,
+                         options: PageOptions = PageOptions(), frame: int = 0,
+                         spool: Optional[str] = None) -> dict:
+    """
+    Bytes the single-encode page (image and label) takes at every
+    TARGET_LADDER step, decoding once per scale.  The encodes are exactly
+    what prepare_page produces with target_step_options.  Returns the sizes
+    and the stage timings.
+
+    With a ``spool`` directory, every step's image and label bytes are
+    also written to a file there named after the step, and the page_fields
+    of each step are returned as 'pages', so the step the search picks
+    can be kept without encoding it again.
+    """
+    sizes = []
+    spooled = []
+    if spool is not None:
+        os.makedirs(spool, exist_ok=True)
+    with collect_stages() as timings:
+        step = 0
+        while step < len(TARGET_LADDER):
+            scale = TARGET_LADDER[step][0]
+            qualities = [quality for step_scale, quality in TARGET_LADDER[step:] if step_scale == scale]
+            pages = prepare_page_variants(source, filename, target_step_options(options, step), frame, qualities)
+            sizes.extend(len(page.image_data) + len(page.label_data) for page in pages)
+            if spool is not None:
+                for page in pages:
+                    with open(os.path.join(spool, str(len(spooled))), 'wb') as f:
+                        f.write(page.image_data + page.label_data)
+                    spooled.append(page_fields(page))
+            step += len(qualities)
+    measured = {'sizes': sizes, 'timings': timings}
+    if spool is not None:
+        measured['pages'] = spooled
+    return measured
+
+
+def fit_to_budget(tables: List[List[int]], budget: int) -> List[int]:
+    """
+    Pick a TARGET_LADDER step per page so the pages' bytes stay within
+    ``budget``, best quality first.  ``tables`` holds each page's size at
+    every step.  Bisects for the best step all pages can share, then moves
+    single pages back up while the budget allows, the cheapest upgrades
+    first.  When even the last step is over budget, every page gets it.
+    """
+    last = len(TARGET_LADDER) - 1
+
+    def total(step: int) -> int:
+        return sum(sizes[step] for sizes in tables)
+
+    if total(last) > budget:
+        return [last] * len(tables)
+    low, high = 0, last
+    while low < high:
+        middle = (low + high) // 2
+        if total(middle) <= budget:
+            high = middle
+        else:
+            low = middle + 1
+    steps = [low] * len(tables)
+    spent = total(low)
+    while True:
+        upgrades = sorted((tables[i][steps[i] - 1] - tables[i][steps[i]], i)
+                          for i in range(len(tables)) if steps[i] > 0)
+        upgraded = False
+        for cost, i in upgrades:
+            if spent + cost <= budget:
+                spent += cost
+                steps[i] -= 1
+                upgraded = True
+        if not upgraded:
+            return steps
+
+
+def prepare_legacy_page(source: Union[str, bytes], filename: str, page_number: int,
+                        options: PageOptions = PageOptions(), frame: int = 0) -> PreparedPage:
+    """
+    Legacy pipeline page as a PreparedPage.
+
+    Runs process_image_file and then the JPEG re-encode create_professional_pdf
+    applies, so the page looks exactly as before but can be streamed into a
+    PDF like a single-encode page.
+    """
+    with collect_stages() as timings:
+        img = process_image_file(source, filename, page_number, options, frame)
+        buffer = io.BytesIO()
+        # Use JPEG with lower quality for smaller file size
+        with stage('encode'):
+            img.save(buffer, format='JPEG', quality=70, optimize=True)
+    return PreparedPage(
+        filename=filename,
+        image_data=buffer.getvalue(),
+        width=img.width,
+        height=img.height,
+        mode=img.mode,
+        encoding='jpeg',
+        label_data=b'',
+        label_width=max(img.width, LABEL_MIN_WIDTH),
+        decode_scale=img.info.get('decode_scale', 1),
+        label_mode=options.label_mode,
+        label_in_image=options.label_mode == 'raster',
+        timings=timings,
+    )
+
+
+def prepared_page_layout(page: PreparedPage):
+    """
+    Place a prepared page on A4.
+
+    Returns (points per pixel, box x, box y, box width in pixels, photo
+    rectangle as (x, y, width, height)); the label band, if any, occupies
+    the bottom LABEL_MARGIN pixels of the box.
+    """
+    if page.label_in_image:
+        scale, x_offset, y_offset, box_width = labeled_box_layout(page.width, page.height - LABEL_MARGIN)
+        return scale, x_offset, y_offset, box_width, (x_offset, y_offset, page.width * scale, page.height * scale)
+    scale, x_offset, y_offset, box_width = labeled_box_layout(page.width, page.height)
+    photo_x = x_offset + ((box_width - page.width) // 2) * scale
+    photo = (photo_x, y_offset + LABEL_MARGIN * scale, page.width * scale, page.height * scale)
+    return scale, x_offset, y_offset, box_width, photo
+
+
+def page_image_format(page: PreparedPage) -> Tuple[str, int, str]:
+    """(color space, bits per component, filter) of a prepared page's image data"""
+    if page.mode == '1':
+        return 'DeviceGray', 1, 'FlateDecode'
+    return ('DeviceGray' if page.mode == 'L' else 'DeviceRGB'), 8, 'DCTDecode'
+
+
+def _image_xobject(data: bytes, width: int, height: int, color_space: str, filters: tuple,
+                   bits_per_component: int = 8) -> pdfdoc.PDFImageXObject:
+    """Build an image XObject straight from already-encoded stream bytes"""
+    name = hashlib.sha1(data).hexdigest()
+    xobj = pdfdoc.PDFImageXObject(name)
+    xobj.width = width
+    xobj.height = height
+    xobj.bitsPerComponent = bits_per_component
+    xobj.colorSpace = color_space
+    xobj.streamContent = data
+    xobj._filters = filters
+    xobj.mask = None
+    return xobj
+
+
+def _draw_xobject(c: canvas.Canvas, xobj: pdfdoc.PDFImageXObject, x: float, y: float, width: float, height: float):
+    """
+    Place an image XObject on the current page.
+
+    This mirrors Canvas.drawImage, which insists on decoding every image to
+    fingerprint it even when the JPEG bytes are passed through unchanged.
+    """
+    c._currentPageHasImages = 1
+    reg_name = c._doc.getXObjectName(xobj.name)
+    if not c._doc.idToObject.get(reg_name, None):
+        c._setXObjects(xobj)
+        c._doc.Reference(xobj, reg_name)
+        c._doc.addForm(xobj.name, xobj)
+    c.saveState()
+    c.translate(x, y)
+    c.scale(width, height)
+    c._code.append("/%s Do" % reg_name)
+    c.restoreState()
+    c._formsinuse.append(xobj.name)
+
+
+def draw_prepared_page(c: canvas.Canvas, page: PreparedPage):
+    """Lay out a prepared page exactly like a labeled image from add_filename_to_image"""
+    scale, x_offset, y_offset, box_width, photo_rect = prepared_page_layout(page)
+
+    color_space, bits, filter_name = page_image_format(page)
+    photo = _image_xobject(page.image_data, page.width, page.height, color_space, (filter_name,), bits)
+    _draw_xobject(c, photo, *photo_rect)
+
+    if page.label_mode == 'vector':
+        draw_vector_label(c, page.filename, x_offset, y_offset, box_width, scale)
+    elif not page.label_in_image:
+        label = _image_xobject(page.label_data, page.label_width, LABEL_MARGIN, 'DeviceRGB', ('FlateDecode',))
+        _draw_xobject(c, label, x_offset, y_offset, box_width * scale, LABEL_MARGIN * scale)
+
+
+def _text_ops(font: str, size: float, color: str, x: float, y: float, encoded: bytes) -> bytes:
+    r, g, b = HexColor(color).rgb()
+    return b'BT /%s %s Tf %s rg 1 0 0 1 %s Tm %s Tj ET\n' % (
+        font.encode(), fp_str(size).encode(), fp_str(r, g, b).encode(), fp_str(x, y).encode(),
+        pdf_string(encoded))
+
+
+def write_prepared_page(writer: PdfStreamWriter, page: PreparedPage):
+    """Stream a prepared page into an incremental PDF, laid out like draw_prepared_page"""
+    started = time.perf_counter()
+    scale, x_offset, y_offset, box_width, photo_rect = prepared_page_layout(page)
+    color_space, bits, filter_name = page_image_format(page)
+    images = {'Im0': writer.image(page.image_data, page.width, page.height, color_space, filter_name, bits)}
+    fonts = {}
+    content = b'q %s 0 0 %s %s %s cm /Im0 Do Q\n' % tuple(
+        fp_str(value).encode() for value in (photo_rect[2], photo_rect[3], photo_rect[0], photo_rect[1]))
+
+    if page.label_mode == 'vector':
+        text, font_name, font_size, center, baseline = vector_label_layout(
+            page.filename, x_offset, y_offset, box_width, scale)
+        if font_name == 'Helvetica':
+            fonts['F0'] = writer.standard_font('Helvetica')
+            # Without a TrueType font, characters outside cp1252 print as '?'
+            encoded = text.encode('cp1252', errors='replace')
+        else:
+            fonts['F0'], encoded = writer.truetype_subset_font(LABEL_FONT_PATH, text)
+        left = center - pdfmetrics.stringWidth(text, font_name, font_size) / 2
+        # Light shadow one pixel down-right, then the navy text on top
+        content += _text_ops('F0', font_size, '#BBBBBB', left + scale, baseline - scale, encoded)
+        content += _text_ops('F0', font_size, '#1A365D', left, baseline, encoded)
+    elif not page.label_in_image:
+        images['Im1'] = writer.image(page.label_data, page.label_width, LABEL_MARGIN, 'DeviceRGB', 'FlateDecode')
+        content += b'q %s 0 0 %s %s %s cm /Im1 Do Q\n' % tuple(
+            fp_str(value).encode() for value in (box_width * scale, LABEL_MARGIN * scale, x_offset, y_offset))
+
+    writer.add_page(content, *A4, images=images, fonts=fonts)
+    record_stage('pdf_build', time.perf_counter() - started)
+
+
+@dataclass
+class PdfSourcePage:
+    """
+    A page of an uploaded PDF, copied into the output without being
+    rendered.  The page is already taken out of the upload (see
+    copy_pdf_pages): ``objects`` are what it needs written first, ``page``
+    its page dictionary, both numbered within the upload.
+    """
+    filename: str
+    number: int  # Page index in the upload, from 0
+    width: float  # Points, as displayed (after /Rotate)
+    height: float
+    objects: list = field(default_factory=list, repr=False)  # (Ref, value) or (Ref, dictionary, stream data)
+    page: dict = field(default_factory=dict, repr=False)
+    mode: str = 'PDF'
+    encoding: str = 'pdf'
+    decode_scale: int = 1
+    timings: dict = field(default_factory=dict, compare=False)
+
+
+def open_pdf(source: Union[str, bytes]) -> PyPDF2.PdfReader:
+    """Open an uploaded PDF; encrypted files only when they open without a password"""
+    reader = PyPDF2.PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if reader.is_encrypted and not reader.decrypt(''):
+        raise ValueError("PDF is password-protected")
+    return reader
+
+
+def _displayed_size(page: PyPDF2.PageObject) -> Tuple[float, float]:
+    width, height = float(page.mediabox.width), float(page.mediabox.height)
+    if page.get('/Rotate', 0) % 180:
+        width, height = height, width
+    return width, height
+
+
+def pdf_page_sizes(source: Union[str, bytes]) -> List[Tuple[float, float]]:
+    """Displayed (width, height) in points of every page of an uploaded PDF"""
+    sizes = [_displayed_size(page) for page in open_pdf(source).pages]
+    if not sizes:
+        raise ValueError("PDF has no pages")
+    return sizes
+
+
+def _pdf_token(value) -> str:
+    """A PDF scalar (name, number, string, boolean, null) in PyPDF2's own serialization"""
+    buffer = io.BytesIO()
+    value.write_to_stream(buffer, None)
+    # format_value emits str values verbatim
+    return buffer.getvalue().decode('latin-1')
+
+
+def _copy_pdf_value(writer: PdfStreamWriter, value, copied: dict):
+    """
+    ``value`` from a source PDF as a PdfStreamWriter value; every indirect
+    object it references is written once, with its stream bytes as they are
+    """
+    if isinstance(value, PyPDF2.generic.IndirectObject):
+        key = (value.idnum, value.generation)
+        if key not in copied:
+            # Reserved first, so reference cycles end here
+            ref = copied[key] = writer.reserve()
+            target = value.get_object()
+            if isinstance(target, PyPDF2.generic.StreamObject):
+                dictionary = {name: item for name, item in target.items() if name != '/Length'}
+                writer.write_stream(_copy_pdf_value(writer, PyPDF2.generic.DictionaryObject(dictionary), copied),
+                                    target._data, compress=False, ref=ref)
+            else:
+                writer.write_object(_copy_pdf_value(writer, target, copied), ref=ref)
+        return copied[key]
+    if isinstance(value, PyPDF2.generic.StreamObject):
+        # Streams are always indirect in the output
+        dictionary = {name: item for name, item in value.items() if name != '/Length'}
+        return writer.write_stream(_copy_pdf_value(writer, PyPDF2.generic.DictionaryObject(dictionary), copied),
+                                   value._data, compress=False)
+    if isinstance(value, PyPDF2.generic.DictionaryObject):
+        return {_pdf_token(name)[1:]: _copy_pdf_value(writer, item, copied) for name, item in value.items()}
+    if isinstance(value, PyPDF2.generic.ArrayObject):
+        return [_copy_pdf_value(writer, item, copied) for item in value]
+    return _pdf_token(value)
+
+
+def copy_pdf_page(writer: PdfStreamWriter, page: PyPDF2.PageObject, copied: dict):
+    """
+    Copy a page of an uploaded PDF into ``writer`` (a PdfStreamWriter or a
+    PdfObjectRecorder) as it is: content streams and images keep their
+    bytes (nothing is decoded or re-encoded).
+    ``copied`` maps source objects already written, so resources shared by
+    several pages of one upload are written once.
+    """
+    started = time.perf_counter()
+    # PyPDF2 has already copied inherited attributes (MediaBox, Resources...) onto the page
+    entries = {name: item for name, item in page.items() if name not in PDF_PAGE_SKIPPED_KEYS}
+    writer.add_existing_page(_copy_pdf_value(writer, PyPDF2.generic.DictionaryObject(entries), copied))
+    record_stage('pdf_build', time.perf_counter() - started)
+
+
+class PdfObjectRecorder:
+    """
+    Takes the place of the PdfStreamWriter while pages are copied out of
+    an upload, keeping the objects instead of writing them, so the upload
+    is parsed on the worker pool and the writer only replays the result
+    (see write_pdf_source_page)
+    """
+
+    def __init__(self):
+        self._count = 0
+        self.objects = []
+        self.page = None
+
+    def reserve(self) -> Ref:
+        self._count += 1
+        return Ref(self._count)
+
+    def write_object(self, value, ref: Optional[Ref] = None) -> Ref:
+        ref = ref or self.reserve()
+        self.objects.append((ref, value))
+        return ref
+
+    def write_stream(self, dictionary: dict, data: bytes, compress: Optional[bool] = None,
+                     ref: Optional[Ref] = None) -> Ref:
+        # Copied streams keep their bytes, they are never compressed again
+        ref = ref or self.reserve()
+        self.objects.append((ref, dictionary, data))
+        return ref
+
+    def add_existing_page(self, page: dict):
+        self.page = page
+
+    def take(self) -> Tuple[list, dict]:
+        """The objects and page dictionary of the page copied last"""
+        objects, page = self.objects, self.page
+        self.objects, self.page = [], None
+        return objects, page
+
+
+def copy_pdf_pages(source: Union[str, bytes], filename: str) -> List[PdfSourcePage]:
+    """
+    Every page of an uploaded PDF, copied out of it (see copy_pdf_page)
+    and ready to be written without parsing the upload again.  Resources
+    shared by several pages come with the first page that uses them.
+    """
+    recorder, copied, pages = PdfObjectRecorder(), {}, []
+    for number, page in enumerate(open_pdf(source).pages):
+        copy_pdf_page(recorder, page, copied)
+        objects, dictionary = recorder.take()
+        pages.append(PdfSourcePage(filename, number, *_displayed_size(page), objects=objects, page=dictionary))
+    if not pages:
+        raise ValueError("PDF has no pages")
+    return pages
+
+
+def _renumber(value, refs: dict, writer: PdfStreamWriter):
+    """``value`` with references numbered within its upload replaced by the writer's own"""
+    if isinstance(value, Ref):
+        if value.number not in refs:
+            refs[value.number] = writer.reserve()
+        return refs[value.number]
+    if isinstance(value, dict):
+        return {name: _renumber(item, refs, writer) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_renumber(item, refs, writer) for item in value]
+    return value
+
+
+def write_pdf_source_page(writer: PdfStreamWriter, page: PdfSourcePage, refs: dict):
+    """
+    Write a page copied out of an uploaded PDF.  ``refs`` maps the upload's
+    object numbers to the writer's and is shared by the pages of one upload.
+    """
+    started = time.perf_counter()
+    for ref, *body in page.objects:
+        ref = _renumber(ref, refs, writer)
+        if len(body) == 1:
+            writer.write_object(_renumber(body[0], refs, writer), ref=ref)
+        else:
+            writer.write_stream(_renumber(body[0], refs, writer), body[1], compress=False, ref=ref)
+    writer.add_existing_page(_renumber(page.page, refs, writer))
+    record_stage('pdf_build', time.perf_counter() - started)
+
+
+def write_pages(writer: PdfStreamWriter, page: Union[PreparedPage, list]):
+    """
+    Write one processed upload: a prepared page, or the pages of a
+    multi-page upload (TIFF frames or the pages of a PDF), in order
+    """
+    refs = {}
+    for item in page if isinstance(page, list) else [page]:
+        if isinstance(item, PdfSourcePage):
+            # The pages of one upload share its resources
+            write_pdf_source_page(writer, item, refs)
+        else:
+            write_prepared_page(writer, item)
+
+
+def write_prepared_pdf(pages: Iterable[PreparedPage], out: BinaryIO, object_streams: bool = True) -> int:
+    """
+    Write pages (or multi-page uploads), consumed one at a time, as a
+    complete PDF to ``out``; returns the page count
+    """
+    writer = PdfStreamWriter(out, object_streams=object_streams)
+    for page in pages:
+        write_pages(writer, page)
+    writer.close()
+    return writer.page_count
+
+
+def render_single_page_pdf(page: Union[PreparedPage, list]) -> bytes:
+    """A complete PDF of one upload for split mode (one page, or all pages of a multi-page upload)"""
+    out = io.BytesIO()
+    write_prepared_pdf([page], out)
+    return out.getvalue()
+
+
+def page_filename(page: Union[PreparedPage, list]) -> str:
+    """Upload filename of a processed upload"""
+    return page[0].filename if isinstance(page, list) else page.filename
+
+
+def split_document_name(filename: str, used: set) -> str:
+    """
+    Archive name for one page's PDF: the upload's base name with a .pdf
+    extension, numbered ('scan (2).pdf') when an earlier page already took
+    the name, compared case-insensitively as on Windows and macOS
+    """
+    base = os.path.splitext(os.path.basename(filename.replace('\\', '/')))[0] or 'document'
+    name, copy = f"{base}.pdf", 1
+    while name.lower() in used:
+        copy += 1
+        name = f"{base} ({copy}).pdf"
+    used.add(name.lower())
+    return name
+
+
+class MergedDocument:
+    """Merge-mode output: every page goes into one PDF, written as it arrives"""
+    media_type = 'application/pdf'
+
+    def __init__(self, out: BinaryIO):
+        self.writer = PdfStreamWriter(out)
+
+    def add(self, page: Union[PreparedPage, list], document: Optional[bytes] = None):
+        write_pages(self.writer, page)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        """Give up on an unfinished document; the output is left incomplete"""
+
+
+class SplitArchive:
+    """
+    Split-mode output: a ZIP with one PDF per upload, written as uploads
+    arrive; the pages of a multi-page PDF or TIFF stay in one document.
+
+    ``out`` does not need to be seekable, so the archive can go straight
+    into a response.  PDFs of JPEG pages hardly compress, so entries are
+    stored unless 'deflated' is asked for.
+    """
+    media_type = 'application/zip'
+
+    def __init__(self, out: BinaryIO, compression: str = 'stored'):
+        self.compression = ZIP_COMPRESSIONS[compression]
+        self._zip = zipfile.ZipFile(out, 'w', self.compression)
+        self._names = set()
+
+    def add(self, page: Union[PreparedPage, list], document: Optional[bytes] = None):
+        """Add an upload's PDF, rendering it here unless already rendered"""
+        if document is None:
+            document = render_single_page_pdf(page)
+        name = split_document_name(page_filename(page), self._names)
+        self._zip.writestr(name, document, compress_type=self.compression)
+
+    def close(self):
+        self._zip.close()
+
+    def abort(self):
+        """Give up on an unfinished archive while ``out`` is still open"""
+        try:
+            # Otherwise ZipFile finishes the archive from its finalizer,
+            # after the output has been closed
+            self._zip.close()
+        except (OSError, ValueError):
+            pass
+
+
+# Per-page workers by pipeline mode; both return a PreparedPage.
+# 'legacy' re-encodes each page several times on its way into the PDF;
+# 'single' encodes each page exactly once (or not at all for JPEGs that
+# already fit) and embeds the bytes directly as the image XObject.
+PIPELINES = {
+    'legacy': prepare_legacy_page,
+    'single': prepare_page,
+}
@@ -0,0 +1,134 @@
+"""
+/preview-order: the upload order with image dimensions and, on request,
+small thumbnails, so the frontend can show the ordering UI without
+decoding every full-size photo in the browser.
+
+Dimensions come from the image headers (PDFs: the page boxes).
+Thumbnails are made on the execution engine, several at a time, with
+reduced-scale decoding, and are cached by content hash and size alone,
+so reordering, renaming or previewing the same files again costs only a
+cache read.  Afterwards the uploads can be run through the regular page
+pipeline in the background, which fills the page cache for the /convert
+that usually follows.
+"""
+import asyncio
+import base64
+import logging
+from contextlib import aclosing
+
+import config
+from cache import ThumbnailCache, thumbnail_cache
+from conversion import (
+    CONVERT_FORM_SCHEMA,
+    ConversionProgress,
+    form_flag,
+    page_options,
+    parse_convert_fields,
+    process_uploads,
+)
+from executor import engine, ordered_window
+from metrics import observe_stages
+from pipeline import is_pdf, make_thumbnail, upload_dimensions
+from uploads import UploadError
+
+logger = logging.getLogger('snapmerge.preview')
+
+MIN_THUMBNAIL_SIZE = 32
+
+PREVIEW_FORM_SCHEMA = {
+    "type": "object",
+    "required": ["files"],
+    "properties": {
+        **CONVERT_FORM_SCHEMA["properties"],
+        "thumbnails": {"type": "boolean", "default": False,
+                       "description": "Include a JPEG data URI thumbnail of every image"},
+        "thumbnail_size": {"type": "integer", "default": config.THUMBNAIL_SIZE,
+                           "minimum": MIN_THUMBNAIL_SIZE, "maximum": config.THUMBNAIL_MAX_SIZE,
+                           "description": "Longest side of the thumbnails in pixels"},
+        "warm_cache": {"type": "boolean", "default": bool(config.PREVIEW_WARM_PAGE_CACHE),
+                       "description": "Process the pages into the page cache in the background, "
+                                      "using the conversion fields, so the following /convert is faster"},
+    },
+}
+
+
+def parse_preview_fields(fields: dict) -> dict:
+    """
+    Validate the /preview-order form: the /convert fields (used to warm the
+    page cache) plus the thumbnail options; raises UploadError on bad values
+    """
+    params = parse_convert_fields(fields)
+    params["thumbnails"] = form_flag(fields, "thumbnails")
+    params["warm_cache"] = form_flag(fields, "warm_cache", bool(config.PREVIEW_WARM_PAGE_CACHE))
+    try:
+        size = int(fields.get("thumbnail_size") or config.THUMBNAIL_SIZE)
+    except ValueError:
+        raise UploadError("thumbnail_size must be an integer")
+    params["thumbnail_size"] = min(max(size, MIN_THUMBNAIL_SIZE), config.THUMBNAIL_MAX_SIZE)
+    return params
+
+
+async def thumbnail_for(upload, size: int):
+    """The upload's thumbnail from the cache or the pool: (thumbnail, cached)"""
+    key = ThumbnailCache.key(upload.sha256, size)
+    thumbnail = await asyncio.to_thread(thumbnail_cache.get, key)
+    if thumbnail is not None:
+        return thumbnail, True
+    thumbnail = await engine.run(make_thumbnail, upload.source, size)
+    observe_stages(thumbnail.pop('timings'))
+    try:
+        await asyncio.to_thread(thumbnail_cache.put, key, thumbnail)
+    except Exception as e:
+        logger.warning("Could not cache thumbnail of %s: %s", upload.filename, e)
+    return thumbnail, False
+
+
+async def preview_upload(upload, params: dict) -> dict:
+    entry = {
+        "index": upload.index,
+        "filename": upload.filename,
+        "content_type": upload.content_type,
+        "size": upload.size,
+    }
+    try:
+        if params["thumbnails"] and not await asyncio.to_thread(is_pdf, upload.source):
+            thumbnail, cached = await thumbnail_for(upload, params["thumbnail_size"])
+            entry.update({
+                "width": thumbnail["width"],
+                "height": thumbnail["height"],
+                "pages": thumbnail["pages"],
+                "thumbnail": "data:image/jpeg;base64," + base64.b64encode(thumbnail["data"]).decode('ascii'),
+                "thumbnail_width": thumbnail["thumbnail_width"],
+                "thumbnail_height": thumbnail["thumbnail_height"],
+                "thumbnail_cached": cached,
+            })
+        else:
+            entry.update(await asyncio.to_thread(upload_dimensions, upload.source))
+            if params["thumbnails"]:
+                entry["thumbnail"] = None  # PDF pages are not rendered
+    except Exception as e:
+        logger.debug("Could not preview %s: %s", upload.filename, e)
+        entry["error"] = "Not a supported image or PDF"
+    return entry
+
+
+async def preview_uploads(uploads: list, params: dict, in_flight: int) -> list:
+    """Preview entries of ``uploads`` in upload order, up to ``in_flight`` at a time"""
+    entries = []
+    async with aclosing(ordered_window((preview_upload(upload, params) for upload in uploads),
+                                       in_flight)) as results:
+        async for entry in results:
+            entries.append(entry)
+    return entries
+
+
+async def warm_page_cache(uploads: list, params: dict, in_flight: int):
+    """Run the uploads through the page pipeline, keeping only what lands in the page cache"""
+    progress = ConversionProgress(uploads)
+    async with aclosing(process_uploads(uploads, params["pipeline"], page_options(params),
+                                        in_flight, progress)) as results:
+        async for upload, result, _ in results:
+            progress.record(upload, result)
+    cached = sum(1 for page in progress.pages if page.get("cached"))
+    logger.info("🔥 Warmed the page cache for %d files (%d were cached already)",
+                progress.document_count, cached)
@@ -1,25 +1,95 @@
 #!/usr/bin/env python3
+"""
+Start the SnapMerge API server.
 
-import uvicorn
+    python run_server.py                 # development: auto-reload on 127.0.0.1:8001
+    python run_server.py --production    # [--host H] [--port P] [--pool-size N] [--no-warmup]
+
+Production mode takes its defaults from the SNAPMERGE_HOST, _PORT,
+_BACKLOG, _LIMIT_CONCURRENCY, _KEEP_ALIVE and _GRACEFUL_TIMEOUT settings,
+never reloads, and warms up before it accepts connections (see warmup.py).
+
+It runs one web process: conversions already use every CPU through its
+pool, while the temp janitor, job resumption, upload sessions, admission
+limits and cache budgets all belong to one process and would clash or
+multiply with several.  --workers (SNAPMERGE_WORKERS) above 1 is refused.
+"""
+import argparse
+import importlib
 import os
 import sys
 
-if __name__ == "__main__":
+import uvicorn
+
+import config
+
+
+def run_development():
     print("Starting SnapMerge Server...")
     print("Server will be available at: http://127.0.0.1:8001")
     print("API docs at: http://127.0.0.1:8001/docs")
     print("Press Ctrl+C to stop the server")
-    
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=8001,
+        reload=True,
+        log_level="info"
+    )
+
+
+def run_production(args):
+    # The workers read their settings from the environment when they import
+    # the app, so the command line is passed on through it
+    if args.pool_size:
+        os.environ["SNAPMERGE_POOL_SIZE"] = str(args.pool_size)
+    if args.no_warmup:
+        os.environ["SNAPMERGE_WARMUP"] = "0"
+    # The app is served from this process, where config has been imported already
+    importlib.reload(config)
+
+    print(f"Starting SnapMerge Server on http://{args.host}:{args.port}")
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        backlog=config.SERVER_BACKLOG,
+        limit_concurrency=config.SERVER_LIMIT_CONCURRENCY or None,
+        timeout_keep_alive=config.SERVER_KEEP_ALIVE,
+        timeout_graceful_shutdown=config.SERVER_GRACEFUL_TIMEOUT,
+        log_level="info"
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Start the SnapMerge API server")
+    parser.add_argument("--production", action="store_true",
+                        help="no reload, settings from SNAPMERGE_* (default: development)")
+    parser.add_argument("--host", default=config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVER_WORKERS,
+                        help="web worker processes; only 1 is supported")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="conversion processes (default: SNAPMERGE_POOL_SIZE, one per CPU)")
+    parser.add_argument("--no-warmup", action="store_true", help="accept connections without warming up")
+    args = parser.parse_args(argv)
+    if args.workers > 1:
+        parser.error("only one web worker is supported: the conversion pool already uses every CPU "
+                     "(size it with --pool-size), and the temp janitor, jobs, upload sessions, admission "
+                     "limits and caches would clash or multiply across worker processes")
+
     try:
-        uvicorn.run(
-            "main:app",
-            host="127.0.0.1",
-            port=8001,
-            reload=True,
-            log_level="info"
-        )
+        if args.production:
+            run_production(args)
+        else:
+            run_development()
     except KeyboardInterrupt:
         print("\nServer stopped.")
     except Exception as e:
         print(f"Error starting server: {e}")
-        sys.exit(1)
\ No newline at end of file
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
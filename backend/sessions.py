@@ -0,0 +1,325 @@
+"""
+Upload sessions.
+
+``/convert`` only starts processing once the whole multipart body is in,
+so on a slow link the workers sit idle during the upload and all get busy
+at the end.  A session splits the request up: ``POST /sessions`` opens
+one with the conversion parameters, ``PUT /sessions/{id}/files/{position}``
+uploads one file (several may be in flight, in any order), and every file
+is decoded/optimized/labeled as soon as it has landed.  ``POST
+/sessions/{id}/finalize`` then only puts the finished pages into the
+merged PDF or split ZIP, in the requested order.  A session processes at
+most ``max_in_flight`` pages at a time, however many uploads arrive at
+once.
+
+A session's uploads live in ``<temp root>/sessions/<id>/``, one
+subdirectory per upload, and its processed pages are held in memory until
+finalize.  Sessions are not persisted: the temp janitor removes a session
+directory SESSION_TTL after its last upload, which also drops the session
+and cancels whatever it was still processing.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import config
+from conversion import (
+    CONVERT_FORM_SCHEMA,
+    ConversionProgress,
+    page_options,
+    parse_convert_fields,
+    process_upload,
+    render_document,
+    resolve_max_in_flight,
+    split_renderer,
+    write_output,
+)
+from executor import ordered_window
+from pipeline import header_pixels
+from uploads import IngestedUpload, UploadError, ordered_upload_name
+
+logger = logging.getLogger('snapmerge.sessions')
+
+
+# Page processing is fixed when the session is opened; the document is
+# chosen at finalize
+SESSION_FIELDS = ('pipeline', 'label_mode', 'color_mode', 'max_in_flight')
+FINALIZE_FIELDS = ('mode', 'zip_compression')
+
+SESSION_FORM_SCHEMA = {
+    "type": "object",
+    "properties": {name: CONVERT_FORM_SCHEMA["properties"][name] for name in SESSION_FIELDS},
+}
+
+FINALIZE_FORM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **{name: CONVERT_FORM_SCHEMA["properties"][name] for name in FINALIZE_FIELDS},
+        "order": {"type": "string",
+                  "description": "Comma-separated positions in document order; default: all, ascending"},
+    },
+}
+
+
+def parse_finalize_fields(session_params: dict, fields: dict):
+    """
+    The document parameters for finalize (the session's, with ``mode`` and
+    ``zip_compression`` from ``fields``) and the requested order, None for
+    the default; raises UploadError on bad values
+    """
+    params = parse_convert_fields({**{name: str(session_params[name]) for name in SESSION_FIELDS},
+                                   **{name: fields[name] for name in FINALIZE_FIELDS if name in fields}})
+    if params["mode"] not in ('merge', 'split'):
+        raise UploadError(f"Unknown mode '{params['mode']}', expected one of: merge, split")
+    order = fields.get("order", "").strip()
+    if not order:
+        return params, None
+    try:
+        return params, [int(position) for position in order.split(",")]
+    except ValueError:
+        raise UploadError("order must be comma-separated positions")
+
+
+class SessionLimit(Exception):
+    """No room for another open session"""
+
+
+class SessionError(Exception):
+    """The request does not fit the session's state; carries the HTTP status to answer with"""
+
+    def __init__(self, message: str, status_code: int = 409):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class SessionFile:
+    """One uploaded file and the processing of its page(s)"""
+    position: int
+    upload: IngestedUpload
+    directory: str
+    pixels: int  # From the image headers, for the session's pixel budget
+    task: asyncio.Task  # Resolves to process_upload's (page, None)
+
+    @property
+    def state(self) -> str:
+        if not self.task.done():
+            return 'processing'
+        if self.task.cancelled() or self.task.exception() is not None:
+            return 'failed'
+        return 'ready'
+
+
+def _log_failure(upload: IngestedUpload):
+    def done(task: asyncio.Task):
+        # Retrieved here so failed pages of abandoned sessions are not reported as never retrieved
+        if not task.cancelled() and task.exception() is not None:
+            logger.info("❌ %s: %s", upload.filename, task.exception())
+    return done
+
+
+@dataclass
+class Session:
+    id: str
+    directory: str
+    params: dict  # Parsed /convert form fields given when the session was opened
+    created_at: float = field(default_factory=time.time)
+    files: Dict[int, SessionFile] = field(default_factory=dict)
+    state: str = 'open'  # open -> finalizing -> complete/failed
+    receiving: int = 0  # Uploads still being read
+    # Set once finalized: the per-page report of the document
+    report: Optional[dict] = None
+    # Held by every page task of the session, so uploads landing together
+    # are processed max_in_flight pages at a time
+    limiter: asyncio.Semaphore = field(init=False)
+
+    def __post_init__(self):
+        self.limiter = asyncio.Semaphore(self.max_in_flight)
+
+    @property
+    def max_in_flight(self) -> int:
+        return resolve_max_in_flight(self.params["max_in_flight"])
+
+    def check_open(self):
+        if self.state != 'open':
+            raise SessionError(f"Session is {self.state}")
+
+    def upload_directory(self, position: int) -> str:
+        """A new directory for one upload, so uploads to the same position never collide"""
+        return os.path.join(self.directory, f"{position:05d}-{uuid4().hex[:8]}")
+
+    def remaining_bytes(self, position: int) -> int:
+        """Upload bytes still allowed for ``position`` (replacing what it holds)"""
+        used = sum(file.upload.size for file in self.files.values() if file.position != position)
+        return config.MAX_UPLOAD_REQUEST_BYTES - used
+
+    async def receive(self, position: int, upload: IngestedUpload, directory: str):
+        """
+        Take the upload for ``position``, replacing an earlier one, and start
+        processing it right away; raises UploadError (413) when the images of
+        the session would exceed the pixel budget
+        """
+        self.check_open()
+        pixels = await asyncio.to_thread(header_pixels, upload.source)
+        budget = config.MAX_REQUEST_PIXELS
+        if budget > 0:
+            total = pixels + sum(file.pixels for file in self.files.values() if file.position != position)
+            if total > budget:
+                raise UploadError(
+                    f"Images in this session total {total} pixels, over the {budget} pixel limit",
+                    status_code=413)
+        self.discard(position)
+        task = asyncio.create_task(process_upload(
+            upload, self.params["pipeline"], page_options(self.params), self.limiter))
+        task.add_done_callback(_log_failure(upload))
+        self.files[position] = SessionFile(position, upload, directory, pixels, task)
+
+    def discard(self, position: int) -> bool:
+        """Drop the upload at ``position`` and its page"""
+        file = self.files.pop(position, None)
+        if file is None:
+            return False
+        file.task.cancel()
+        shutil.rmtree(file.directory, ignore_errors=True)
+        return True
+
+    def resolve_order(self, order: Optional[List[int]]) -> List[int]:
+        """Positions to assemble: ``order`` as given, or every uploaded position ascending"""
+        if order is None:
+            return sorted(self.files)
+        if len(set(order)) != len(order):
+            raise SessionError("order lists a position more than once", status_code=400)
+        for position in order:
+            if position not in self.files:
+                raise SessionError(f"No file uploaded at position {position}", status_code=400)
+        return order
+
+    async def results(self, order: List[int], render=None):
+        """Yield (upload, page or exception, rendered) in ``order``, like process_uploads"""
+        files = [self.files[position] for position in order]
+
+        async def finish(file: SessionFile):
+            # Shielded, so giving up on the document does not cancel the page itself
+            page, _ = await asyncio.shield(file.task)
+            if render is None:
+                return page, None
+            async with self.limiter:
+                return page, await render_document(render, page)
+
+        async with aclosing(ordered_window((finish(file) for file in files), self.max_in_flight)) as results:
+            file_iter = iter(files)
+            async for result in results:
+                file = next(file_iter)
+                if isinstance(result, Exception):
+                    yield file.upload, result, None
+                else:
+                    yield file.upload, *result
+
+    async def finalize(self, out, params: dict, order: Optional[List[int]]) -> ConversionProgress:
+        """
+        Write the pages at ``order`` as the merged PDF (or split ZIP) of
+        ``params["mode"]`` to ``out``.  Only pages still being processed are
+        waited for; afterwards the session is closed either way.  Raises
+        SessionError, or ConversionError like write_output.
+        """
+        self.check_open()
+        if self.receiving:
+            raise SessionError("Files are still being uploaded")
+        order = self.resolve_order(order)
+        if not order:
+            raise SessionError("No files uploaded", status_code=400)
+        self.state = 'finalizing'
+        # Numbered in the final order, as if they had come in one /convert request
+        uploads = []
+        for index, position in enumerate(order):
+            upload = self.files[position].upload
+            upload.index, upload.ordered_name = index, ordered_upload_name(index, upload.filename)
+            uploads.append(upload)
+        progress = ConversionProgress(uploads)
+        try:
+            await write_output(out, uploads, params, page_options(params), self.max_in_flight, progress,
+                               results=self.results(order, split_renderer(params["mode"])))
+            self.state = 'complete'
+        finally:
+            if self.state != 'complete':
+                self.state = 'failed'
+            progress.state = self.state
+            self.report = progress.status()
+            self.close()
+        return progress
+
+    def close(self):
+        """Cancel the processing still going on and release the pages"""
+        for file in self.files.values():
+            file.task.cancel()
+        self.files = {}
+
+    def status(self) -> dict:
+        """Public view for GET /sessions/{id}"""
+        view = {
+            'session_id': self.id,
+            'state': self.state,
+            'created_at': self.created_at,
+            'receiving': self.receiving,
+            'files': [{'position': file.position, 'filename': file.upload.filename,
+                       'size': file.upload.size, 'state': file.state}
+                      for file in sorted(self.files.values(), key=lambda file: file.position)],
+        }
+        if self.report is not None:
+            view.update(self.report, state=self.state)
+        return view
+
+
+class SessionManager:
+    """Open upload sessions, each in its own directory under ``root``"""
+
+    def __init__(self, root: str, max_open: int = config.MAX_OPEN_SESSIONS):
+        self.root = root
+        self.max_open = max_open
+        self.sessions: Dict[str, Session] = {}
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid4().hex
+
+    def directory(self, session_id: str) -> str:
+        return os.path.join(self.root, session_id)
+
+    @property
+    def open_count(self) -> int:
+        return sum(1 for session in self.sessions.values() if session.state == 'open')
+
+    def create(self, session_id: str, params: dict) -> Session:
+        """Open a session whose directory already exists"""
+        if self.open_count >= self.max_open:
+            raise SessionLimit(f"Too many open upload sessions (limit {self.max_open})")
+        session = Session(id=session_id, directory=self.directory(session_id), params=params)
+        self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def forget(self, directory: str):
+        """Drop the session whose directory the janitor removed"""
+        if os.path.dirname(os.path.normpath(directory)) != os.path.normpath(self.root):
+            return
+        session = self.sessions.pop(os.path.basename(directory), None)
+        if session is not None:
+            if session.state == 'open':
+                logger.info("⌛ Upload session %s expired with %d files", session.id, len(session.files))
+            session.close()
+
+    def stop(self):
+        """Cancel the processing of every session (on shutdown; sessions are not persisted)"""
+        for session in self.sessions.values():
+            session.close()
+
+
+session_manager = SessionManager(os.path.join(config.TEMP_ROOT, 'sessions'))
@@ -0,0 +1,117 @@
+import asyncio
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from admission import AdmissionController, AdmissionMiddleware, client_address
+from conversion import check_pixel_budget
+from uploads import IngestedUpload, UploadError
+
+
+def _scope(client, path='/convert', method='POST', headers=()):
+    return {'type': 'http', 'method': method, 'path': path, 'client': (client, 5000), 'headers': list(headers)}
+
+
+async def _call(app, scope):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    return start['status'], dict(start['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+
+def test_requests_over_the_limits_are_rejected_until_slots_free_up():
+    release = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await release.wait()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    controller = AdmissionController(max_concurrent=2, max_per_client=1, retry_after=7)
+    app = AdmissionMiddleware(slow_app, controller)
+
+    async def scenario():
+        first = asyncio.create_task(_call(app, _scope('10.0.0.1')))
+        second = asyncio.create_task(_call(app, _scope('10.0.0.2')))
+        await asyncio.sleep(0)
+        same_client = await _call(app, _scope('10.0.0.1'))
+        server_full = await _call(app, _scope('10.0.0.3'))
+        # Other endpoints are not counted
+        health = asyncio.create_task(_call(app, _scope('10.0.0.3', path='/', method='GET')))
+        await asyncio.sleep(0)
+        assert controller.stats()['active'] == 2
+        release.set()
+        await asyncio.gather(first, second)
+        after = await _call(app, _scope('10.0.0.3'))
+        return same_client, server_full, await health, after
+
+    same_client, server_full, health, after = asyncio.run(scenario())
+    assert same_client[0] == 429 and same_client[1][b'retry-after'] == b'7'
+    assert server_full[0] == 503 and server_full[1][b'retry-after'] == b'7'
+    assert 'busy' in json.loads(server_full[2])['error']
+    assert health[0] == 200
+    assert after[0] == 200
+    assert controller.stats()['active'] == 0
+    assert controller.stats()['rejected'] == 2
+
+
+def test_session_uploads_and_finalize_are_admitted_like_conversions():
+    release = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await release.wait()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    controller = AdmissionController(max_concurrent=0, max_per_client=1)
+    app = AdmissionMiddleware(slow_app, controller, paths=(
+        '/convert', '/sessions/{session_id}/files/{position}', '/sessions/{session_id}/finalize'))
+
+    async def scenario():
+        upload = asyncio.create_task(_call(app, _scope('10.0.0.1', path='/sessions/ab12/files/0', method='PUT')))
+        await asyncio.sleep(0)
+        statuses = [(await _call(app, _scope('10.0.0.1', path=path, method=method)))[0]
+                    for method, path in [('PUT', '/sessions/ab12/files/1'), ('POST', '/sessions/ab12/finalize')]]
+        # Opening a session and deleting a file do no page work
+        others = [asyncio.create_task(_call(app, _scope('10.0.0.1', path=path, method=method)))
+                  for method, path in [('POST', '/sessions'), ('DELETE', '/sessions/ab12/files/0')]]
+        await asyncio.sleep(0)
+        release.set()
+        await upload
+        return statuses + [(await task)[0] for task in others]
+
+    assert asyncio.run(scenario()) == [429, 429, 200, 200]
+    assert controller.stats()['active'] == 0
+
+
+def test_client_address_prefers_the_configured_proxy_header():
+    scope = _scope('10.0.0.9', headers=[(b'x-forwarded-for', b'203.0.113.5, 10.0.0.1')])
+    assert client_address(scope, 'X-Forwarded-For') == '203.0.113.5'
+    assert client_address(scope, '') == '10.0.0.9'
+
+
+def _upload(index, size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size).save(buffer, format='PNG')
+    data = buffer.getvalue()
+    return IngestedUpload(index=index, filename=f'{index}.png', content_type='image/png', size=len(data),
+                          sha256='', ordered_name=f'{index:03d}_{index}.png', data=data)
+
+
+def test_pixel_budget_is_checked_from_headers():
+    uploads = [_upload(0, (1000, 1000)), _upload(1, (1000, 500)),
+               IngestedUpload(2, 'notes.txt', 'text/plain', 5, '', '002_notes.txt', data=b'hello')]
+
+    asyncio.run(check_pixel_budget(uploads, budget=1_500_000))
+    with pytest.raises(UploadError) as excinfo:
+        asyncio.run(check_pixel_budget(uploads, budget=1_499_999))
+    assert excinfo.value.status_code == 413
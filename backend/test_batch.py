@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import io
+import json
+import zipfile
+from collections import Counter
+
+import PyPDF2
+import pytest
+from PIL import Image
+from reportlab.pdfgen import canvas
+
+import conversion
+from batch import BATCH_REPORT_NAME, parse_batch_fields, stream_batch
+from uploads import IngestedUpload, UploadError, ordered_upload_name
+
+
+pytestmark = pytest.mark.usefixtures("thread_engine")
+
+
+def _jpeg(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (300, 400), color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def _pdf():
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=(612, 792))
+    c.drawString(72, 700, "Statement")
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def _uploads(files):
+    return [IngestedUpload(index=index, filename=name, content_type='application/octet-stream', size=len(data),
+                           sha256=hashlib.sha256(data).hexdigest(), ordered_name=ordered_upload_name(index, name),
+                           data=data)
+            for index, (name, data) in enumerate(files)]
+
+
+def _manifest(*documents):
+    return json.dumps({"documents": list(documents)})
+
+
+def test_documents_share_processed_files_and_stream_as_one_archive(monkeypatch):
+    processed = Counter()
+    page_worker = conversion.PIPELINES['single']
+
+    def counting_worker(source, filename, *args):
+        processed[filename] += 1
+        return page_worker(source, filename, *args)
+
+    monkeypatch.setitem(conversion.PIPELINES, 'single', counting_worker)
+    shared = _jpeg((20, 120, 200))
+    uploads = _uploads([('smith.jpg', _jpeg((200, 120, 40))), ('doe.jpg', _jpeg((40, 200, 120))),
+                        ('bank.jpg', shared), ('statement.pdf', _pdf()), ('bank.jpg', shared),
+                        ('notes.txt', b'not an image')])
+    params, documents = parse_batch_fields({"pipeline": "single", "manifest": _manifest(
+        {"name": "smith", "files": ["smith.jpg", "bank.jpg", "statement.pdf"]},
+        {"name": "doe", "files": [1, 4], "mode": "split"},
+        {"name": "notes", "files": ["notes.txt"]},
+    )}, uploads)
+
+    async def run():
+        report, chunks = {}, []
+        async for chunk in stream_batch(documents, params, conversion.page_options(params), 2, report):
+            chunks.append(chunk)
+        return report, b''.join(chunks)
+
+    report, data = asyncio.run(run())
+    # The bank statement photo was attached twice and used by two documents
+    assert processed == {'smith.jpg': 1, 'doe.jpg': 1, 'bank.jpg': 1, 'notes.txt': 1}
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['smith.pdf', 'doe/doe.pdf', 'doe/bank.pdf', BATCH_REPORT_NAME]
+        assert len(PyPDF2.PdfReader(io.BytesIO(zf.read('smith.pdf'))).pages) == 3
+        assert json.loads(zf.read(BATCH_REPORT_NAME)) == report
+    assert report["processed_files"] == 5 and report["shared_files"] == 1
+    smith, doe, notes = report["documents"]
+    assert smith["processed_images"] == 3 and smith["page_classes"].endswith(",pdf")
+    assert doe["entries"] == ['doe/doe.pdf', 'doe/bank.pdf']
+    assert "error" in notes and notes["skipped_files"][0]["filename"] == 'notes.txt'
+
+
+def test_a_batch_without_pages_yields_nothing():
+    uploads = _uploads([('notes.txt', b'not an image')])
+    params, documents = parse_batch_fields({"manifest": _manifest({"name": "notes", "files": [0]})}, uploads)
+
+    async def run():
+        report = {}
+        chunks = [chunk async for chunk in stream_batch(documents, params, conversion.page_options(params), 2,
+                                                        report)]
+        return report, chunks
+
+    report, chunks = asyncio.run(run())
+    assert chunks == [] and "error" in report["documents"][0]
+
+
+@pytest.mark.parametrize("manifest", [
+    "{not json",
+    json.dumps({"documents": []}),
+    _manifest({"name": "a", "files": ["missing.jpg"]}),
+    _manifest({"name": "a", "files": [7]}),
+    _manifest({"name": "a", "files": [0]}, {"name": "A", "files": [0]}),
+    _manifest({"name": "a", "files": ["scan.jpg"]}),
+    _manifest({"name": "a", "files": [0], "mode": "zip"}),
+    _manifest({"name": " ", "files": [0]}),
+])
+def test_bad_manifests_are_rejected(manifest):
+    # Two different files under one name can only be referred to by position
+    uploads = _uploads([('scan.jpg', _jpeg((1, 2, 3))), ('scan.jpg', _jpeg((200, 2, 3)))])
+    with pytest.raises(UploadError):
+        parse_batch_fields({"manifest": manifest}, uploads)
@@ -0,0 +1,105 @@
+import io
+import os
+import time
+
+from PIL import Image
+
+from cache import DiskCache, PageCache, cache_key
+from pipeline import PageOptions, prepare_page
+
+
+def _artifact(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def test_cache_key_depends_on_order_names_and_params():
+    files = [('a' * 64, 'one.jpg'), ('b' * 64, 'two.jpg')]
+    key = cache_key(files, {'mode': 'merge'})
+
+    assert key == cache_key(list(files), {'mode': 'merge'})
+    assert key != cache_key(files[::-1], {'mode': 'merge'})
+    assert key != cache_key([('a' * 64, 'renamed.jpg'), files[1]], {'mode': 'merge'})
+    assert key != cache_key(files, {'mode': 'split'})
+
+
+def test_hits_misses_and_lru_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=2500)
+
+    assert cache.get('first') is None
+    cache.put_file('first', _artifact(tmp_path, 'first.pdf', 1000), {'name': 'first'})
+    cache.put_file('second', _artifact(tmp_path, 'second.pdf', 1000), {'name': 'second'})
+
+    entry = cache.get('first')
+    assert entry.meta == {'name': 'first'}
+    with open(entry.path, 'rb') as f, open(tmp_path / 'first.pdf', 'rb') as original:
+        assert f.read() == original.read()
+
+    # 'second' is now the least recently used entry and makes room
+    cache.put_file('third', _artifact(tmp_path, 'third.pdf', 1000), {'name': 'third'})
+    assert cache.get('second') is None
+    assert cache.get('third') is not None
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 2, 1)
+    assert (stats['entries'], stats['bytes']) == (2, 2000)
+
+
+def test_entries_and_recency_survive_a_restart(tmp_path):
+    directory = str(tmp_path / 'cache')
+    cache = DiskCache(directory, max_bytes=2500)
+    cache.put_file('old', _artifact(tmp_path, 'old.pdf', 1000), {})
+    cache.put_file('new', _artifact(tmp_path, 'new.pdf', 1000), {})
+    time.sleep(0.01)
+    cache.get('old')
+
+    restarted = DiskCache(directory, max_bytes=2500)
+    restarted.put_bytes('newest', b'x' * 1000, {})
+
+    assert restarted.get('new') is None
+    assert restarted.get('old') is not None
+    assert restarted.get('newest') is not None
+
+
+def test_a_served_copy_outlives_the_evicted_entry(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=1500)
+    cache.put_file('first', _artifact(tmp_path, 'first.pdf', 1000), {})
+    served = str(tmp_path / 'response.pdf')
+
+    entry = cache.get('first', copy_to=served)
+    assert entry.path == served
+    # Evicting the entry while the response is still being sent
+    cache.put_file('second', _artifact(tmp_path, 'second.pdf', 1000), {})
+    assert cache.get('first') is None
+    with open(served, 'rb') as f, open(tmp_path / 'first.pdf', 'rb') as original:
+        assert f.read() == original.read()
+
+    # Data that is gone is a miss, not an entry pointing nowhere
+    os.remove(cache._paths('second')[0])
+    assert cache.get('second', copy_to=str(tmp_path / 'other.pdf')) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=0)
+    assert cache.put_bytes('key', b'data', {}) is None
+    assert cache.get('key') is None
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def test_page_cache_round_trips_pages_independent_of_position(tmp_path):
+    cache = PageCache(DiskCache(str(tmp_path / 'pages'), max_bytes=10 * 1024 * 1024))
+    source = io.BytesIO()
+    Image.new('RGB', (900, 600), 'navy').save(source, format='PNG')
+    page = prepare_page(source.getvalue(), 'visa.png', 3)
+
+    key = PageCache.key('c' * 64, 'visa.png', 'single', PageOptions())
+    assert key == PageCache.key('c' * 64, 'visa.png', 'single', PageOptions())
+    assert key != PageCache.key('c' * 64, 'visa_renamed.png', 'single', PageOptions())
+    assert key != PageCache.key('c' * 64, 'visa.png', 'legacy', PageOptions())
+    assert key != PageCache.key('c' * 64, 'visa.png', 'single', PageOptions(label_mode='vector'))
+
+    assert cache.get(key) is None
+    cache.put(key, page)
+    assert cache.get(key) == page
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import io
+import os
+import threading
+import time
+import zipfile
+
+import PyPDF2
+import pytest
+from PIL import Image
+from reportlab.pdfgen import canvas
+
+import config
+import conversion
+import pipeline
+from cache import DiskCache, PageCache
+from conversion import ConversionProgress, document_headers, write_output
+from executor import ExecutionEngine
+from pipeline import PageOptions
+from uploads import IngestedUpload, ordered_upload_name
+
+PARAMS = {"mode": "merge", "pipeline": "single", "label_mode": "raster", "zip_compression": "stored",
+          "max_in_flight": 0, "stream": False}
+
+
+pytestmark = pytest.mark.usefixtures("thread_engine")
+
+
+def _jpeg(size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def _tiff(frames):
+    buffer = io.BytesIO()
+    images = [Image.new('RGB', (400, 500 + 10 * i), (30 * i, 90, 30)) for i in range(frames)]
+    images[0].save(buffer, format='TIFF', save_all=True, append_images=images[1:])
+    return buffer.getvalue()
+
+
+def _pdf(pages):
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    for number in range(pages):
+        c.drawString(72, 700, f"Statement page {number + 1}")
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def _uploads(files):
+    return [IngestedUpload(index=index, filename=name, content_type='application/octet-stream', size=len(data),
+                           sha256=hashlib.sha256(data).hexdigest(), ordered_name=ordered_upload_name(index, name),
+                           data=data)
+            for index, (name, data) in enumerate(files)]
+
+
+def _convert(files, mode):
+    uploads = _uploads(files)
+    progress = ConversionProgress(uploads)
+    out = io.BytesIO()
+    asyncio.run(write_output(out, uploads, dict(PARAMS, mode=mode), PageOptions(), 4, progress))
+    return out.getvalue(), progress
+
+
+def test_pdf_and_tiff_uploads_expand_to_pages_in_upload_order():
+    files = [('passport.jpg', _jpeg((300, 400))), ('scans.tiff', _tiff(3)),
+             ('statement.pdf', _pdf(2)), ('notes.txt', b'not an image')]
+    data, progress = _convert(files, 'merge')
+
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    assert len(reader.pages) == 6
+    assert 'Statement page 2' in reader.pages[5].extract_text()
+    assert [(info['original_name'], info['index'], info.get('source_page')) for info in progress.file_info] == [
+        ('passport.jpg', 0, None),
+        ('scans.tiff', 1, 1), ('scans.tiff', 2, 2), ('scans.tiff', 3, 3),
+        ('statement.pdf', 4, 1), ('statement.pdf', 5, 2),
+    ]
+    assert [info['encoding'] for info in progress.file_info][-2:] == ['pdf', 'pdf']
+    assert [page.get('page_count') for page in progress.pages] == [1, 3, 2, None]
+    assert progress.headers()['X-Processed-Images'] == '6'
+    assert progress.headers()['X-Page-Classes'] == 'color,color,color,color,pdf,pdf'
+    # The download is named after the first upload and the number of documents
+    assert 'passport_and_2_more_documents.pdf' in document_headers('merge', progress)['Content-Disposition']
+
+
+def test_split_mode_keeps_each_uploads_pages_together():
+    files = [('scans.tiff', _tiff(3)), ('statement.pdf', _pdf(2)), ('passport.jpg', _jpeg((300, 400)))]
+    data, progress = _convert(files, 'split')
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['scans.pdf', 'statement.pdf', 'passport.pdf']
+        page_counts = [len(PyPDF2.PdfReader(io.BytesIO(zf.read(name))).pages) for name in zf.namelist()]
+    assert page_counts == [3, 2, 1]
+    assert progress.processed_count == 6
+
+
+@pytest.mark.parametrize('mode', ['merge', 'split'])
+def test_pdf_uploads_are_parsed_and_rendered_on_the_pool(monkeypatch, mode):
+    threads = []
+
+    def on_thread(fn):
+        def recorded(*args, **kwargs):
+            threads.append((fn.__name__, threading.current_thread().name))
+            return fn(*args, **kwargs)
+        return recorded
+
+    monkeypatch.setattr(pipeline, 'open_pdf', on_thread(pipeline.open_pdf))
+    monkeypatch.setattr(pipeline, 'write_prepared_pdf', on_thread(pipeline.write_prepared_pdf))
+    data, progress = _convert([('statement.pdf', _pdf(2)), ('passport.jpg', _jpeg((300, 400)))], mode)
+
+    assert progress.processed_count == 3
+    assert ('open_pdf' in dict(threads)) and (mode == 'merge' or 'write_prepared_pdf' in dict(threads))
+    # The engine's threads, never the event loop's or asyncio.to_thread's
+    assert all(name.startswith('snapmerge') for _, name in threads)
+
+
+def _counting(fn, running, peaks, lock):
+    def counted(*args):
+        with lock:
+            running[0] += 1
+            peaks.append(running[0])
+        try:
+            time.sleep(0.02)
+            return fn(*args)
+        finally:
+            with lock:
+                running[0] -= 1
+    return counted
+
+
+def test_uploads_and_frames_share_the_requests_in_flight_limit(monkeypatch):
+    monkeypatch.setattr(conversion, "engine", ExecutionEngine(kind='thread', max_workers=8))
+    running, lock = [0], threading.Lock()
+    process_peaks, measure_peaks = [], []
+    monkeypatch.setitem(conversion.PIPELINES, 'single',
+                        _counting(conversion.PIPELINES['single'], running, process_peaks, lock))
+    monkeypatch.setattr(conversion, 'measure_target_sizes',
+                        _counting(conversion.measure_target_sizes, running, measure_peaks, lock))
+    uploads = _uploads([(f'scans{i}.tiff', _tiff(4)) for i in range(3)])
+    progress = ConversionProgress(uploads)
+    params = dict(PARAMS, target_bytes=10 ** 9)
+    asyncio.run(write_output(io.BytesIO(), uploads, params, PageOptions(), 2, progress))
+
+    assert progress.processed_count == 12
+    # Both the size search and the conversion run two pages at a time, never more
+    assert max(measure_peaks) == max(process_peaks) == 2
+
+
+def _photo(seed):
+    buffer = io.BytesIO()
+    Image.effect_noise((1600, 1200), 30 + seed).convert('RGB').save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('mode', ['merge', 'split'])
+def test_target_bytes_fits_each_document_into_the_budget(mode):
+    files = [(f'photo{i}.jpg', _photo(i)) for i in range(3)] + [('statement.pdf', _pdf(1))]
+    full, _ = _convert(files, mode)
+    target = len(full) // 3 if mode == 'merge' else 150_000
+
+    uploads = _uploads(files)
+    progress = ConversionProgress(uploads)
+    out = io.BytesIO()
+    params = dict(PARAMS, mode=mode, target_bytes=target)
+    asyncio.run(write_output(out, uploads, params, PageOptions(), 4, progress))
+
+    headers = progress.headers()
+    assert headers['X-Target-Met'] == 'true'
+    if mode == 'merge':
+        assert len(out.getvalue()) <= target
+        assert headers['X-Document-Bytes'] == str(len(out.getvalue()))
+    else:
+        with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+            sizes = [len(zf.read(name)) for name in zf.namelist()]
+        assert max(sizes) <= target
+        assert headers['X-Document-Bytes'] == ",".join(map(str, sizes))
+    settings = headers['X-Page-Settings'].split(',')
+    assert len(settings) == 4 and settings[-1] == 'pdf' and all(s.startswith('q') for s in settings[:3])
+    assert progress.status()['target']['estimated_bytes']
+
+
+def test_target_bytes_conversion_reuses_the_chosen_encodes(monkeypatch, tmp_path):
+    files = [(f'photo{i}.jpg', _photo(i)) for i in range(2)]
+    params = dict(PARAMS, target_bytes=250_000)
+    expected = io.BytesIO()
+    asyncio.run(write_output(expected, _uploads(files), params, PageOptions(), 4, ConversionProgress(_uploads(files))))
+
+    monkeypatch.setattr(conversion, "page_cache", PageCache(DiskCache(str(tmp_path / "pages"), 1 << 26)))
+    monkeypatch.setattr(config, "TEMP_ROOT", str(tmp_path / "temp"))
+    encoded = []
+    monkeypatch.setitem(conversion.PIPELINES, 'single', lambda *args: encoded.append(args))
+    uploads = _uploads(files)
+    progress = ConversionProgress(uploads)
+    out = io.BytesIO()
+    asyncio.run(write_output(out, uploads, params, PageOptions(), 4, progress))
+
+    # The measured encodes of the chosen steps are converted, nothing is encoded again
+    assert not encoded
+    assert progress.processed_count == 2 and progress.target_met
+    assert out.getvalue() == expected.getvalue()
+    # and the spool is gone
+    assert os.listdir(tmp_path / "temp") == []
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from executor import ExecutionEngine, TaskTimeoutError, ordered_window
+
+
+def _slow_square(value, delay):
+    time.sleep(delay)
+    return value * value
+
+
+@pytest.mark.parametrize("kind", ["thread", "process"])
+def test_engine_runs_tasks_off_the_event_loop(kind):
+    engine = ExecutionEngine(kind=kind, max_workers=2, task_timeout=30)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        tick_task = asyncio.create_task(ticker())
+        result = await engine.run(_slow_square, 7, 0.3)
+        tick_task.cancel()
+        return result, ticks
+
+    try:
+        result, ticks = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+
+    assert result == 49
+    # The loop kept ticking while the worker slept
+    assert ticks > 5
+
+
+def test_engine_task_timeout():
+    engine = ExecutionEngine(kind="thread", max_workers=1, task_timeout=0.05)
+    try:
+        with pytest.raises(TaskTimeoutError):
+            asyncio.run(engine.run(_slow_square, 2, 0.5))
+    finally:
+        engine.shutdown()
+
+
+def test_engine_shutdown_is_idempotent():
+    engine = ExecutionEngine(kind="thread", max_workers=1)
+    engine.start()
+    assert engine.running
+    engine.shutdown()
+    engine.shutdown()
+    assert not engine.running
+
+
+def _checked_square(value, delay):
+    if value < 0:
+        raise ValueError("negative")
+    return _slow_square(value, delay)
+
+
+def test_ordered_window_yields_in_input_order_within_the_window():
+    engine = ExecutionEngine(kind="thread", max_workers=4)
+    consumed = []
+
+    def args():
+        # Later items finish first; a negative one fails
+        for value in [5, 4, 3, -1, 2, 1]:
+            consumed.append(value)
+            yield value, value / 100 if value > 0 else 0
+
+    async def scenario():
+        results = []
+        async for result in ordered_window((engine.run(_checked_square, *item) for item in args()), window=2):
+            # Never more than the window has been started beyond this result
+            assert len(consumed) <= len(results) + 1 + 2
+            results.append(result)
+        return results
+
+    try:
+        results = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+
+    assert results[:3] == [25, 16, 9]
+    assert isinstance(results[3], ValueError)
+    assert results[4:] == [4, 1]
@@ -0,0 +1,92 @@
+import asyncio
+import os
+
+import janitor
+from janitor import TempJanitor
+
+NOW = 1_000_000.0
+
+
+def _directory(root, name, size, age):
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'upload.bin'), 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (NOW - age, NOW - age))
+    return path
+
+
+def test_sweep_expires_each_area_by_its_ttl_and_spares_directories_in_use(tmp_path):
+    root, jobs = str(tmp_path / 'temp'), str(tmp_path / 'temp' / 'jobs')
+    old_request = _directory(root, 'old', 10, age=700)
+    fresh_request = _directory(root, 'fresh', 10, age=60)
+    held_request = _directory(root, 'held', 10, age=700)
+    old_job = _directory(jobs, 'finished', 10, age=700)
+    running_job = _directory(jobs, 'running', 10, age=99_999)
+
+    sweeper = TempJanitor({root: 600, jobs: 86_400}, in_use=lambda path: path.endswith('running'))
+    sweeper.hold(held_request)
+    removed = sweeper.sweep(now=NOW)
+
+    assert removed == {'expired': [old_request], 'evicted': []}
+    # The jobs area itself is not a request directory, and its entries keep their own TTL
+    for path in (fresh_request, held_request, jobs, old_job, running_job):
+        assert os.path.exists(path)
+
+    sweeper.release(held_request)
+    assert sorted(sweeper.sweep(now=NOW + 100_000)['expired']) == sorted([fresh_request, held_request, old_job])
+    stats = sweeper.stats()
+    assert stats['entries'] == 1 and stats['bytes'] == 10 and stats['expired'] == 4
+    assert stats['areas'][jobs]['entries'] == 1 and stats['areas'][root]['entries'] == 0
+
+
+def test_quota_evicts_the_oldest_directories_first(tmp_path):
+    root = str(tmp_path)
+    oldest = _directory(root, 'a', 400, age=500)
+    older = _directory(root, 'b', 400, age=400)
+    newer = _directory(root, 'c', 400, age=300)
+    recent = _directory(root, 'd', 400, age=10)
+
+    sweeper = TempJanitor({root: 0}, max_bytes=900, grace=60)
+    removed = sweeper.sweep(now=NOW)
+
+    assert removed == {'expired': [], 'evicted': [oldest, older]}
+    assert os.path.exists(newer) and os.path.exists(recent)
+    assert sweeper.total_bytes == 800
+
+
+def test_only_new_or_changed_directories_are_walked(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    for index in range(50):
+        _directory(root, f'request-{index}', 1, age=5)
+    walked = []
+    real_size = janitor.directory_size
+    monkeypatch.setattr(janitor, 'directory_size', lambda path: walked.append(path) or real_size(path))
+
+    sweeper = TempJanitor({root: 600})
+    sweeper.sweep(now=NOW)
+    assert len(walked) == 50
+
+    walked.clear()
+    changed = _directory(root, 'request-7', 100, age=1)
+    added = _directory(root, 'request-new', 1, age=1)
+    sweeper.sweep(now=NOW)
+    assert sorted(walked) == sorted([changed, added])
+    assert sweeper.total_bytes == 49 + 100 + 1
+
+
+def test_scheduled_sweeps_report_removals_on_the_loop(tmp_path):
+    root = str(tmp_path)
+    expired = _directory(root, 'gone', 1, age=NOW)
+    forgotten = []
+
+    async def scenario():
+        sweeper = TempJanitor({root: 600}, interval=0.01, on_remove=forgotten.append)
+        await sweeper.start()
+        await asyncio.sleep(0.05)
+        await sweeper.stop()
+        return sweeper.stats()['sweeps']
+
+    assert asyncio.run(scenario()) > 1
+    assert forgotten == [expired]
+    assert not os.path.exists(expired)
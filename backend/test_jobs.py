@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+
+import PyPDF2
+import pytest
+from PIL import Image
+
+import conversion
+import jobs
+from cache import DiskCache
+from jobs import Job, JobManager, JobQueueFull
+from uploads import IngestedUpload, ordered_upload_name
+
+PARAMS = {"mode": "merge", "pipeline": "single", "label_mode": "raster", "zip_compression": "stored",
+          "max_in_flight": 0, "stream": False}
+
+
+pytestmark = pytest.mark.usefixtures("thread_engine")
+
+
+@pytest.fixture(autouse=True)
+def _without_result_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "result_cache", DiskCache(str(tmp_path / "results"), 0))
+
+
+def _uploads(directory, names):
+    """Uploads already spilled to the job directory, as POST /jobs leaves them"""
+    os.makedirs(directory, exist_ok=True)
+    uploads = []
+    for index, name in enumerate(names):
+        if name.startswith('broken'):
+            data = b'not an image'
+        else:
+            buffer = io.BytesIO()
+            Image.new('RGB', (300, 400), (index * 60, 90, 30)).save(buffer, format='JPEG')
+            data = buffer.getvalue()
+        ordered_name = ordered_upload_name(index, name)
+        path = os.path.join(directory, ordered_name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        uploads.append(IngestedUpload(index=index, filename=name, content_type='image/jpeg', size=len(data),
+                                      sha256=hashlib.sha256(data).hexdigest(), ordered_name=ordered_name,
+                                      path=path))
+    return uploads
+
+
+async def _wait_finished(manager, job_id):
+    for _ in range(200):
+        if manager.jobs[job_id].finished:
+            return manager.jobs[job_id]
+        await asyncio.sleep(0.02)
+    raise AssertionError("job did not finish")
+
+
+def test_job_reports_per_page_progress_and_persists_its_result(tmp_path):
+    root = str(tmp_path / "jobs")
+
+    async def scenario():
+        manager = JobManager(root, workers=1, max_queued=1)
+        await manager.start()
+        try:
+            job_id = manager.new_job_id()
+            uploads = _uploads(manager.directory(job_id), ['passport.jpg', 'broken.jpg', 'visa.jpg'])
+            await manager.submit(job_id, PARAMS, uploads)
+            return await _wait_finished(manager, job_id)
+        finally:
+            await manager.stop()
+
+    job = asyncio.run(scenario())
+    status = job.status()
+    assert status['state'] == 'complete'
+    assert status['processed_images'] == 2
+    assert [page['state'] for page in status['pages']] == ['done', 'skipped', 'done']
+    assert all(page['seconds'] >= 0 for page in status['pages'])
+    assert status['result_url'] == f"/jobs/{job.id}/result"
+    assert len(PyPDF2.PdfReader(job.result['path']).pages) == 2
+    # Inputs are removed, the result and the record stay
+    assert sorted(os.listdir(job.directory)) == ['job.json', 'snapmerge_ordered.pdf']
+
+    # A new manager (a restarted server) finds the completed job on disk
+    restarted = JobManager(root)
+    assert restarted.load() == []
+    assert restarted.jobs[job.id].status()['pages'] == status['pages']
+    assert restarted.jobs[job.id].result == job.result
+
+
+def test_interrupted_jobs_resume_after_restart(tmp_path):
+    root = str(tmp_path / "jobs")
+    job_id = JobManager.new_job_id()
+    directory = os.path.join(root, job_id)
+    job = Job(id=job_id, directory=directory, params=PARAMS, uploads=_uploads(directory, ['id.jpg']),
+              state='running')
+    JobManager(root).save(job)
+
+    async def scenario():
+        manager = JobManager(root, workers=1)
+        await manager.start()
+        try:
+            return await _wait_finished(manager, job_id)
+        finally:
+            await manager.stop()
+
+    assert asyncio.run(scenario()).state == 'complete'
+    with open(os.path.join(directory, 'job.json')) as f:
+        assert json.load(f)['state'] == 'complete'
+
+
+def test_full_queue_rejects_new_jobs(tmp_path):
+    async def scenario():
+        # Workers are not started, so submitted jobs stay queued
+        manager = JobManager(str(tmp_path / "jobs"), max_queued=1)
+        manager._queue = asyncio.Queue()
+        first = manager.new_job_id()
+        await manager.submit(first, PARAMS, _uploads(manager.directory(first), ['a.jpg']))
+        second = manager.new_job_id()
+        with pytest.raises(JobQueueFull):
+            await manager.submit(second, PARAMS, _uploads(manager.directory(second), ['b.jpg']))
+
+    asyncio.run(scenario())
+
+
+def test_a_job_converts_when_the_cached_result_has_gone(tmp_path, monkeypatch):
+    results = DiskCache(str(tmp_path / "results"), 10 * 1024 * 1024)
+    monkeypatch.setattr(jobs, "result_cache", results)
+
+    async def scenario():
+        manager = JobManager(str(tmp_path / "jobs"), workers=1)
+        await manager.start()
+        try:
+            finished = []
+            for _ in range(3):
+                job_id = manager.new_job_id()
+                await manager.submit(job_id, PARAMS, _uploads(manager.directory(job_id), ['id.jpg', 'visa.jpg']))
+                finished.append(await _wait_finished(manager, job_id))
+                if len(finished) == 2:
+                    # Evicted (or deleted by hand) before the next job gets to it
+                    for name in os.listdir(results.directory):
+                        if name.endswith('.data'):
+                            os.remove(os.path.join(results.directory, name))
+            return finished
+        finally:
+            await manager.stop()
+
+    converted, cached, reconverted = asyncio.run(scenario())
+    assert [job.state for job in (converted, cached, reconverted)] == ['complete'] * 3
+    assert cached.report.get('cached_result') and 'cached_result' not in reconverted.report
+    assert reconverted.report['processed_images'] == 2
+    assert len(PyPDF2.PdfReader(reconverted.result['path']).pages) == 2
+    # Its uploads were discarded like any finished job's
+    assert sorted(os.listdir(reconverted.directory)) == ['job.json', 'snapmerge_ordered.pdf']
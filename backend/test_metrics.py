@@ -0,0 +1,67 @@
+import io
+import json
+import logging
+
+from PIL import Image
+
+import metrics
+from logs import JsonFormatter, TextFormatter
+from metrics import Counter, Gauge, Histogram, observe_stages, stage
+from pipeline import PageOptions, prepare_page
+
+
+def test_metrics_render_in_the_prometheus_text_format():
+    histogram = Histogram('test_seconds', 'A test histogram', ('stage',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, stage='decode')
+    counter = Counter('test_files', 'A test counter')
+    counter.inc()
+    counter.inc(2)
+    gauge = Gauge('test_jobs', 'A test gauge', ('state',), function=lambda: {('queued',): 3})
+
+    assert histogram.render().splitlines() == [
+        '# HELP test_seconds A test histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="decode",le="0.1"} 1',
+        'test_seconds_bucket{stage="decode",le="1"} 3',
+        'test_seconds_bucket{stage="decode",le="+Inf"} 4',
+        'test_seconds_sum{stage="decode"} 4.25',
+        'test_seconds_count{stage="decode"} 4',
+    ]
+    assert counter.render().splitlines()[-1] == 'test_files_total 3'
+    assert gauge.render().splitlines()[-1] == 'test_jobs{state="queued"} 3'
+
+
+def test_page_workers_collect_their_stage_timings_for_the_web_process():
+    buffer = io.BytesIO()
+    Image.new('RGBA', (1600, 1200), (20, 40, 60, 255)).save(buffer, format='PNG')
+    before = {name: metrics.STAGE_SECONDS.count(stage=name) for name in ('decode', 'resize', 'encode', 'label')}
+
+    page = prepare_page(buffer.getvalue(), 'passport.png', 1, PageOptions())
+
+    # Collected on the page instead of observed where the worker runs
+    assert set(page.timings) == {'decode', 'resize', 'encode', 'label'}
+    assert all(seconds >= 0 for seconds in page.timings.values())
+    assert {name: metrics.STAGE_SECONDS.count(stage=name) for name in before} == before
+
+    observe_stages(page.timings)
+    assert all(metrics.STAGE_SECONDS.count(stage=name) == count + 1 for name, count in before.items())
+
+    # Outside a collector stages are observed directly
+    count = metrics.STAGE_SECONDS.count(stage='compress')
+    with stage('compress'):
+        pass
+    assert metrics.STAGE_SECONDS.count(stage='compress') == count + 1
+
+
+def test_log_records_keep_their_extra_fields():
+    record = logging.LogRecord('snapmerge.main', logging.INFO, __file__, 1, 'PDF created with %d images', (3,),
+                               None)
+    record.mode = 'merge'
+    record.skipped_files = 1
+
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'PDF created with 3 images'
+    assert entry['level'] == 'INFO' and entry['logger'] == 'snapmerge.main'
+    assert entry['mode'] == 'merge' and entry['skipped_files'] == 1
+    assert TextFormatter().format(record).endswith('PDF created with 3 images mode="merge" skipped_files=1')
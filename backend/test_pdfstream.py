@@ -0,0 +1,120 @@
+import asyncio
+import io
+import os
+import tracemalloc
+
+import PyPDF2
+from PIL import Image
+
+import pipeline
+from executor import ExecutionEngine, ordered_window
+from pdfstream import ChunkBuffer, PdfStreamWriter
+from pipeline import PageOptions, prepare_legacy_page, prepare_page, write_prepared_page, write_prepared_pdf
+
+
+class _Unseekable(io.RawIOBase):
+    """Write-only sink, like a response body"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+def _png(size, seed=0):
+    img = Image.effect_noise(size, 40 + seed % 20).convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _noise_jpeg(size):
+    img = Image.frombytes('L', size, os.urandom(size[0] * size[1]))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=60)
+    return buffer.getvalue()
+
+
+def test_streamed_pdf_is_readable_without_seeking():
+    source = _png((900, 700))
+    pages = [
+        prepare_page(source, 'scan_one.png', 1),
+        prepare_legacy_page(source, 'scan_two.png', 2),
+        prepare_page(source, 'statement.png', 3, PageOptions(label_mode='vector')),
+        prepare_page(source, 'паспорт.png', 4, PageOptions(label_mode='vector')),
+    ]
+    out = _Unseekable()
+    assert write_prepared_pdf(pages, out) == 4
+
+    reader = PyPDF2.PdfReader(io.BytesIO(b''.join(out.chunks)), strict=True)
+    assert len(reader.pages) == 4
+    photo_widths = []
+    for pdf_page in reader.pages:
+        xobjects = pdf_page['/Resources']['/XObject']
+        photo_widths.append(xobjects['/Im0'].get_object()['/Width'])
+    assert photo_widths == [800, 800, 800, 800]
+    assert 'statement' in reader.pages[2].extract_text()
+    if pipeline.LABEL_FONT_PATH is not None:
+        assert 'паспорт' in reader.pages[3].extract_text()
+
+
+def test_chunk_buffer_hands_out_each_page_once_finished():
+    source = _png((600, 400))
+    pages = [prepare_page(source, f'page_{n}.png', n + 1) for n in range(3)]
+    sink = ChunkBuffer()
+    writer = PdfStreamWriter(sink)
+    chunks = []
+    for page in pages:
+        write_prepared_page(writer, page)
+        chunks.append(sink.drain())
+    writer.close()
+    chunks.append(sink.drain())
+
+    assert all(chunks) and sink.drain() == b''
+    assert chunks[0].startswith(b'%PDF-')
+    assert chunks[-1].rstrip().endswith(b'%%EOF')
+    out = io.BytesIO()
+    assert write_prepared_pdf(pages, out) == 3
+    assert b''.join(chunks) == out.getvalue()
+
+
+def _merge_peak_bytes(page_count, tmp_path):
+    """Peak Python heap while streaming page_count distinct pages into one PDF"""
+    engine = ExecutionEngine(kind='thread', max_workers=2)
+
+    async def merge(out):
+        writer = PdfStreamWriter(out)
+        # Fresh noise per page, so no two pages share image data
+        page_args = ((_noise_jpeg((600, 800)), f'page_{i}.jpg', i + 1, PageOptions()) for i in range(page_count))
+        async for page in ordered_window((engine.run(prepare_page, *args) for args in page_args), window=2):
+            write_prepared_page(writer, page)
+        writer.close()
+        return writer.page_count
+
+    tracemalloc.start()
+    try:
+        with open(tmp_path / f'merged_{page_count}.pdf', 'wb') as out:
+            written = asyncio.run(merge(out))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        engine.shutdown()
+    assert written == page_count
+    return peak
+
+
+def test_merge_memory_does_not_grow_with_page_count(tmp_path):
+    small = _merge_peak_bytes(8, tmp_path)
+    large = _merge_peak_bytes(80, tmp_path)
+
+    # Each page carries ~225 KB of JPEG data; holding all 80 would take ~18 MB
+    output_size = (tmp_path / 'merged_80.pdf').stat().st_size
+    assert output_size > 10 * 1024 * 1024
+    assert large < 4 * 1024 * 1024
+    # 72 more pages may not add more than a few pages' worth of heap
+    assert large - small < 1536 * 1024
@@ -0,0 +1,359 @@
+import io
+import zipfile
+
+import PyPDF2
+import pytest
+from PIL import Image, ImageDraw, ImageFilter, JpegImagePlugin
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+import pipeline
+from pipeline import (
+    PageOptions,
+    SplitArchive,
+    add_filename_to_image,
+    classify_page,
+    copy_pdf_pages,
+    create_professional_pdf,
+    fit_label_font,
+    fit_to_budget,
+    header_pixels,
+    inspect_upload,
+    load_label_font,
+    make_thumbnail,
+    measure_target_sizes,
+    pdf_page_sizes,
+    prepare_page,
+    process_image_file,
+    render_single_page_pdf,
+    resize_for_pdf,
+    target_step_options,
+    upload_dimensions,
+    write_prepared_pdf,
+)
+
+
+def _save(tmp_path, name, size, fmt, color=(200, 120, 40)):
+    path = tmp_path / name
+    Image.new('RGB', size, color).save(path, format=fmt)
+    return str(path)
+
+
+def _write_pdf(pages, pdf_path):
+    with open(pdf_path, 'wb') as f:
+        write_prepared_pdf(pages, f)
+
+
+def test_single_encode_passes_small_jpeg_through(tmp_path):
+    path = _save(tmp_path, 'passport.jpg', (600, 800), 'JPEG')
+    page = prepare_page(path, 'passport.jpg', 1)
+
+    assert page.encoding == 'passthrough'
+    with open(path, 'rb') as f:
+        assert page.image_data == f.read()
+
+    pdf_path = str(tmp_path / 'out.pdf')
+    _write_pdf([page], pdf_path)
+    with open(pdf_path, 'rb') as f:
+        assert page.image_data in f.read()
+
+
+def test_single_encode_resizes_large_images_once(tmp_path):
+    path = _save(tmp_path, 'scan.png', (2400, 1800), 'PNG')
+    page = prepare_page(path, 'scan.png', 1)
+
+    assert page.encoding == 'jpeg'
+    assert (page.width, page.height) == (800, 600)
+    assert Image.open(io.BytesIO(page.image_data)).format == 'JPEG'
+
+
+def test_single_encode_pdf_keeps_page_order(tmp_path):
+    pages = [
+        prepare_page(_save(tmp_path, f'{i}.jpg', (400 + i * 10, 300), 'JPEG'), f'{i}.jpg', i + 1)
+        for i in range(3)
+    ]
+    pdf_path = str(tmp_path / 'out.pdf')
+    _write_pdf(pages, pdf_path)
+
+    reader = PyPDF2.PdfReader(pdf_path)
+    assert len(reader.pages) == 3
+    widths = []
+    for pdf_page in reader.pages:
+        xobjects = pdf_page['/Resources']['/XObject']
+        photos = [x.get_object() for x in xobjects.values()
+                  if x.get_object()['/Filter'] in ('/DCTDecode', ['/DCTDecode'])]
+        widths.append(photos[0]['/Width'])
+    assert widths == [400, 410, 420]
+
+
+def test_raster_label_adds_band_under_image():
+    img = Image.new('RGB', (500, 300), 'red')
+    labeled = add_filename_to_image(img, 'birth_certificate.jpg', 1)
+
+    assert labeled.size == (800, 380)
+    # Image is centered horizontally above the label band
+    assert labeled.getpixel((150, 0)) == (255, 0, 0)
+    assert labeled.getpixel((10, 10)) == (255, 255, 255)
+
+
+def test_oversized_jpeg_is_decoded_at_reduced_scale(tmp_path):
+    path = _save(tmp_path, 'phone.jpg', (4000, 3000), 'JPEG')
+    img = resize_for_pdf(Image.open(path), max_width=800, max_height=1200)
+
+    # 1/2 scale still leaves twice the target size for the LANCZOS pass
+    assert img.info['decode_scale'] == 2
+    assert img.size == (800, 600)
+
+    page = prepare_page(path, 'phone.jpg', 1)
+    assert page.decode_scale == 2
+
+
+def test_thumbnails_are_decoded_at_reduced_scale(tmp_path, monkeypatch):
+    path = _save(tmp_path, 'phone.jpg', (4000, 3000), 'JPEG')
+    decoded_sizes = []
+    draft = JpegImagePlugin.JpegImageFile.draft
+
+    def spy(self, mode, size):
+        result = draft(self, mode, size)
+        decoded_sizes.append(self.size)
+        return result
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, 'draft', spy)
+
+    thumbnail = make_thumbnail(path, 256)
+    # 1/4 scale leaves twice the size for the LANCZOS pass; never the full 12 MP
+    assert decoded_sizes == [(1000, 750)]
+    assert (thumbnail['width'], thumbnail['height'], thumbnail['pages']) == (4000, 3000, 1)
+    assert (thumbnail['thumbnail_width'], thumbnail['thumbnail_height']) == (256, 192)
+    assert Image.open(io.BytesIO(thumbnail['data'])).size == (256, 192)
+    assert 'thumbnail' in thumbnail['timings']
+    assert upload_dimensions(path) == {'width': 4000, 'height': 3000, 'pages': 1}
+
+
+def test_images_that_fit_are_decoded_at_full_scale(tmp_path):
+    path = _save(tmp_path, 'small.png', (700, 900), 'PNG')
+    img = resize_for_pdf(Image.open(path))
+
+    assert img.info['decode_scale'] == 1
+    assert img.size == (700, 900)
+
+
+def _linear_fit(draw, text, width, max_width):
+    """The original one-step-at-a-time shrink loop, as a reference"""
+    font_size = min(32, max(18, width // 50))
+    font = load_label_font(pipeline.LABEL_FONT_PATH, font_size)
+    bbox = draw.textbbox((0, 0), text, font=font)
+    while bbox[2] - bbox[0] > max_width and font_size > 12:
+        font_size -= 2
+        font = load_label_font(pipeline.LABEL_FONT_PATH, font_size)
+        bbox = draw.textbbox((0, 0), text, font=font)
+    return font_size
+
+
+@pytest.mark.skipif(pipeline.LABEL_FONT_PATH is None, reason="no TrueType label font installed")
+@pytest.mark.parametrize("text", ["ID", "passport_scan_front", "x" * 60, "Very long document name " * 8])
+@pytest.mark.parametrize("width", [800, 1000, 1600])
+def test_label_fit_matches_linear_shrink(text, width):
+    draw = ImageDraw.Draw(Image.new('RGB', (width, 80)))
+    font, _, _ = fit_label_font(draw, text, width, width - 60)
+    assert font.size == _linear_fit(draw, text, width, width - 60)
+
+
+@pytest.mark.skipif(pipeline.LABEL_FONT_PATH is None, reason="no TrueType label font installed")
+def test_label_fonts_are_loaded_once_per_size():
+    load_label_font.cache_clear()
+    for _ in range(5):
+        add_filename_to_image(Image.new('RGB', (800, 100)), "a very long file name " * 6 + ".jpg", 1)
+    info = load_label_font.cache_info()
+    assert info.misses <= 4
+    assert info.hits > info.misses
+
+
+def test_vector_labels_are_searchable_text(tmp_path):
+    options = PageOptions(label_mode='vector')
+    path = _save(tmp_path, 'scan.png', (1200, 1600), 'PNG')
+    file_info = [{'original_name': 'bank_statement_march.png'}]
+
+    img = process_image_file(path, 'bank_statement_march.png', 1, options)
+    # No band is rasterized into the page image
+    assert img.size == (800, 1066)
+    legacy_pdf = str(tmp_path / 'legacy.pdf')
+    create_professional_pdf([img], legacy_pdf, file_info, options)
+
+    page = prepare_page(path, 'bank_statement_march.png', 1, options)
+    assert page.label_data == b''
+    single_pdf = str(tmp_path / 'single.pdf')
+    _write_pdf([page], single_pdf)
+
+    for pdf_path in (legacy_pdf, single_pdf):
+        text = PyPDF2.PdfReader(pdf_path).pages[0].extract_text()
+        assert 'bank_statement_march' in text
+
+
+def test_vector_labels_embed_a_font_only_for_non_latin_names(tmp_path):
+    options = PageOptions(label_mode='vector')
+    path = _save(tmp_path, 'photo.jpg', (600, 800), 'JPEG')
+
+    for name, embedded in (('passport.jpg', False), ('паспорт.jpg', pipeline.LABEL_FONT_PATH is not None)):
+        pdf_path = str(tmp_path / 'out.pdf')
+        _write_pdf([prepare_page(path, name, 1, options)], pdf_path)
+        fonts = PyPDF2.PdfReader(pdf_path).pages[0]['/Resources']['/Font'].values()
+        descriptors = [font.get_object()['/FontDescriptor'].get_object() for font in fonts
+                       if '/FontDescriptor' in font.get_object()]
+        assert any('/FontFile2' in descriptor for descriptor in descriptors) == embedded
+
+
+def test_vector_labels_without_a_truetype_font_replace_non_latin_characters(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'LABEL_FONT_PATH', None)
+    pipeline.vector_label_font.cache_clear()
+    try:
+        page = prepare_page(_save(tmp_path, 'photo.jpg', (600, 800), 'JPEG'), 'паспорт 2024.jpg', 1,
+                            PageOptions(label_mode='vector'))
+        pdf_path = str(tmp_path / 'out.pdf')
+        _write_pdf([page], pdf_path)
+    finally:
+        pipeline.vector_label_font.cache_clear()
+    assert '2024' in PyPDF2.PdfReader(pdf_path).pages[0].extract_text()
+
+
+class _Unseekable(io.RawIOBase):
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data.extend(data)
+        return len(data)
+
+
+@pytest.mark.parametrize('compression, compress_type', [('stored', zipfile.ZIP_STORED),
+                                                        ('deflated', zipfile.ZIP_DEFLATED)])
+def test_split_archive_streams_and_keeps_duplicate_names(tmp_path, compression, compress_type):
+    path = _save(tmp_path, 'photo.jpg', (600, 800), 'JPEG')
+    pages = [prepare_page(path, name, 1) for name in ('scan.jpg', 'other/scan.png', 'SCAN.jpeg', 'id.jpg')]
+    out = _Unseekable()
+    archive = SplitArchive(out, compression)
+    archive.add(pages[0], render_single_page_pdf(pages[0]))
+    for page in pages[1:]:
+        archive.add(page)
+    archive.close()
+
+    with zipfile.ZipFile(io.BytesIO(bytes(out.data))) as zf:
+        assert zf.namelist() == ['scan.pdf', 'scan (2).pdf', 'SCAN (3).pdf', 'id.pdf']
+        assert {info.compress_type for info in zf.infolist()} == {compress_type}
+        for name in zf.namelist():
+            assert len(PyPDF2.PdfReader(io.BytesIO(zf.read(name))).pages) == 1
+
+
+def _text_pdf(path, pages):
+    c = canvas.Canvas(str(path), pagesize=letter)
+    for number in range(pages):
+        c.drawString(72, 700, f"Bank statement page {number + 1}")
+        c.showPage()
+    c.save()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_pdf_pages_are_copied_without_rendering(tmp_path):
+    data = _text_pdf(tmp_path / 'statement.pdf', 2)
+    assert inspect_upload(data) == ('pdf', 0)
+    sizes = pdf_page_sizes(data)
+    assert sizes == [(612.0, 792.0), (612.0, 792.0)]
+
+    photo = prepare_page(_save(tmp_path, 'id.jpg', (600, 800), 'JPEG'), 'id.jpg', 1)
+    statement = copy_pdf_pages(data, 'statement.pdf')
+    assert [(page.width, page.height) for page in statement] == sizes
+    out = io.BytesIO()
+    assert write_prepared_pdf([photo, statement], out) == 3
+
+    source = PyPDF2.PdfReader(io.BytesIO(data))
+    merged = PyPDF2.PdfReader(io.BytesIO(out.getvalue()), strict=True)
+    assert len(merged.pages) == 3
+    for copy, original in zip(merged.pages[1:], source.pages):
+        assert copy.mediabox == original.mediabox
+        # Content stream bytes are carried over untouched
+        assert copy['/Contents'].get_object()._data == original['/Contents'].get_object()._data
+    assert 'Bank statement page 2' in merged.pages[2].extract_text()
+    # Resources shared by the pages of one upload are written once
+    fonts = [page['/Resources']['/Font'].get_object().raw_get('/F1') for page in merged.pages[1:]]
+    assert fonts[0].idnum == fonts[1].idnum
+
+
+def test_multi_frame_tiff_is_one_page_per_frame(tmp_path):
+    path = tmp_path / 'scan.tiff'
+    frames = [Image.new('RGB', (500 + 100 * i, 700), (40 * i, 90, 30)) for i in range(3)]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+    path = str(path)
+
+    assert inspect_upload(path) == ('image', 3)
+    assert header_pixels(path) == (500 + 600 + 700) * 700
+    pages = [prepare_page(path, 'scan.tiff', 1, frame=frame) for frame in range(3)]
+    assert [page.width for page in pages] == [500, 600, 700]
+
+    # Split mode keeps the frames of one upload in one document
+    document = PyPDF2.PdfReader(io.BytesIO(render_single_page_pdf(pages)))
+    assert len(document.pages) == 3
+
+
+def _document_scan(size=(800, 1100), paper=(255, 255, 255)):
+    """Text lines on paper, softened like a scan resized for the page"""
+    img = Image.new('RGB', size, paper)
+    draw = ImageDraw.Draw(img)
+    font = load_label_font(pipeline.LABEL_FONT_PATH, 13)
+    for y in range(40, size[1] - 40, 18):
+        draw.text((40, y), f"Line {y} of the residence permit application, employer and salary", fill=(0, 0, 0),
+                  font=font)
+    return img.filter(ImageFilter.GaussianBlur(0.6))
+
+
+def test_page_classifier_tells_color_gray_and_bilevel_pages_apart():
+    assert classify_page(_document_scan())[0] == 'bilevel'
+    # Yellowed paper is still a black-and-white document
+    assert classify_page(_document_scan(paper=(247, 242, 217)))[0] == 'bilevel'
+    signed = _document_scan(paper=(247, 242, 217))
+    ImageDraw.Draw(signed).line([(500, 1000), (700, 1050), (600, 1080)], fill=(20, 40, 200), width=4)
+    assert classify_page(signed)[0] == 'color'
+    assert classify_page(Image.linear_gradient('L').resize((800, 1100)).convert('RGB'))[0] == 'gray'
+    assert classify_page(Image.effect_noise((600, 800), 60).convert('RGB'))[0] == 'gray'
+    assert classify_page(Image.new('RGB', (600, 800), (200, 120, 40)))[0] == 'color'
+
+
+def test_auto_color_mode_encodes_document_scans_as_1_bit(tmp_path):
+    path = str(tmp_path / 'statement.png')
+    _document_scan().save(path)
+    color = prepare_page(path, 'statement.png', 1)
+    bilevel = prepare_page(path, 'statement.png', 1, PageOptions(color_mode='auto'))
+
+    assert (color.mode, color.encoding) == ('RGB', 'jpeg')
+    assert (bilevel.mode, bilevel.encoding) == ('1', 'flate')
+    assert len(bilevel.image_data) * 3 < len(color.image_data)
+
+    out = io.BytesIO()
+    write_prepared_pdf([bilevel], out)
+    image = PyPDF2.PdfReader(io.BytesIO(out.getvalue())).pages[0]['/Resources']['/XObject']['/Im0'].get_object()
+    assert (image['/BitsPerComponent'], image['/ColorSpace'], image['/Filter']) == (1, '/DeviceGray', '/FlateDecode')
+    assert len(image.get_data()) == (bilevel.width + 7) // 8 * bilevel.height
+
+
+def test_target_sizes_match_the_encodes_and_the_budget_is_filled(tmp_path, monkeypatch):
+    path = str(tmp_path / 'photo.jpg')
+    Image.effect_noise((1600, 1200), 40).convert('RGB').save(path, format='JPEG', quality=95)
+    options = PageOptions(label_mode='vector')
+    sizes = measure_target_sizes(path, 'photo.jpg', 1, options)['sizes']
+    assert len(sizes) == len(pipeline.TARGET_LADDER)
+    assert sizes == sorted(sizes, reverse=True)
+    for step in (0, 6, len(sizes) - 1):
+        page = prepare_page(path, 'photo.jpg', 1, target_step_options(options, step))
+        assert len(page.image_data) == sizes[step]
+
+    tables = [[100, 80, 60, 40, 20], [200, 150, 100, 50, 25], [90, 85, 80, 75, 70]]
+    monkeypatch.setattr(pipeline, 'TARGET_LADDER', [(1.0, 90)] * 5)
+    assert fit_to_budget(tables, 1000) == [0, 0, 0]
+    steps = fit_to_budget(tables, 230)
+    assert sum(table[step] for table, step in zip(tables, steps)) <= 230
+    # Shared step 2 (240 bytes) is over budget; from step 3 (165) the
+    # cheapest upgrades are taken until nothing fits any more
+    assert steps == [1, 3, 0]
+    assert fit_to_budget(tables, 10) == [4, 4, 4]
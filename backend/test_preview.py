@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import hashlib
+import io
+
+import pytest
+from PIL import Image
+from reportlab.pdfgen import canvas
+
+import conversion
+import preview
+from cache import DiskCache, PageCache, ThumbnailCache
+from preview import parse_preview_fields, preview_uploads, warm_page_cache
+from uploads import IngestedUpload, UploadError, ordered_upload_name
+
+
+@pytest.fixture(autouse=True)
+def _thread_engine_and_caches(monkeypatch, tmp_path, thread_engine):
+    monkeypatch.setattr(preview, "engine", thread_engine)
+    monkeypatch.setattr(preview, "thumbnail_cache", ThumbnailCache(DiskCache(str(tmp_path / "thumbnails"), 1 << 20)))
+    monkeypatch.setattr(conversion, "page_cache", PageCache(DiskCache(str(tmp_path / "pages"), 1 << 24)))
+
+
+def _jpeg(size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def _pdf():
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=(612, 792))
+    c.drawString(72, 700, "Statement")
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def _uploads(files):
+    return [IngestedUpload(index=index, filename=name, content_type='application/octet-stream', size=len(data),
+                           sha256=hashlib.sha256(data).hexdigest(), ordered_name=ordered_upload_name(index, name),
+                           data=data)
+            for index, (name, data) in enumerate(files)]
+
+
+def test_preview_reports_dimensions_and_cached_thumbnails():
+    photo = _jpeg((2000, 1500))
+    params = parse_preview_fields({"thumbnails": "true", "thumbnail_size": "128"})
+    first = asyncio.run(preview_uploads(
+        _uploads([('photo.jpg', photo), ('statement.pdf', _pdf()), ('notes.txt', b'not an image')]), params, 4))
+
+    assert first[0]["width"] == 2000 and first[0]["height"] == 1500 and first[0]["pages"] == 1
+    assert (first[0]["thumbnail_width"], first[0]["thumbnail_height"]) == (128, 96)
+    assert first[0]["thumbnail_cached"] is False
+    data = base64.b64decode(first[0]["thumbnail"].removeprefix("data:image/jpeg;base64,"))
+    assert Image.open(io.BytesIO(data)).size == (128, 96)
+    assert first[1]["thumbnail"] is None and (first[1]["width"], first[1]["height"]) == (612, 792)
+    assert "error" in first[2]
+
+    # Same bytes under another name and position: served from the cache
+    again = asyncio.run(preview_uploads(_uploads([('other.jpg', _jpeg((50, 50))), ('renamed.jpg', photo)]),
+                                        params, 4))
+    assert [entry["thumbnail_cached"] for entry in again] == [False, True]
+    assert again[1]["thumbnail"] == first[0]["thumbnail"]
+
+
+def test_preview_without_thumbnails_reads_headers_only():
+    params = parse_preview_fields({})
+    assert params["thumbnails"] is False and params["thumbnail_size"] == preview.config.THUMBNAIL_SIZE
+    entries = asyncio.run(preview_uploads(_uploads([('photo.jpg', _jpeg((300, 400)))]), params, 2))
+    assert entries[0]["width"] == 300 and "thumbnail" not in entries[0]
+
+    assert parse_preview_fields({"thumbnail_size": "99999"})["thumbnail_size"] == preview.config.THUMBNAIL_MAX_SIZE
+    with pytest.raises(UploadError):
+        parse_preview_fields({"thumbnail_size": "big"})
+
+
+def test_warming_fills_the_page_cache_used_by_convert():
+    params = parse_preview_fields({"pipeline": "single"})
+    files = [('photo.jpg', _jpeg((300, 400))), ('scan.jpg', _jpeg((400, 300)))]
+    asyncio.run(warm_page_cache(_uploads(files), params, 2))
+
+    progress = conversion.ConversionProgress(_uploads(files))
+    out = io.BytesIO()
+    asyncio.run(conversion.write_output(out, _uploads(files), params, conversion.page_options(params), 2,
+                                        progress))
+    assert [page["cached"] for page in progress.pages] == [True, True]
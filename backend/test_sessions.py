@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import io
+import os
+import threading
+import time
+
+import PyPDF2
+import pytest
+from PIL import Image
+
+import conversion
+from conversion import parse_convert_fields
+from executor import ExecutionEngine
+from sessions import SessionError, SessionLimit, SessionManager, parse_finalize_fields
+from uploads import IngestedUpload, UploadError, ordered_upload_name
+
+
+pytestmark = pytest.mark.usefixtures("thread_engine")
+
+
+def _upload(directory, name, size=(300, 400)):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, ordered_upload_name(0, name))
+    Image.new('RGB', size, (200, 120, 40)).save(path, format='JPEG')
+    with open(path, 'rb') as f:
+        data = f.read()
+    return IngestedUpload(index=0, filename=name, content_type='image/jpeg', size=len(data),
+                          sha256=hashlib.sha256(data).hexdigest(), ordered_name=ordered_upload_name(0, name),
+                          path=path)
+
+
+def _open(tmp_path, **fields):
+    manager = SessionManager(str(tmp_path / "sessions"))
+    session_id = manager.new_session_id()
+    os.makedirs(manager.directory(session_id))
+    return manager, manager.create(session_id, parse_convert_fields(
+        {"pipeline": "single", "label_mode": "vector", **fields}))
+
+
+async def _receive(session, position, name):
+    directory = session.upload_directory(position)
+    await session.receive(position, _upload(directory, name), directory)
+
+
+def test_pages_are_processed_on_arrival_and_assembled_in_the_requested_order(tmp_path):
+    manager, session = _open(tmp_path)
+
+    async def run():
+        # Uploaded out of order; position 1 is replaced by a later upload
+        for position, name in [(2, 'visa.jpg'), (0, 'passport.jpg'), (1, 'old.jpg'), (1, 'bank.jpg')]:
+            await _receive(session, position, name)
+        await asyncio.gather(*(file.task for file in session.files.values()))
+        assert [file['state'] for file in session.status()['files']] == ['ready', 'ready', 'ready']
+
+        params, order = parse_finalize_fields(session.params, {"mode": "merge", "order": "2,0,1"})
+        out = io.BytesIO()
+        progress = await session.finalize(out, params, order)
+        return out.getvalue(), progress
+
+    data, progress = asyncio.run(run())
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    assert [name in page.extract_text() for name, page in zip(['visa', 'passport', 'bank'], reader.pages)] == [True] * 3
+    assert [info['original_name'] for info in progress.file_info] == ['visa.jpg', 'passport.jpg', 'bank.jpg']
+    # The replaced upload's directory is gone
+    assert len(os.listdir(session.directory)) == 3
+    assert session.state == 'complete' and session.files == {}
+    assert session.status()['processed_images'] == 3
+    with pytest.raises(SessionError):
+        session.check_open()
+
+
+def test_bad_orders_limits_and_expiry(tmp_path, monkeypatch):
+    manager, session = _open(tmp_path)
+
+    async def run():
+        await _receive(session, 0, 'passport.jpg')
+        params, _ = parse_finalize_fields(session.params, {})
+        for order in ([0, 0], [0, 5]):
+            with pytest.raises(SessionError) as error:
+                await session.finalize(io.BytesIO(), params, order)
+            assert error.value.status_code == 400
+        assert session.state == 'open'
+
+        monkeypatch.setattr('config.MAX_REQUEST_PIXELS', 200_000)
+        directory = session.upload_directory(1)
+        with pytest.raises(UploadError) as error:
+            await session.receive(1, _upload(directory, 'huge.jpg', (1000, 1000)), directory)
+        assert error.value.status_code == 413 and 1 not in session.files
+
+        # The janitor removed the directory: the session and its work go away
+        task = session.files[0].task
+        manager.forget(session.directory)
+        await asyncio.sleep(0)
+        return task
+
+    task = asyncio.run(run())
+    assert task.done() and manager.get(session.id) is None
+
+    with pytest.raises(UploadError):
+        parse_finalize_fields(session.params, {"mode": "zip"})
+    with pytest.raises(UploadError):
+        parse_finalize_fields(session.params, {"order": "1,two"})
+    manager.max_open = 0
+    with pytest.raises(SessionLimit):
+        manager.create(manager.new_session_id(), session.params)
+
+
+def test_a_session_processes_max_in_flight_pages_at_a_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversion, "engine", ExecutionEngine(kind='thread', max_workers=8))
+    running, peaks, lock = [0], [], threading.Lock()
+    page_worker = conversion.PIPELINES['single']
+
+    def counting_worker(*args):
+        with lock:
+            running[0] += 1
+            peaks.append(running[0])
+        try:
+            time.sleep(0.02)
+            return page_worker(*args)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setitem(conversion.PIPELINES, 'single', counting_worker)
+    monkeypatch.setattr('config.MAX_IN_FLIGHT_PAGES', 4)
+    manager, session = _open(tmp_path, max_in_flight="2")
+
+    async def run():
+        # Six uploads land at once
+        await asyncio.gather(*(_receive(session, position, f'page{position}.jpg') for position in range(6)))
+        await asyncio.gather(*(file.task for file in session.files.values()))
+
+    asyncio.run(run())
+    assert len(peaks) == 6 and max(peaks) == 2
@@ -0,0 +1,91 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+from starlette.requests import Request
+
+from uploads import UploadError, ingest_multipart
+
+BOUNDARY = "snapmergeboundary"
+
+
+def _multipart(parts):
+    body = b""
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n".encode()
+        if filename is not None:
+            body += b"Content-Type: image/jpeg\r\n"
+        body += b"\r\n" + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def _request(body, chunk_size=4096, content_length=True):
+    headers = [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]
+    if content_length:
+        headers.append((b"content-length", str(len(body)).encode()))
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    received = []
+
+    async def receive():
+        chunk = chunks.pop(0)
+        received.append(len(chunk))
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    request = Request({"type": "http", "method": "POST", "headers": headers}, receive)
+    return request, received
+
+
+def test_small_files_stay_in_memory_and_large_ones_spill(tmp_path):
+    small, large = b"a" * 100, os.urandom(50_000)
+    body = _multipart([("mode", None, b"split"), ("files", "small.jpg", small), ("files", "big.jpg", large)])
+    request, _ = _request(body)
+
+    fields, uploads = asyncio.run(ingest_multipart(request, str(tmp_path), spool_bytes=10_000))
+
+    assert fields == {"mode": "split"}
+    assert [u.ordered_name for u in uploads] == ["000_small.jpg", "001_big.jpg"]
+    assert uploads[0].data == small and uploads[0].path is None
+    assert uploads[0].sha256 == hashlib.sha256(small).hexdigest()
+    assert uploads[1].data is None
+    with open(uploads[1].path, "rb") as f:
+        assert f.read() == large
+    assert uploads[1].sha256 == hashlib.sha256(large).hexdigest()
+    # Only the spilled file touches the disk
+    assert os.listdir(tmp_path) == ["001_big.jpg"]
+
+
+def test_oversized_file_is_rejected_before_the_body_is_read(tmp_path):
+    body = _multipart([("files", "big.jpg", b"x" * 200_000), ("files", "other.jpg", b"y" * 10)])
+    request, received = _request(body, content_length=False)
+
+    with pytest.raises(UploadError) as excinfo:
+        asyncio.run(ingest_multipart(request, str(tmp_path), spool_bytes=1000, max_file_bytes=20_000))
+
+    assert excinfo.value.status_code == 413
+    assert sum(received) < len(body) // 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_declared_length_over_the_request_limit_is_rejected(tmp_path):
+    body = _multipart([("files", "a.jpg", b"x" * 5000)])
+    request, received = _request(body)
+
+    with pytest.raises(UploadError) as excinfo:
+        asyncio.run(ingest_multipart(request, str(tmp_path), max_request_bytes=1000))
+
+    assert excinfo.value.status_code == 413
+    assert received == []
+
+
+def test_request_memory_budget_spills_remaining_files(tmp_path):
+    body = _multipart([("files", f"{i}.jpg", bytes([i]) * 400) for i in range(5)])
+    request, _ = _request(body)
+
+    _, uploads = asyncio.run(ingest_multipart(request, str(tmp_path), spool_bytes=1000, memory_bytes=1000))
+
+    assert [u.path is None for u in uploads] == [True, True, False, False, False]
+    assert [u.size for u in uploads] == [400] * 5
@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+import metrics
+import pipeline
+from executor import ExecutionEngine
+from warmup import FirstRequestTimer, prime_worker, report_startup, warm_up
+
+
+def _primed():
+    # Only the warm-up has loaded a label font in a worker
+    return os.getpid(), pipeline.load_label_font.cache_info().currsize
+
+
+def test_warm_up_primes_the_workers_without_recording_stage_timings():
+    engine = ExecutionEngine(kind='process', max_workers=2)
+    engine.worker_init = prime_worker
+    encodes = metrics.STAGE_SECONDS.count(stage='encode')
+
+    async def run():
+        seconds = await warm_up(engine)
+        return seconds, await asyncio.gather(*(engine.run(_primed) for _ in range(4)))
+
+    try:
+        seconds, results = asyncio.run(run())
+    finally:
+        engine.shutdown()
+    assert seconds > 0
+    assert all(currsize > 0 for _, currsize in results)
+    assert metrics.STAGE_SECONDS.count(stage='encode') == encodes
+
+    report_startup(0.5, seconds, 2.0)
+    text = metrics.REGISTRY.render()
+    assert 'snapmerge_startup_seconds{phase="import"} 0.5' in text
+    assert 'snapmerge_startup_seconds{phase="total"}' in text
+
+
+def test_only_the_first_conversion_request_is_timed():
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope['path'])
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+    async def send(message):
+        pass
+
+    timer = FirstRequestTimer(app, paths=('/convert',))
+    metrics.FIRST_REQUEST_SECONDS.set(-1)
+
+    async def run():
+        for method, path in [('GET', '/convert'), ('POST', '/metrics'), ('POST', '/convert')]:
+            await timer({'type': 'http', 'method': method, 'path': path}, None, send)
+        assert metrics.FIRST_REQUEST_SECONDS.samples()[0][2] >= 0
+        metrics.FIRST_REQUEST_SECONDS.set(-1)
+        await timer({'type': 'http', 'method': 'POST', 'path': '/convert'}, None, send)
+
+    asyncio.run(run())
+    assert calls == ['/convert', '/metrics', '/convert', '/convert']
+    assert metrics.FIRST_REQUEST_SECONDS.samples()[0][2] == -1
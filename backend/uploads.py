@@ -0,0 +1,307 @@
+"""
+Streaming ingestion of multipart uploads.
+
+FastAPI's ``UploadFile`` parameters are filled in before the endpoint runs:
+Starlette spools every part to its own temporary file, the old handler then
+read each one fully into memory and wrote it out again under the job
+directory.  This module parses the request body itself as it arrives and
+sends each file part to a sink that:
+
+* hashes the bytes incrementally (SHA-256),
+* keeps small files in memory and spills large ones, once, straight to
+  their final path in the job directory,
+* enforces per-file and per-request byte limits as soon as they are
+  crossed, so oversized requests are rejected before they are fully read.
+
+The multipart state machine mirrors starlette.formparsers.MultiPartParser.
+"""
+import asyncio
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+from starlette.requests import Request
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # older python-multipart releases
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+import config
+
+
+class UploadError(Exception):
+    """The request body could not be ingested; carries the HTTP status to answer with"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class IngestedUpload:
+    """One uploaded file, either held in memory or spilled to disk"""
+    index: int
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    ordered_name: str
+    path: Optional[str] = None  # Set when the upload was spilled to disk
+    data: Optional[bytes] = None  # Set when the upload stayed in memory
+
+    @property
+    def source(self) -> Union[str, bytes]:
+        """What the decoder should open: a file path or the bytes themselves"""
+        return self.path if self.path is not None else self.data
+
+    def discard(self):
+        """Release the upload's memory or disk space"""
+        self.data = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def ordered_upload_name(index: int, filename: str) -> str:
+    """On-disk name that preserves upload order, e.g. 003_passport.jpg"""
+    base = os.path.basename(filename.replace('\\', '/')) if filename else ''
+    if not base:
+        extension = os.path.splitext(filename)[1] if filename else ".jpg"
+        base = f"image{extension}"
+    return f"{index:03d}_{base}"
+
+
+class _UploadSink:
+    """Receives the bytes of one file part"""
+
+    def __init__(self, index: int, filename: str, content_type: str, temp_dir: str,
+                 spool_bytes: int, max_file_bytes: int):
+        self.index = index
+        self.filename = filename
+        self.content_type = content_type
+        self.ordered_name = ordered_upload_name(index, filename)
+        self.path = os.path.join(temp_dir, self.ordered_name)
+        self.spool_bytes = spool_bytes
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._file = None
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_file_bytes:
+            raise UploadError(
+                f"File '{self.filename}' exceeds the {self.max_file_bytes} byte limit", status_code=413)
+        self._hash.update(data)
+        if self._file is None:
+            self._buffer.extend(data)
+            if len(self._buffer) > self.spool_bytes:
+                # Spill to the final location; later chunks go straight there
+                self._file = open(self.path, 'wb')
+                self._file.write(self._buffer)
+                self._buffer = bytearray()
+        else:
+            self._file.write(data)
+
+    @property
+    def on_disk(self) -> bool:
+        return self._file is not None
+
+    def close(self) -> IngestedUpload:
+        upload = IngestedUpload(
+            index=self.index,
+            filename=self.filename,
+            content_type=self.content_type,
+            size=self.size,
+            sha256=self._hash.hexdigest(),
+            ordered_name=self.ordered_name,
+        )
+        if self._file is not None:
+            self._file.close()
+            upload.path = self.path
+        else:
+            upload.data = bytes(self._buffer)
+        self._buffer = bytearray()
+        return upload
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self._buffer = bytearray()
+
+
+class _MultipartIngester:
+    """python-multipart callbacks that route file parts to upload sinks"""
+
+    def __init__(self, temp_dir: str, charset: str, spool_bytes: int, max_file_bytes: int,
+                 max_request_bytes: int, max_files: int, memory_bytes: int):
+        self.temp_dir = temp_dir
+        self.charset = charset
+        self.spool_bytes = spool_bytes
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0  # Bytes of finished uploads kept in memory
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.max_files = max_files
+        self.fields: Dict[str, str] = {}
+        self.uploads: List[IngestedUpload] = []
+        self.total_bytes = 0
+        self._header_name = b""
+        self._header_value = b""
+        self._headers: List[Tuple[bytes, bytes]] = []
+        self._field_name: Optional[str] = None
+        self._field_data = bytearray()
+        self._sink: Optional[_UploadSink] = None
+        self._open_sinks: List[_UploadSink] = []
+        # Data for sinks that are already on disk is written off the event loop
+        self.pending_disk_writes: List[Tuple[_UploadSink, bytes]] = []
+
+    def _decode(self, value: bytes) -> str:
+        try:
+            return value.decode(self.charset)
+        except (UnicodeDecodeError, LookupError):
+            return value.decode('latin-1')
+
+    def on_part_begin(self):
+        self._headers = []
+        self._field_name = None
+        self._field_data = bytearray()
+        self._sink = None
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers.append((self._header_name.lower(), self._header_value))
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        headers = dict(self._headers)
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise UploadError('The Content-Disposition header field "name" must be provided.')
+        self._field_name = self._decode(options[b"name"])
+        if b"filename" in options:
+            if len(self.uploads) + len(self._open_sinks) >= self.max_files:
+                raise UploadError(f"Too many files. Maximum number of files is {self.max_files}.", status_code=413)
+            self._sink = _UploadSink(
+                index=len(self.uploads),
+                filename=self._decode(options[b"filename"]),
+                content_type=self._decode(headers.get(b"content-type", b"application/octet-stream")),
+                temp_dir=self.temp_dir,
+                # Once the request's memory budget is used up, files go to disk
+                spool_bytes=min(self.spool_bytes, max(0, self.memory_bytes - self.memory_used)),
+                max_file_bytes=self.max_file_bytes,
+            )
+            self._open_sinks.append(self._sink)
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        self.total_bytes += len(chunk)
+        if self.total_bytes > self.max_request_bytes:
+            raise UploadError(
+                f"Request exceeds the {self.max_request_bytes} byte upload limit", status_code=413)
+        if self._sink is None:
+            if len(self._field_data) + len(chunk) > config.MAX_FIELD_BYTES:
+                raise UploadError(f"Form field '{self._field_name}' is too large", status_code=413)
+            self._field_data.extend(chunk)
+        elif self._sink.on_disk:
+            self.pending_disk_writes.append((self._sink, chunk))
+        else:
+            self._sink.write(chunk)
+
+    def on_part_end(self):
+        if self._sink is None:
+            self.fields[self._field_name] = self._decode(bytes(self._field_data))
+            return
+        if self.pending_disk_writes:
+            # Finish writing this part before closing its file
+            self.flush_disk_writes()
+        self._open_sinks.remove(self._sink)
+        upload = self._sink.close()
+        if upload.data is not None:
+            self.memory_used += upload.size
+        self.uploads.append(upload)
+        self._sink = None
+
+    def on_end(self):
+        pass
+
+    def flush_disk_writes(self):
+        pending, self.pending_disk_writes = self.pending_disk_writes, []
+        for sink, chunk in pending:
+            sink.write(chunk)
+
+    def abort(self):
+        for sink in self._open_sinks:
+            sink.abort()
+        for upload in self.uploads:
+            upload.discard()
+
+
+async def ingest_multipart(request: Request, temp_dir: str,
+                           spool_bytes: int = config.UPLOAD_SPOOL_BYTES,
+                           max_file_bytes: int = config.MAX_UPLOAD_FILE_BYTES,
+                           max_request_bytes: int = config.MAX_UPLOAD_REQUEST_BYTES,
+                           max_files: int = config.MAX_UPLOAD_FILES,
+                           memory_bytes: int = config.UPLOAD_MEMORY_BYTES) -> Tuple[Dict[str, str], List[IngestedUpload]]:
+    """
+    Stream a multipart/form-data request body into upload sinks.
+
+    Returns the plain form fields and the uploaded files in request order.
+    Files are kept in memory up to ``spool_bytes`` each and ``memory_bytes``
+    for the whole request; everything else is spilled to ``temp_dir``.
+    Raises UploadError (with a 400 or 413 status) on malformed bodies or
+    exceeded limits; everything written so far is removed in that case.
+    """
+    content_type = request.headers.get("content-type", "")
+    media_type, params = parse_options_header(content_type)
+    if media_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data request")
+
+    declared_length = request.headers.get("content-length")
+    if declared_length and declared_length.isdigit() and int(declared_length) > max_request_bytes:
+        # Reject before reading a single byte of the body
+        raise UploadError(f"Request exceeds the {max_request_bytes} byte upload limit", status_code=413)
+
+    charset = params.get(b"charset", b"utf-8").decode("latin-1")
+    ingester = _MultipartIngester(temp_dir, charset, spool_bytes, max_file_bytes,
+                                  max_request_bytes, max_files, memory_bytes)
+    parser = multipart.MultipartParser(params[b"boundary"], {
+        "on_part_begin": ingester.on_part_begin,
+        "on_part_data": ingester.on_part_data,
+        "on_part_end": ingester.on_part_end,
+        "on_header_field": ingester.on_header_field,
+        "on_header_value": ingester.on_header_value,
+        "on_header_end": ingester.on_header_end,
+        "on_headers_finished": ingester.on_headers_finished,
+        "on_end": ingester.on_end,
+    })
+
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if ingester.pending_disk_writes:
+                await asyncio.to_thread(ingester.flush_disk_writes)
+        parser.finalize()
+    except FormParserError as exc:
+        ingester.abort()
+        raise UploadError(f"Invalid multipart data: {exc}") from exc
+    except BaseException:
+        ingester.abort()
+        raise
+
+    return ingester.fields, ingester.uploads
@@ -0,0 +1,141 @@
+"""
+Process warm-up and cold-start measurement.
+
+A fresh web process pays for a lot on its first conversion: the engine's
+worker processes are spawned and import Pillow, ReportLab and PyPDF2, the
+label fonts are loaded, and the JPEG codecs and PDF writers run for the
+first time.  On one CPU that made the first single-page /convert take over
+600 ms instead of 170 ms (``python -m benchmarks.bench_startup``).  With SNAPMERGE_WARMUP the lifespan does all
+of it before the server accepts connections: every engine worker runs
+``prime_worker`` in its initializer (replacement workers too), and the web
+process, which writes the documents, runs it once itself.
+
+How long the process took to become ready (imports, warm-up, total) and
+how long its first conversion request took are logged and exported as
+``snapmerge_startup_seconds`` and ``snapmerge_first_request_seconds``.
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+from PIL import Image
+
+from metrics import FIRST_REQUEST_SECONDS, STARTUP_SECONDS, collect_stages
+from pipeline import (
+    LABEL_MODES,
+    PIPELINES,
+    MergedDocument,
+    PageOptions,
+    copy_pdf_pages,
+    render_single_page_pdf,
+)
+
+logger = logging.getLogger('snapmerge.warmup')
+
+WARMUP_IMAGE_SIZE = (64, 48)
+
+
+def prime_process() -> float:
+    """
+    Run a tiny page through every pipeline and label mode, write them as a
+    merged PDF and copy that back in as an uploaded PDF, so this process
+    has imported and initialized everything a conversion touches; returns
+    the seconds taken
+    """
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    Image.new('RGB', WARMUP_IMAGE_SIZE, (200, 120, 40)).save(buffer, format='JPEG')
+    source = buffer.getvalue()
+    # Collected and dropped: these are not real pages
+    with collect_stages():
+        pages = [PIPELINES[pipeline](source, 'warm-up.jpg', 1,
+                                     PageOptions(label_mode=label_mode, color_mode='auto'), 0)
+                 for pipeline in PIPELINES for label_mode in LABEL_MODES]
+        out = io.BytesIO()
+        document = MergedDocument(out)
+        for page in pages:
+            document.add(page)
+        document.close()
+        pdf = out.getvalue()
+        render_single_page_pdf(copy_pdf_pages(pdf, 'warm-up.pdf'))
+    return time.perf_counter() - started
+
+
+def prime_worker():
+    """Engine worker initializer: a failed warm-up must not take the pool down with it"""
+    try:
+        prime_process()
+    except Exception as e:
+        logger.warning("Worker warm-up failed: %s", e)
+
+
+async def warm_up(engine) -> float:
+    """
+    Start the engine's workers and prime them and this process; returns the
+    seconds taken.  The engine must have been started with ``worker_init``
+    set to prime_worker.
+    """
+    started = time.perf_counter()
+    await asyncio.to_thread(prime_process)
+    if engine.kind == 'process':
+        # A task per worker spawns all of them; each primes itself before
+        # taking its first task
+        await asyncio.gather(*(engine.run(os.getpid) for _ in range(engine.max_workers)))
+    return time.perf_counter() - started
+
+
+def process_age() -> Optional[float]:
+    """Seconds since this process started (from /proc), None where that is not available"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Field 22 is the start time in clock ticks after boot; the
+            # command name before it may contain spaces
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+def report_startup(import_seconds: float, warmup_seconds: Optional[float], since_import: float):
+    """Log and export how long this process took to become ready"""
+    total = process_age()
+    if total is None:
+        total = since_import
+    STARTUP_SECONDS.set(import_seconds, phase='import')
+    STARTUP_SECONDS.set(warmup_seconds or 0.0, phase='warmup')
+    STARTUP_SECONDS.set(total, phase='total')
+    if warmup_seconds is None:
+        logger.info("🚀 Ready in %.2fs (imports %.2fs, no warm-up)", total, import_seconds)
+    else:
+        logger.info("🚀 Ready in %.2fs (imports %.2fs, warm-up %.2fs)", total, import_seconds, warmup_seconds)
+
+
+class FirstRequestTimer:
+    """ASGI middleware timing this process's first POST on the given paths, until its response starts"""
+
+    def __init__(self, app, paths: Iterable[str]):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.timed = False
+
+    async def __call__(self, scope, receive, send):
+        if (self.timed or scope['type'] != 'http' or scope['method'] != 'POST'
+                or scope['path'] not in self.paths):
+            await self.app(scope, receive, send)
+            return
+        self.timed = True
+        started = time.perf_counter()
+
+        async def timed_send(message):
+            if message['type'] == 'http.response.start':
+                seconds = time.perf_counter() - started
+                FIRST_REQUEST_SECONDS.set(seconds)
+                logger.info("⏱️  First request (%s) answered in %.3fs", scope['path'], seconds)
+            await send(message)
+
+        await self.app(scope, receive, timed_send)